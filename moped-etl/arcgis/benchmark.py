@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+"""Times each stage of components_to_agol on synthetic component records"""
+# docker compose run --entrypoint "python /app/benchmark.py" arcgis --components 20000;
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+
+import components_to_agol
+import local_agol
+import upload
+import utils
+from components_to_agol import (
+    make_all_features,
+    make_upload_chunker,
+    make_upload_stage,
+)
+from encoding import FeatureEncoder, get_encoded_size, join_features
+from process.logging import get_logger
+from settings import FETCHED_FIELDS
+
+# Austin's bounding box, so the synthetic coordinates have realistic precision
+MIN_LONGITUDE, MAX_LONGITUDE = -97.94, -97.56
+MIN_LATITUDE, MAX_LATITUDE = 30.10, 30.52
+# About 50 meters in degrees
+VERTEX_STEP = 0.0005
+
+# Fields generated as numbers rather than text
+NUMERIC_FIELDS = {
+    "component_id",
+    "component_phase_id",
+    "feature_count",
+    "interim_project_component_id",
+    "interim_project_id",
+    "length_feet_total",
+    "length_miles_total",
+    "parent_project_id",
+    "project_component_id",
+    "project_funding_total",
+    "project_id",
+    "project_phase_id",
+}
+
+
+def make_line(rng, vertex_count):
+    """Make a random walk of vertices that looks like a street segment"""
+    longitude = rng.uniform(MIN_LONGITUDE, MAX_LONGITUDE)
+    latitude = rng.uniform(MIN_LATITUDE, MAX_LATITUDE)
+    line = []
+    for _ in range(vertex_count):
+        line.append([longitude, latitude])
+        longitude += rng.uniform(-VERTEX_STEP, VERTEX_STEP)
+        latitude += rng.uniform(-VERTEX_STEP, VERTEX_STEP)
+    return line
+
+
+def make_synthetic_records(
+    *, component_count, point_share, vertices_per_line, points_per_component, seed
+):
+    """Generate records shaped like the component view.
+
+    Args:
+        component_count (int): the number of components to generate
+        point_share (float): the fraction of components with point geometry
+        vertices_per_line (int): the number of vertices in each line geometry
+        points_per_component (int): the number of points in each point component
+        seed (int): the random seed, so that runs are comparable
+
+    Returns:
+        list: component_arcgis_online_view records
+    """
+    rng = random.Random(seed)
+    fields = [
+        field for field in FETCHED_FIELDS if field not in ("geometry", "line_geometry")
+    ]
+    components = []
+    for project_component_id in range(1, component_count + 1):
+        component = {
+            field: (
+                rng.randint(1, 100_000)
+                if field in NUMERIC_FIELDS
+                else f"{field} {rng.randint(1, 100_000)}"
+            )
+            for field in fields
+        }
+        component["project_component_id"] = project_component_id
+        component["project_id"] = project_component_id // 5 + 1
+
+        if rng.random() < point_share:
+            points = [
+                [
+                    rng.uniform(MIN_LONGITUDE, MAX_LONGITUDE),
+                    rng.uniform(MIN_LATITUDE, MAX_LATITUDE),
+                ]
+                for _ in range(points_per_component)
+            ]
+            component["geometry"] = {"type": "MultiPoint", "coordinates": points}
+            # The view buffers each point into a ring for the combined layer
+            component["line_geometry"] = {
+                "type": "MultiLineString",
+                "coordinates": [make_line(rng, 17) for _ in points],
+            }
+        else:
+            component["geometry"] = {
+                "type": "MultiLineString",
+                "coordinates": [make_line(rng, vertices_per_line)],
+            }
+            component["line_geometry"] = None
+        components.append(component)
+    return components
+
+
+def time_fetch_parse(response_body):
+    """Time decoding a Hasura response body, as done for every fetched page"""
+    started_at = time.perf_counter()
+    data = json.loads(response_body)
+    return time.perf_counter() - started_at, data
+
+
+def time_make_all_features(components):
+    """Time building the Esri features of every layer"""
+    started_at = time.perf_counter()
+    all_features = make_all_features(components)
+    return time.perf_counter() - started_at, all_features
+
+
+def time_serialization(all_features):
+    """Time encoding each layer's features and joining the addFeatures payload of every chunk
+
+    Returns:
+        tuple: the seconds taken and the payload bytes and chunk count of each layer
+    """
+    payload_stats = {}
+    started_at = time.perf_counter()
+    encoder = FeatureEncoder()
+    for feature_type, features in all_features.items():
+        payload_bytes = 0
+        chunk_count = 0
+        chunker = make_upload_chunker(feature_type)
+        for feature_chunk, _ in chunker.chunks(
+            map(encoder.encode_feature, features), get_encoded_size
+        ):
+            payload_bytes += len(join_features(feature_chunk))
+            chunk_count += 1
+        payload_stats[feature_type] = {
+            "features": len(features),
+            "payload_bytes": payload_bytes,
+            "chunks": chunk_count,
+        }
+    return time.perf_counter() - started_at, payload_stats
+
+
+def time_upload(all_features, *, workers, layer_workers):
+    """Time uploading every layer to the stand-in the endpoints point at"""
+    encoder = FeatureEncoder()
+    layer_jobs = {
+        feature_type: [
+            make_upload_stage(
+                feature_type, features, make_upload_chunker(feature_type), encoder
+            )
+        ]
+        for feature_type, features in all_features.items()
+    }
+    started_at = time.perf_counter()
+    upload.run_layer_jobs(layer_jobs, workers, layer_workers)
+    return time.perf_counter() - started_at
+
+
+def start_stand_in(latency, latency_per_mb):
+    """Serve a local AGOL stand-in on a free port and point the AGOL endpoints at it
+
+    Returns:
+        ThreadingHTTPServer: the running stand-in
+    """
+    options = argparse.Namespace(
+        host="127.0.0.1",
+        port=0,
+        latency=latency,
+        latency_per_mb=latency_per_mb,
+        failure_rate=0,
+        throttle_rate=0,
+        retry_after=1,
+        token_error_rate=0,
+        error_body_rate=0,
+        token_lifetime=3600,
+        view=[],
+    )
+    server = local_agol.make_server(options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    utils.AGOL_ORG_BASE_URL = base_url
+    utils.AGOL_COMPONENTS_ENDPOINT = (
+        f"{base_url}/arcgis/rest/services/Moped_Project_Components/FeatureServer"
+    )
+    utils.get_token()
+    return server
+
+
+def run_sweep(args):
+    """Time the local stages at each size of `args.sweep` and check that they scale linearly
+
+    Each stage's cost per component at every size is compared with its cost at the smallest
+    size. The Hasura response is not serialized at each size, so only `make_all_features`
+    and serialization are swept, which keeps the largest sizes within memory.
+
+    Returns:
+        tuple: the sweep's settings and per-component cost of each stage at every size, and
+            True if no stage's cost per component grew more than `args.max_growth` times
+    """
+    sizes = sorted(args.sweep)
+    stage_costs = {"make_all_features": {}, "serialization": {}}
+    for size in sizes:
+        logger.info(f"Generating {size} synthetic components...")
+        components = make_synthetic_records(
+            component_count=size,
+            point_share=args.point_share,
+            vertices_per_line=args.vertices,
+            points_per_component=args.points,
+            seed=args.seed,
+        )
+        timings = {stage: [] for stage in stage_costs}
+        for repeat in range(1, args.repeat + 1):
+            logger.info(f"Running {size} components, repeat {repeat} of {args.repeat}...")
+            # make_all_features pops the geometries, so each repeat builds from a copy
+            components_copy = [dict(component) for component in components]
+            seconds, all_features = time_make_all_features(components_copy)
+            timings["make_all_features"].append(seconds)
+            seconds, _ = time_serialization(all_features)
+            timings["serialization"].append(seconds)
+            del components_copy, all_features
+        del components
+        for stage, seconds in timings.items():
+            stage_costs[stage][size] = min(seconds) / size
+
+    passed = True
+    stages = {}
+    for stage, costs in stage_costs.items():
+        base_cost = costs[sizes[0]]
+        stages[stage] = {}
+        for size in sizes:
+            growth = costs[size] / base_cost
+            stages[stage][size] = {
+                "microseconds_per_component": round(costs[size] * 1_000_000, 3),
+                "growth": round(growth, 3),
+            }
+            if growth > args.max_growth:
+                passed = False
+    return (
+        {
+            "settings": {
+                "sizes": sizes,
+                "point_share": args.point_share,
+                "vertices_per_line": args.vertices,
+                "points_per_component": args.points,
+                "seed": args.seed,
+                "repeat": args.repeat,
+                "max_growth": args.max_growth,
+            },
+            "platform": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+            },
+            "stages": stages,
+            "passed": passed,
+        },
+        passed,
+    )
+
+
+def summarize(seconds):
+    """Reduce the timings of a stage's repeats to comparable numbers"""
+    return {
+        "min_seconds": round(min(seconds), 6),
+        "median_seconds": round(statistics.median(seconds), 6),
+        "max_seconds": round(max(seconds), 6),
+    }
+
+
+def run_benchmark(args):
+    """Run each stage `args.repeat` times and collect the results
+
+    Returns:
+        dict: the benchmark's settings, platform, stage timings and payload sizes
+    """
+    logger.info(f"Generating {args.components} synthetic components...")
+    components = make_synthetic_records(
+        component_count=args.components,
+        point_share=args.point_share,
+        vertices_per_line=args.vertices,
+        points_per_component=args.points,
+        seed=args.seed,
+    )
+    components_body = json.dumps({"component_arcgis_online_view": components})
+
+    server = None if args.skip_upload else start_stand_in(args.latency, args.latency_per_mb)
+    timings = {"fetch_parse": [], "make_all_features": [], "serialization": []}
+    if server:
+        timings["upload"] = []
+
+    for repeat in range(1, args.repeat + 1):
+        logger.info(f"Running repeat {repeat} of {args.repeat}...")
+        seconds, components_data = time_fetch_parse(components_body)
+        timings["fetch_parse"].append(seconds)
+
+        seconds, all_features = time_make_all_features(
+            components_data["component_arcgis_online_view"]
+        )
+        timings["make_all_features"].append(seconds)
+
+        seconds, payload_stats = time_serialization(all_features)
+        timings["serialization"].append(seconds)
+
+        if server:
+            timings["upload"].append(
+                time_upload(
+                    all_features, workers=args.workers, layer_workers=args.layer_workers
+                )
+            )
+
+    if server:
+        server.shutdown()
+
+    return {
+        "settings": {
+            "components": args.components,
+            "point_share": args.point_share,
+            "vertices_per_line": args.vertices,
+            "points_per_component": args.points,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "workers": args.workers,
+            "layer_workers": args.layer_workers,
+            "latency": args.latency,
+            "latency_per_mb": args.latency_per_mb,
+        },
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "hasura_bytes": len(components_body),
+        "layers": payload_stats,
+        "stages": {stage: summarize(seconds) for stage, seconds in timings.items()},
+    }
+
+
+def get_cli_args():
+    """Create the CLI and parse args
+
+    Returns:
+        argparse.Namespace: The CLI namespace
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--components",
+        type=int,
+        default=10_000,
+        help="Number of synthetic components. Defaults to 10000.",
+    )
+    parser.add_argument(
+        "--point-share",
+        type=float,
+        default=0.5,
+        help="Fraction of components with point geometry. Defaults to 0.5.",
+    )
+    parser.add_argument(
+        "--vertices",
+        type=int,
+        default=50,
+        help="Vertices in each line geometry. Defaults to 50.",
+    )
+    parser.add_argument(
+        "--points",
+        type=int,
+        default=3,
+        help="Points in each point component, which sets the exploded layer's size. Defaults to 3.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Times to run each stage. Defaults to 3.",
+    )
+    parser.add_argument(
+        "--skip-upload",
+        action="store_true",
+        help="Only time the stages that run locally.",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("--layer-workers", type=int, default=2)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds the stand-in adds to each response. Defaults to 0.",
+    )
+    parser.add_argument(
+        "--latency-per-mb",
+        type=float,
+        default=0,
+        help="Seconds the stand-in adds per megabyte of payload. Defaults to 0.",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        nargs="?",
+        const=[1_000, 10_000, 100_000, 500_000],
+        default=None,
+        metavar="SIZES",
+        help="Time the local stages at each comma-separated number of components instead, and fail if their cost per component grows super-linearly. Defaults to 1000,10000,100000,500000 if --sweep is used without a value.",
+    )
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=2.0,
+        help="How many times its cost per component at the smallest sweep size a stage may take at a larger size. Defaults to 2.0.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="benchmark.json",
+        help="File the JSON results are written to. Defaults to benchmark.json.",
+    )
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must run each stage at least once")
+    return args
+
+
+if __name__ == "__main__":
+    args = get_cli_args()
+    logger = get_logger(name="benchmark", level=logging.INFO)
+    components_to_agol.logger.setLevel(logging.WARNING)
+    local_agol.logger.setLevel(logging.WARNING)
+    utils.logger.setLevel(logging.WARNING)
+    upload.logger.setLevel(logging.WARNING)
+
+    if args.sweep:
+        results, passed = run_sweep(args)
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+        for stage, costs in results["stages"].items():
+            for size, cost in costs.items():
+                logger.info(
+                    f"{stage} at {size} components: {cost['microseconds_per_component']:.1f} microseconds per component ({cost['growth']:.2f}x)"
+                )
+        logger.info(f"Wrote the results to {args.output}")
+        if not passed:
+            logger.error(
+                f"A stage's cost per component grew more than {args.max_growth}x across the sweep"
+            )
+            sys.exit(1)
+        sys.exit(0)
+
+    results = run_benchmark(args)
+    with open(args.output, "w") as fout:
+        json.dump(results, fout, indent=2)
+    for stage, summary in results["stages"].items():
+        logger.info(f"{stage}: median {summary['median_seconds']:.3f} seconds")
+    logger.info(f"Wrote the results to {args.output}")
@@ -0,0 +1,50 @@
+"""Writes a layer's features as GeoJSON so AGOL can load them in a single append job"""
+import os
+
+from encoding import dumps
+
+
+def get_geojson_geometry(geometry):
+    """Convert an Esri geometry back to the geojson geometry it was built from.
+
+    Args:
+        geometry (dict): an Esri geometry with `paths`, `points`, or `x` and `y`
+
+    Returns:
+        dict: a geojson MultiLineString, MultiPoint or Point geometry
+    """
+    if "paths" in geometry:
+        return {"type": "MultiLineString", "coordinates": geometry["paths"]}
+    if "points" in geometry:
+        return {"type": "MultiPoint", "coordinates": geometry["points"]}
+    return {"type": "Point", "coordinates": [geometry["x"], geometry["y"]]}
+
+
+def write_geojson(path, features, encoder):
+    """Write Esri features to a GeoJSON FeatureCollection file.
+
+    Features are written one at a time so the file is never held in memory, and their
+    properties reuse the attributes the encoder already serialized.
+
+    Args:
+        path (str): the file to write
+        features (list): Esri feature objects of a single layer
+        encoder (FeatureEncoder): encodes the feature attributes
+
+    Returns:
+        int: the size of the file in bytes
+    """
+    with open(path, "wb") as fout:
+        fout.write(b'{"type":"FeatureCollection","features":[')
+        for index, feature in enumerate(features):
+            if index:
+                fout.write(b",")
+            fout.write(
+                b'{"type":"Feature","properties":'
+                + encoder.encode_attributes(feature["attributes"])
+                + b',"geometry":'
+                + dumps(get_geojson_geometry(feature["geometry"]))
+                + b"}"
+            )
+        fout.write(b"]}")
+    return os.path.getsize(path)
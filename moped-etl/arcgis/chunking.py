@@ -0,0 +1,134 @@
+"""Splits AGOL request payloads into chunks sized by bytes rather than by feature count"""
+import threading
+import time
+from statistics import median
+
+from utils import get_last_attempt_seconds
+
+
+class AdaptiveChunker:
+    """Yields chunks that fit a serialized payload budget and tunes that budget from
+    how long AGOL takes to answer each request.
+
+    A chunk of long multi-segment street corridors can be megabytes while the same number
+    of signal points is tiny, so chunks are filled up to a byte budget instead of a fixed
+    number of items. After each request finishes, `record` estimates how many bytes AGOL
+    could have handled in `target_seconds` and moves the budget towards it, at most halving
+    or doubling it at a time.
+
+    Chunks are built lazily, so a chunk that is pulled after some requests have returned is
+    sized with the updated budget. `record` is called from the upload workers.
+
+    Args:
+        name (str): a label for the report, such as "points uploads"
+        target_bytes (int): the starting byte budget for a chunk
+        min_bytes (int): the smallest byte budget the chunker will shrink to
+        max_bytes (int): the largest byte budget the chunker will grow to
+        target_seconds (float): the response time we want each request to take
+    """
+
+    def __init__(self, name, target_bytes, min_bytes, max_bytes, target_seconds):
+        self.name = name
+        self.byte_budget = target_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        # (item count, payload bytes) of every chunk handed out, in order
+        self.chunk_sizes = []
+        self._lock = threading.Lock()
+
+    def chunks(self, items, get_size):
+        """Yield successive chunks of items that fit the current byte budget.
+
+        A single item that is larger than the budget is sent on its own.
+
+        Args:
+            items (list): the items to split into chunks
+            get_size (function): returns the serialized size in bytes of one item
+
+        Yields:
+            tuple: the list of items in the chunk and the chunk's payload size in bytes
+        """
+        chunk = []
+        chunk_bytes = 0
+        for item in items:
+            item_bytes = get_size(item)
+            if chunk and chunk_bytes + item_bytes > self.get_byte_budget():
+                yield self._hand_out(chunk, chunk_bytes)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(item)
+            chunk_bytes += item_bytes
+        if chunk:
+            yield self._hand_out(chunk, chunk_bytes)
+
+    def get_byte_budget(self):
+        """Return the current byte budget for a chunk"""
+        with self._lock:
+            return self.byte_budget
+
+    def record(self, payload_bytes, elapsed_seconds):
+        """Adjust the byte budget from the response time of a finished request.
+
+        Args:
+            payload_bytes (int): the payload size of the request
+            elapsed_seconds (float): how long AGOL took to answer the attempt that succeeded
+        """
+        # Guard against a zero timer reading on very small payloads
+        elapsed_seconds = max(elapsed_seconds, 0.001)
+        estimate = payload_bytes * self.target_seconds / elapsed_seconds
+        with self._lock:
+            estimate = min(max(estimate, self.byte_budget / 2), self.byte_budget * 2)
+            self.byte_budget = int(
+                min(max(estimate, self.min_bytes), self.max_bytes)
+            )
+
+    def timed(self, payload_bytes, request):
+        """Wrap a request so that its response time feeds back into the byte budget.
+
+        Only the attempt that succeeded is timed, so one throttled or retried request does
+        not shrink the chunks of the whole layer. Requests that do not go through
+        `resilient_layer_request` are timed from start to finish.
+
+        Args:
+            payload_bytes (int): the payload size of the request
+            request (function): the request to run, which takes no arguments
+
+        Returns:
+            function: runs the request and records how long it took
+        """
+
+        def run_timed_request():
+            start = time.monotonic()
+            result = request()
+            elapsed_seconds = get_last_attempt_seconds()
+            if elapsed_seconds is None:
+                elapsed_seconds = time.monotonic() - start
+            self.record(payload_bytes, elapsed_seconds)
+            return result
+
+        return run_timed_request
+
+    def report(self):
+        """Describe the chunk sizes that were handed out so they can be tuned.
+
+        Returns:
+            str: a one-line summary of the chunk item counts and payload sizes
+        """
+        if not self.chunk_sizes:
+            return f"{self.name}: no chunks"
+        item_counts = [item_count for item_count, _ in self.chunk_sizes]
+        byte_counts = [byte_count for _, byte_count in self.chunk_sizes]
+        return (
+            f"{self.name}: {len(self.chunk_sizes)} chunks, "
+            f"items min/median/max {min(item_counts)}/{median(item_counts):g}/{max(item_counts)}, "
+            f"bytes min/median/max {min(byte_counts)}/{median(byte_counts):g}/{max(byte_counts)}, "
+            f"final budget {self.get_byte_budget()} bytes"
+        )
+
+    def _hand_out(self, chunk, chunk_bytes):
+        """Remember the size of a chunk before it is yielded"""
+        with self._lock:
+            self.chunk_sizes.append((len(chunk), chunk_bytes))
+        return chunk, chunk_bytes
+
@@ -1,6 +1,8 @@
 import argparse
 from datetime import datetime, timezone, timedelta
 
+from settings import UPLOAD_MAX_WORKERS, UPLOAD_MAX_WORKERS_PER_LAYER
+
 
 def get_cli_args():
     """Create the CLI and parse args
@@ -27,6 +29,82 @@ def get_cli_args():
         help="Delete and replace all project components.",
     )
 
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Only add, update, and delete the features of components that changed. Use with -f to compare every feature or -d to compare the features of updated projects.",
+    )
+
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="With -f, empty each layer with truncate and load it from a generated GeoJSON file with one asynchronous append job instead of chunked requests. The feature service must allow uploads. Runs are not journaled for --resume.",
+    )
+
+    parser.add_argument(
+        "--blue-green",
+        action="store_true",
+        help="With -f, rebuild whichever of the blue and green feature services the view layers are not reading, check its feature counts, then point the view layers at it. Runs are not journaled for --resume.",
+    )
+
+    parser.add_argument(
+        "--service-edits",
+        action="store_true",
+        help="With --diff, send the edits of all four layers together in feature service applyEdits requests, chunked by component.",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Fetch components from Hasura a page at a time and upload each page as it arrives, keeping memory use bounded. Runs are not journaled for --resume.",
+    )
+
+    parser.add_argument(
+        "--simplify",
+        action="store_true",
+        help="Round coordinates and simplify line geometries before uploading to shrink the AGOL payloads.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a full or incremental run that did not finish, using its saved features and skipping the chunks AGOL already accepted.",
+    )
+
+    parser.add_argument(
+        "--discard-journal",
+        action="store_true",
+        help="Start a new full or incremental run even though the journal holds a run that did not finish, discarding it instead of refusing to start.",
+    )
+
+    parser.add_argument(
+        "--capture",
+        type=str,
+        metavar="FILE",
+        help="Save every Hasura response of the run to a JSON file for --replay.",
+    )
+
+    parser.add_argument(
+        "--replay",
+        type=str,
+        metavar="FILE",
+        help="Answer Hasura requests from a file saved by --capture instead of querying Hasura. Use the same options and -d date as the captured run.",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        metavar="FILE",
+        help="Append the run's JSON summary of the time, bytes and features of each stage to a JSON Lines file.",
+    )
+
+    parser.add_argument(
+        "--statsd",
+        type=str,
+        metavar="HOST:PORT",
+        help="Also send the run's stage metrics to a StatsD agent, such as localhost:8125.",
+    )
+
     parser.add_argument(
         "-n",
         "--dry-run",
@@ -34,4 +112,19 @@ def get_cli_args():
         help="Log what changes would be made without executing them",
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=UPLOAD_MAX_WORKERS,
+        help=f"Maximum number of AGOL requests in flight across all layers. Defaults to {UPLOAD_MAX_WORKERS}.",
+    )
+
+    parser.add_argument(
+        "--layer-workers",
+        type=int,
+        default=UPLOAD_MAX_WORKERS_PER_LAYER,
+        help=f"Maximum number of AGOL requests in flight for a single layer. Defaults to {UPLOAD_MAX_WORKERS_PER_LAYER}.",
+    )
+
     return parser.parse_args()
@@ -2,24 +2,85 @@
 """Copies all Moped component records to ArcGIS Online (AGOL)"""
 # docker compose run arcgis;
 import logging
+import os
+import tempfile
 import json
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 
 from process.logging import get_logger
 from cli import get_cli_args
 from settings import (
     COMPONENTS_QUERY_BY_LAST_UPDATE_DATE,
-    EXPLODED_COMPONENTS_QUERY_BY_LAST_UPDATE_DATE,
-    UPLOAD_CHUNK_SIZE,
+    COMPONENTS_PAGE_SIZE,
+    COMPONENTS_QUERY,
+    INCREMENTAL_CHANGES_QUERY,
+    COMPONENT_RECORD_TYPES,
+    UPLOAD_CHUNK_TARGET_BYTES,
+    UPLOAD_CHUNK_MIN_BYTES,
+    UPLOAD_CHUNK_MAX_BYTES,
+    DELETE_CHUNK_TARGET_BYTES,
+    DELETE_CHUNK_MIN_BYTES,
+    DELETE_CHUNK_MAX_BYTES,
+    CHUNK_TARGET_SECONDS,
+    JOURNAL_DIR,
+    COORDINATE_DECIMALS,
+    SIMPLIFY_TOLERANCE,
+    LAYER_FIELDS,
+    REQUIRED_FIELDS,
+    BULK_JOB_POLL_SECONDS,
+    BULK_JOB_TIMEOUT_SECONDS,
+    LAYER_IDS,
+    METRICS_PREFIX,
 )
 from utils import (
     make_hasura_request,
     get_token,
     delete_all_features,
+    truncate_layer,
+    upload_file,
+    append_geojson,
+    delete_upload,
+    set_components_endpoint,
+    get_service_name,
+    get_view_source_endpoint,
+    count_features,
+    point_view_at,
+    AGOL_BLUE_ENDPOINT,
+    AGOL_GREEN_ENDPOINT,
+    AGOL_VIEW_ENDPOINT,
     delete_features_by_project_ids,
+    delete_features_by_component_ids,
     add_features,
-    chunks,
+    apply_edits,
+    apply_service_edits,
+    log_request_stats,
+    get_request_stats,
+    start_hasura_capture,
+    save_hasura_capture,
+    start_hasura_replay,
     get_logger,
 )
+from upload import run_layer_jobs
+from chunking import AdaptiveChunker
+from diff import (
+    get_layer_components,
+    make_layer_edits,
+    get_edit_size,
+    split_edits,
+    group_edits_by_component,
+    get_component_edits_size,
+    split_service_edits,
+)
+from journal import RunJournal
+from streaming import iter_component_pages, prefetch, fetch_in_background
+from geometry import shrink_all_features
+from encoding import FeatureEncoder, get_encoded_size, join_features
+from bulk import write_geojson
+from metrics import run_metrics, append_summary, send_to_statsd
 
 
 def get_esri_geometry_key(geometry):
@@ -62,10 +123,6 @@ def make_esri_feature(*, esri_geometry_key, geometry, attributes):
     }
     if (esri_geometry_key == "points") or (esri_geometry_key == "paths"):
         feature["geometry"][esri_geometry_key] = geometry["coordinates"]
-    elif esri_geometry_key == "point":
-        geometry = json.loads(geometry)
-        feature["geometry"]["y"] = geometry["coordinates"][1]
-        feature["geometry"]["x"] = geometry["coordinates"][0]
     else:
         feature["geometry"]["y"] = geometry["coordinates"][1]
         feature["geometry"]["x"] = geometry["coordinates"][0]
@@ -73,19 +130,82 @@ def make_esri_feature(*, esri_geometry_key, geometry, attributes):
     return feature
 
 
-def make_all_features(data, exploded_geometry):
-    """Take a list of component feature records and create Esri feature objects for lines, points, and combined layers in AGOL.
+def explode_multipoint(geometry):
+    """Split a MultiPoint geometry into its points.
+
+    This matches the `exploded_component_arcgis_online_view`, which runs `st_dump` on the
+    component geometry: one Point per coordinate, in `point_index` order.
+
+    Args:
+        geometry (dict): a geojson MultiPoint geometry
+
+    Returns:
+        list: geojson Point geometries
+    """
+    return [
+        {"type": "Point", "coordinates": coordinates}
+        for coordinates in geometry["coordinates"]
+    ]
+
+
+def group_layers_by_fields(layer_fields):
+    """Group the layers that upload the same attributes so that they can share them.
+
+    Args:
+        layer_fields (dict): lists of the columns uploaded to each layer keyed by feature type
+
+    Returns:
+        list: `(fields, feature_types)` tuples, where fields include the `REQUIRED_FIELDS`
+    """
+    feature_types_by_fields = defaultdict(list)
+    for feature_type, fields in layer_fields.items():
+        fields = tuple(dict.fromkeys(REQUIRED_FIELDS + list(fields)))
+        feature_types_by_fields[fields].append(feature_type)
+    return list(feature_types_by_fields.items())
+
+
+def project_attributes(component, source_geometry_type, layer_groups):
+    """Pick the attributes of each layer from a component record.
+
+    Args:
+        component (dict): a component record without its geometries
+        source_geometry_type (str): "point" or "line"
+        layer_groups (list): the layers grouped by their fields from `group_layers_by_fields`
+
+    Returns:
+        dict: attributes keyed by feature type, where layers with the same fields share
+            one dict
+    """
+    attributes_by_layer = {}
+    for fields, feature_types in layer_groups:
+        attributes = {field: component.get(field) for field in fields}
+        # adds a special `source_geometry_type` column that will be useful on the `combined` layer
+        # so that we can keep track of if the original feature was a point or line geometry
+        attributes["source_geometry_type"] = source_geometry_type
+        for feature_type in feature_types:
+            attributes_by_layer[feature_type] = attributes
+    return attributes_by_layer
+
+
+def make_all_features(data, layer_fields=LAYER_FIELDS):
+    """Take a list of component feature records and create Esri feature objects for lines, points, combined, and exploded layers in AGOL.
+
+    Every layer is built in a single pass over the component records. The exploded layer
+    takes each point component's MultiPoint geometry and "explodes" it into individual
+    points, the same as the `exploded_component_arcgis_online_view` does. Each layer only
+    gets the attributes listed for it in `layer_fields`.
 
     Args:
         data (dict): a list of component feature records
-        exploded_geometry (dict): a dictionary of exploded geometry data from the component_arcgis_online_view. This is created
-            by taking the multi-point geometry from the component_arcgis_online_view and "exploding" it into individual points.
+        layer_fields (dict, optional): lists of the columns uploaded to each layer keyed by
+            feature type. Defaults to `LAYER_FIELDS`.
 
     Returns:
-        dict: An object with lists of Esri feature objects for lines, points, and combined layers
+        dict: An object with lists of Esri feature objects for lines, points, combined, and exploded layers
     """
 
     all_features = {"lines": [], "points": [], "combined": [], "exploded": []}
+    layer_groups = group_layers_by_fields(layer_fields)
 
     logger.info("Building Esri feature objects...")
     for component in data:
@@ -102,64 +222,502 @@ def make_all_features(data, exploded_geometry):
             continue
 
         esri_geometry_key = get_esri_geometry_key(geometry)
-        feature = make_esri_feature(
-            esri_geometry_key=esri_geometry_key,
-            geometry=geometry,
-            attributes=component,
+        attributes = project_attributes(
+            component,
+            "point" if esri_geometry_key == "points" else "line",
+            layer_groups,
         )
 
-        # adds a special `source_geometry_type` column that will be useful on the `combined` layer
-        # so that we can keep track of if the original feature was a point or line geometry
-        feature["attributes"]["source_geometry_type"] = (
-            "point" if esri_geometry_key == "points" else "line"
-        )
-
-        if not feature:
-            continue
-
         if esri_geometry_key == "points":
-            all_features["points"].append(feature)
+            all_features["points"].append(
+                make_esri_feature(
+                    esri_geometry_key=esri_geometry_key,
+                    geometry=geometry,
+                    attributes=attributes["points"],
+                )
+            )
             # create the point -> line feature
             line_feature = make_esri_feature(
                 esri_geometry_key="paths",
                 geometry=line_geometry,
-                attributes=component,
+                attributes=attributes["combined"],
             )
             all_features["combined"].append(line_feature)
 
-            project_component_id = feature["attributes"]["project_component_id"]
-            # Filter exploded_geometry to only include dicts with matching project_component_id
-            matching_exploded_geometry_records = [
-                feature
-                for feature in exploded_geometry
-                if feature.get("project_component_id") == project_component_id
-            ]
-            for record in matching_exploded_geometry_records:
-                geometry = record.pop("geometry")
-                esri_geometry_key = "point"
+            for exploded_point in explode_multipoint(geometry):
+                all_features["exploded"].append(
+                    make_esri_feature(
+                        esri_geometry_key="point",
+                        geometry=exploded_point,
+                        attributes=attributes["exploded"],
+                    )
+                )
 
+        else:
+            feature = make_esri_feature(
+                esri_geometry_key=esri_geometry_key,
+                geometry=geometry,
+                attributes=attributes["lines"],
+            )
+            all_features["lines"].append(feature)
+            if attributes["combined"] is not attributes["lines"]:
                 feature = make_esri_feature(
-                    esri_geometry_key="point",
+                    esri_geometry_key=esri_geometry_key,
                     geometry=geometry,
-                    attributes=component,
+                    attributes=attributes["combined"],
                 )
+            all_features["combined"].append(feature)
 
-                feature["attributes"]["source_geometry_type"] = "point"
-                all_features["exploded"].append(feature)
+    return all_features
 
-        else:
-            all_features["lines"].append(feature)
-            all_features["combined"].append(feature)
 
+def get_id_size(record_id):
+    """Return the size in bytes a project or component id adds to a deleteFeatures `where` clause"""
+    return len(str(record_id)) + 2
+
+
+def make_upload_chunker(feature_type):
+    """Create the chunker that sizes the addFeatures requests of a layer"""
+    return AdaptiveChunker(
+        f"{feature_type} uploads",
+        target_bytes=UPLOAD_CHUNK_TARGET_BYTES,
+        min_bytes=UPLOAD_CHUNK_MIN_BYTES,
+        max_bytes=UPLOAD_CHUNK_MAX_BYTES,
+        target_seconds=CHUNK_TARGET_SECONDS,
+    )
+
+
+def make_delete_chunker(feature_type):
+    """Create the chunker that sizes the deleteFeatures requests of a layer"""
+    return AdaptiveChunker(
+        f"{feature_type} deletes",
+        target_bytes=DELETE_CHUNK_TARGET_BYTES,
+        min_bytes=DELETE_CHUNK_MIN_BYTES,
+        max_bytes=DELETE_CHUNK_MAX_BYTES,
+        target_seconds=CHUNK_TARGET_SECONDS,
+    )
+
+
+def make_edit_chunker(feature_type):
+    """Create the chunker that sizes the applyEdits requests of a layer"""
+    return AdaptiveChunker(
+        f"{feature_type} edits",
+        target_bytes=UPLOAD_CHUNK_TARGET_BYTES,
+        min_bytes=UPLOAD_CHUNK_MIN_BYTES,
+        max_bytes=UPLOAD_CHUNK_MAX_BYTES,
+        target_seconds=CHUNK_TARGET_SECONDS,
+    )
+
+
+def make_upload_stage(feature_type, features, chunker, encoder, journal=None):
+    """Split a layer's features into chunks and create the requests that upload them.
+
+    Chunks are created as the requests are pulled, so each one is sized from the
+    response times of the uploads that already finished. Features are encoded as they are
+    chunked, and each chunk's payload is joined from those encoded features. Features the
+    journal shows were already acknowledged are skipped, except for the rest of a component
+    that has unacknowledged features, and each chunk's range is journaled once it succeeds.
+
+    Args:
+        feature_type (str): the layer the features will be added to
+        features (list): Esri feature objects to upload
+        chunker (AdaptiveChunker): sizes the chunks of the layer's uploads
+        encoder (FeatureEncoder): encodes the features, shared by the layers of a run so
+            attributes shared across layers are encoded once
+        journal (RunJournal, optional): the journal of the run. Defaults to None, which
+            uploads every feature without journaling.
+
+    Yields:
+        tuple: `(description, request)` to be run by `run_layer_jobs`
+    """
+    if journal:
+        # This stage is only pulled once the layer's delete stage has succeeded
+        journal.record_cleared(feature_type)
+        pending_ranges = journal.get_pending_ranges(feature_type, features)
+    else:
+        pending_ranges = [(0, len(features))]
+
+    pending_count = sum(end - start for start, end in pending_ranges)
+    logger.info(
+        f"Uploading {pending_count} of {len(features)} features to {feature_type} layer in chunks of about {chunker.get_byte_budget()} bytes..."
+    )
+    index = 0
+    for range_start, range_end in pending_ranges:
+        chunk_start = range_start
+        for feature_chunk, chunk_bytes in chunker.chunks(
+            map(encoder.encode_feature, features[range_start:range_end]),
+            get_encoded_size,
+        ):
+            index += 1
+            chunk_end = chunk_start + len(feature_chunk)
+            request = run_metrics.measured(
+                f"{feature_type} upload",
+                chunker.timed(
+                    chunk_bytes,
+                    partial(add_features, feature_type, join_features(feature_chunk)),
+                ),
+                byte_count=chunk_bytes,
+                feature_count=len(feature_chunk),
+            )
+            if journal:
+                request = journal.recorded(feature_type, chunk_start, chunk_end, request)
+            yield (
+                f"Uploading {feature_type} chunk {index} ({len(feature_chunk)} features, {chunk_bytes} bytes)....",
+                request,
+            )
+            chunk_start = chunk_end
+
+
+def make_bulk_load_stage(feature_type, features, encoder):
+    """Create the request that loads all of a layer's features with one append job.
+
+    The request writes the features to a GeoJSON file, uploads it to the feature service,
+    and starts an append job that loads it on the AGOL server, polling the job until it
+    is done. The file is written by the upload worker, so layers are written in parallel.
+
+    Args:
+        feature_type (str): the layer the features will be added to
+        features (list): Esri feature objects to load
+        encoder (FeatureEncoder): encodes the feature attributes
+
+    Returns:
+        list: a single `(description, request)` tuple to be run by `run_layer_jobs`
+    """
+
+    def load_layer():
+        with run_metrics.timed(f"{feature_type} upload") as counts:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, f"{feature_type}.geojson")
+                file_bytes = write_geojson(path, features, encoder)
+                counts["byte_count"] = file_bytes
+                logger.info(f"Uploading {file_bytes} bytes of {feature_type} GeoJSON...")
+                upload_id = upload_file(feature_type, path)
+            logger.info(f"Appending {len(features)} features to {feature_type} layer...")
+            append_geojson(
+                feature_type, upload_id, BULK_JOB_POLL_SECONDS, BULK_JOB_TIMEOUT_SECONDS
+            )
+            counts["feature_count"] = len(features)
+            delete_upload(feature_type, upload_id)
+
+    return [
+        (
+            f"Loading {len(features)} features into {feature_type} layer with an append job...",
+            load_layer,
+        )
+    ]
+
+
+def make_delete_stage(feature_type, project_ids, component_ids, chunker):
+    """Split project and component ids into chunks and create the requests that delete their features.
+
+    Args:
+        feature_type (str): the layer the features will be deleted from
+        project_ids (list): the ids of the projects whose features will be deleted
+        component_ids (list): the ids of the components whose features will be deleted
+        chunker (AdaptiveChunker): sizes the chunks of the layer's deletes
+
+    Yields:
+        tuple: `(description, request)` to be run by `run_layer_jobs`
+    """
+    for delete_chunk, chunk_bytes in chunker.chunks(project_ids, get_id_size):
+        joined_project_ids = ", ".join(str(x) for x in delete_chunk)
+        yield (
+            f"Deleting features in {feature_type} layer with project ids {joined_project_ids}",
+            run_metrics.measured(
+                f"{feature_type} delete",
+                chunker.timed(
+                    chunk_bytes,
+                    partial(
+                        delete_features_by_project_ids,
+                        feature_type,
+                        joined_project_ids,
+                    ),
+                ),
+                byte_count=chunk_bytes,
+            ),
+        )
+    for delete_chunk, chunk_bytes in chunker.chunks(component_ids, get_id_size):
+        joined_component_ids = ", ".join(str(x) for x in delete_chunk)
+        yield (
+            f"Deleting features in {feature_type} layer with project component ids {joined_component_ids}",
+            run_metrics.measured(
+                f"{feature_type} delete",
+                chunker.timed(
+                    chunk_bytes,
+                    partial(
+                        delete_features_by_component_ids,
+                        feature_type,
+                        joined_component_ids,
+                    ),
+                ),
+                byte_count=chunk_bytes,
+            ),
+        )
+
+
+def make_unacknowledged_delete_stage(feature_type, features, journal):
+    """Delete the features of the components a resumed run uploads again.
+
+    Chunks that AGOL committed without acknowledging them, or that partly failed, would
+    otherwise be added twice when the run is resumed.
+
+    Args:
+        feature_type (str): the layer the features will be deleted from
+        features (list): the Esri feature objects in the layer's snapshot
+        journal (RunJournal): the journal of the resumed run
+
+    Returns:
+        generator: the delete requests from `make_delete_stage`
+    """
+    component_ids = journal.get_pending_component_ids(feature_type, features)
+    logger.info(
+        f"Deleting any {feature_type} features of the {len(component_ids)} components that were not acknowledged..."
+    )
+    return make_delete_stage(
+        feature_type, [], component_ids, make_delete_chunker(feature_type)
+    )
+
+
+def to_naive_utc(date):
+    """Convert an ISO date string with TZ offset to UTC without an offset.
+
+    Postgres ignores the offset of a string cast to a timestamp without time zone, so the
+    activity log's UTC created_at has to be compared with a UTC date.
+
+    Args:
+        date (str): ISO date string with TZ offset
+
+    Returns:
+        str: ISO date string in UTC without an offset
+    """
+    return (
+        datetime.fromisoformat(date.replace("Z", "+00:00"))
+        .astimezone(timezone.utc)
+        .replace(tzinfo=None)
+        .isoformat()
+    )
+
+
+def get_incremental_changes(date):
+    """Find the projects and components to replace in an incremental run.
+
+    Editing a component's features or attributes bumps the component's updated_at, so only
+    those components need to be replaced. A project is replaced as a whole only when it was
+    soft-deleted, or when the activity log shows a change to a record that is not part of a
+    component, since that can change attributes shared by all of its components.
+
+    A component edit also bumps its project's updated_at, which every feature carries as
+    `project_updated_at`. Only the replaced components get the new value, so the features
+    of their sibling components keep the value from when they were last written until the
+    project is replaced. reconcile.py checks each project's latest `project_updated_at`
+    across all layers for that reason. A project whose changed components were all
+    soft-deleted is replaced as a whole, so that one of its features carries the new value.
+
+    Args:
+        date (str): ISO date string with TZ offset of the last run
+
+    Returns:
+        dict: the `project_ids` and `component_ids` whose features are deleted, and the
+            `component_where` filter for the components to upload again
+    """
+    data = make_hasura_request(
+        query=INCREMENTAL_CHANGES_QUERY,
+        variables={
+            "date": date,
+            "activity_date": to_naive_utc(date),
+            "component_record_types": COMPONENT_RECORD_TYPES,
+        },
+    )
+    projects_with_project_changes = {
+        activity["record_project_id"] for activity in data["moped_activity_log"]
+    }
+    projects_with_live_component_changes = {
+        component["project_id"]
+        for component in data["moped_proj_components"]
+        if not component["is_deleted"]
+    }
+    projects_with_project_changes |= {
+        component["project_id"]
+        for component in data["moped_proj_components"]
+        if component["project_id"] not in projects_with_live_component_changes
+    }
+    deleted_project_ids = [
+        project["project_id"] for project in data["moped_project"] if project["is_deleted"]
+    ]
+    replaced_project_ids = [
+        project["project_id"]
+        for project in data["moped_project"]
+        if not project["is_deleted"]
+        and project["project_id"] in projects_with_project_changes
+    ]
+    project_ids = deleted_project_ids + replaced_project_ids
+    # Components of soft-deleted or replaced projects are already covered by project deletes.
+    # Soft-deleted components are included so that their features are deleted.
+    project_ids_set = set(project_ids)
+    component_ids = [
+        component["project_component_id"]
+        for component in data["moped_proj_components"]
+        if component["project_id"] not in project_ids_set
+    ]
+    logger.info(
+        f"Replacing {len(replaced_project_ids)} projects with project-level changes, "
+        f"{len(component_ids)} updated components, and deleting {len(deleted_project_ids)} soft-deleted projects"
+    )
+    return {
+        "project_ids": project_ids,
+        "component_ids": component_ids,
+        "component_where": {
+            "_or": [
+                {"project_id": {"_in": replaced_project_ids}},
+                {"project_component_id": {"_in": component_ids}},
+            ]
+        },
+    }
+
+
+def make_apply_edits_stage(feature_type, edits, chunker):
+    """Split a layer's edits into chunks and create the applyEdits requests that push them.
+
+    Args:
+        feature_type (str): the layer the edits will be applied to
+        edits (list): `(project_component_id, operation, payload)` tuples from
+            `make_layer_edits`
+        chunker (AdaptiveChunker): sizes the chunks of the layer's edits
+
+    Yields:
+        tuple: `(description, request)` to be run by `run_layer_jobs`
+    """
+    for index, (edit_chunk, chunk_bytes) in enumerate(
+        chunker.chunks(edits, get_edit_size), start=1
+    ):
+        edits_by_operation = split_edits(edit_chunk)
+        yield (
+            f"Applying {feature_type} edits chunk {index} ({len(edits_by_operation['adds'])} adds, {len(edits_by_operation['updates'])} updates, {len(edits_by_operation['deletes'])} deletes)....",
+            run_metrics.measured(
+                f"{feature_type} edits",
+                chunker.timed(
+                    chunk_bytes,
+                    partial(apply_edits, feature_type, **edits_by_operation),
+                ),
+                byte_count=chunk_bytes,
+                feature_count=len(edit_chunk),
+            ),
+        )
+
+
+def make_service_edits_stage(edits_by_layer, chunker):
+    """Group every layer's edits by component and create the service applyEdits requests.
+
+    Each request holds the edits of all four layers for a chunk of components, so a
+    component's representations are written together.
+
+    Args:
+        edits_by_layer (dict): lists of edits from `make_layer_edits` keyed by feature type
+        chunker (AdaptiveChunker): sizes the chunks of components
+
+    Yields:
+        tuple: `(description, request)` to be run by `run_layer_jobs`
+    """
+    components_edits = group_edits_by_component(edits_by_layer)
+    for index, (components_chunk, chunk_bytes) in enumerate(
+        chunker.chunks(components_edits, get_component_edits_size), start=1
+    ):
+        yield (
+            f"Applying service edits chunk {index} ({len(components_chunk)} components, {chunk_bytes} bytes)....",
+            run_metrics.measured(
+                "service edits",
+                chunker.timed(
+                    chunk_bytes,
+                    partial(apply_service_edits, split_service_edits(components_chunk)),
+                ),
+                byte_count=chunk_bytes,
+                feature_count=sum(len(component_edits) for component_edits in components_chunk),
+            ),
+        )
+
+
+def log_edit_counts(feature_type, edits, dry_run):
+    """Log how many features a diff will add, update, and delete in a layer"""
+    edits_by_operation = split_edits(edits)
+    logger.info(
+        f"{'[DRY RUN] Would apply' if dry_run else 'Applying'} {len(edits_by_operation['adds'])} adds, "
+        f"{len(edits_by_operation['updates'])} updates and {len(edits_by_operation['deletes'])} deletes to {feature_type} layer"
+    )
+
+
+def log_chunk_sizes(chunkers):
+    """Log the chunk sizes each chunker chose so the byte budgets can be tuned"""
+    for chunker in chunkers:
+        logger.info(f"Chunk sizes for {chunker.report()}")
+
+
+def shrink_features(all_features, geometry_bytes):
+    """Round and simplify the geometries of every layer and add up the bytes saved.
+
+    Args:
+        all_features (dict): lists of Esri feature objects keyed by feature type
+        geometry_bytes (dict): `[bytes before, bytes after]` totals keyed by feature type,
+            which are updated in place
+    """
+    with run_metrics.timed("simplify") as counts:
+        bytes_by_layer = shrink_all_features(
+            all_features, COORDINATE_DECIMALS, SIMPLIFY_TOLERANCE
+        )
+        counts["byte_count"] = sum(
+            bytes_after for _, bytes_after in bytes_by_layer.values()
+        )
+    for feature_type, (bytes_before, bytes_after) in bytes_by_layer.items():
+        totals = geometry_bytes.setdefault(feature_type, [0, 0])
+        totals[0] += bytes_before
+        totals[1] += bytes_after
+
+
+def log_geometry_savings(geometry_bytes):
+    """Log how many geometry bytes rounding and simplification saved in each layer"""
+    for feature_type, (bytes_before, bytes_after) in geometry_bytes.items():
+        saved_percent = 100 * (bytes_before - bytes_after) / bytes_before if bytes_before else 0
+        logger.info(
+            f"Simplified {feature_type} geometries from {bytes_before} to {bytes_after} bytes ({saved_percent:.1f}% saved)"
+        )
+
+
+def build_all_features(components_data):
+    """Build the features of every layer and record how long it took"""
+    with run_metrics.timed("build") as counts:
+        all_features = make_all_features(components_data)
+        counts["feature_count"] = sum(
+            len(features) for features in all_features.values()
+        )
     return all_features
 
 
-def main(args):
-    logger.info("Getting token...")
-    get_token()
+def read_all_layer_components(where, max_workers):
+    """Read the components already in every layer, several layers at a time.
+
+    Args:
+        where (str): the SQL where clause that selects the features to compare
+        max_workers (int): the maximum number of layers read at once
+
+    Returns:
+        dict: the components from `get_layer_components` keyed by feature type
+    """
+
+    def read_layer_components(feature_type):
+        logger.info(f"Reading {feature_type} features from AGOL...")
+        with run_metrics.timed(f"{feature_type} read") as counts:
+            layer_components = get_layer_components(feature_type, where)
+            counts["feature_count"] = sum(
+                len(component["object_ids"]) for component in layer_components.values()
+            )
+        return layer_components
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(LAYER_IDS, executor.map(read_layer_components, LAYER_IDS)))
+
 
-    # Pass filters to the GraphQL query: none if full replace OR include a date filter for incremental updates
-    variables = (
+def get_query_variables(args):
+    """Pass filters to the GraphQL query: none if full replace OR include a date filter for incremental updates"""
+    return (
         {"project_where": {}, "component_where": {}}
         if args.full
         else {
@@ -168,108 +726,597 @@ def main(args):
         }
     )
 
+
+def stream_all_features(args, token_ready):
+    """Replace features in AGOL while the components are fetched from Hasura a page at a time.
+
+    Every layer's outdated features are deleted first. Then each page of components is
+    built into features and uploaded before moving on, while the next page is fetched in
+    the background, so only about two pages are held in memory at once.
+
+    Args:
+        args (argparse.Namespace): the CLI namespace
+        token_ready (concurrent.futures.Future): the token fetch, which is waited for
+            before the first AGOL request
+    """
+    layer_jobs = {}
+    chunkers = []
+
+    if args.full:
+        component_where = {}
+        for feature_type in ["points", "lines", "combined", "exploded"]:
+            if args.dry_run:
+                logger.info(
+                    f"[DRY RUN] Would delete all existing features from {feature_type} layer"
+                )
+                continue
+            layer_jobs[feature_type] = [
+                [
+                    (
+                        f"Deleting all existing features in {feature_type} layer...",
+                        run_metrics.measured(
+                            f"{feature_type} delete",
+                            partial(delete_all_features, feature_type),
+                        ),
+                    )
+                ]
+            ]
+    else:
+        logger.info(f"Finding projects and components updated since {args.date}...")
+        changes = get_incremental_changes(args.date)
+        component_where = changes["component_where"]
+        for feature_type in ["points", "lines", "combined", "exploded"]:
+            if args.dry_run:
+                logger.info(
+                    f"[DRY RUN] Would delete features from {feature_type} layer for {len(changes['project_ids'])} projects and {len(changes['component_ids'])} components"
+                )
+                continue
+            delete_chunker = make_delete_chunker(feature_type)
+            chunkers.append(delete_chunker)
+            layer_jobs[feature_type] = [
+                make_delete_stage(
+                    feature_type,
+                    changes["project_ids"],
+                    changes["component_ids"],
+                    delete_chunker,
+                )
+            ]
+
+    token_ready.result()
+    target_live_service()
+    run_layer_jobs(
+        layer_jobs,
+        max_workers=args.workers,
+        max_workers_per_layer=args.layer_workers,
+    )
+
+    upload_chunkers = {
+        feature_type: make_upload_chunker(feature_type)
+        for feature_type in ["points", "lines", "combined", "exploded"]
+    }
+    chunkers.extend(upload_chunkers.values())
+    geometry_bytes = {}
+
     logger.info(
-        f"Getting {'all' if args.full else 'recently updated'} component features from all projects..."
+        f"Streaming {'all' if args.full else 'recently updated'} component features in pages of {COMPONENTS_PAGE_SIZE}..."
     )
-    data = make_hasura_request(
-        query=COMPONENTS_QUERY_BY_LAST_UPDATE_DATE,
-        variables=variables,
+    pages = prefetch(
+        iter_component_pages(component_where, COMPONENTS_PAGE_SIZE)
     )
-    components_data = data["component_arcgis_online_view"]
-    projects_data = data["moped_project"]
+    for page_number, components_data in enumerate(pages, start=1):
+        logger.info(f"Processing page {page_number} of {len(components_data)} components...")
+        page_features = build_all_features(components_data)
+        encoder = FeatureEncoder()
+        if args.simplify:
+            shrink_features(page_features, geometry_bytes)
 
-    exploded_data = make_hasura_request(
-        query=EXPLODED_COMPONENTS_QUERY_BY_LAST_UPDATE_DATE,
-        variables={"where": variables["component_where"]},
-    )["exploded_component_arcgis_online_view"]
+        if args.dry_run:
+            for feature_type, features in page_features.items():
+                logger.info(
+                    f"[DRY RUN] Would upload {len(features)} features to {feature_type} layer"
+                )
+            continue
 
-    all_features = make_all_features(components_data, exploded_data)
+        run_layer_jobs(
+            {
+                feature_type: [
+                    make_upload_stage(
+                        feature_type, features, upload_chunkers[feature_type], encoder
+                    )
+                ]
+                for feature_type, features in page_features.items()
+            },
+            max_workers=args.workers,
+            max_workers_per_layer=args.layer_workers,
+        )
 
-    if args.full:
+    log_geometry_savings(geometry_bytes)
+    log_chunk_sizes(chunkers)
+
+
+def get_standby_endpoint():
+    """Find which of the blue and green feature services the view layers are not reading.
+
+    Raises:
+        ValueError: if the view reads from neither feature service
+
+    Returns:
+        tuple: the URLs of the live and the standby feature services
+    """
+    live_name = get_service_name(get_view_source_endpoint())
+    for live_endpoint, standby_endpoint in [
+        (AGOL_BLUE_ENDPOINT, AGOL_GREEN_ENDPOINT),
+        (AGOL_GREEN_ENDPOINT, AGOL_BLUE_ENDPOINT),
+    ]:
+        if get_service_name(live_endpoint) == live_name:
+            return live_endpoint, standby_endpoint
+    raise ValueError(
+        f"The view reads from {live_name}, which is neither the blue nor the green feature service"
+    )
+
+
+def target_live_service():
+    """Point the run at the feature service the view layers read, when blue/green is set up.
+
+    After a blue/green swap, AGOL_COMPONENTS_ENDPOINT may name the standby service, so
+    every other mode has to write to whichever service the view currently reads. Otherwise
+    its edits would be hidden until the next swap, which rebuilds over them.
+    """
+    if not (AGOL_VIEW_ENDPOINT and AGOL_BLUE_ENDPOINT and AGOL_GREEN_ENDPOINT):
+        return
+    live_endpoint, _ = get_standby_endpoint()
+    logger.info(
+        f"Writing to {get_service_name(live_endpoint)}, which the view layers read..."
+    )
+    set_components_endpoint(live_endpoint)
+
+
+def point_view_layers_at(source_endpoint, previous_endpoint):
+    """Point every view layer at a feature service, or back at the previous one if any fails.
+
+    Each view layer is switched with its own updateDefinition request. If one fails, the
+    layers already switched, and the one that failed, are pointed back at the previous
+    service before the error is raised, so the view never reads from both services.
+
+    Args:
+        source_endpoint (str): the URL of the feature service the view should read
+        previous_endpoint (str): the URL of the feature service the view reads now
+
+    Raises:
+        Exception: the error of the request that failed
+    """
+    attempted = []
+    try:
+        for feature_type in LAYER_IDS:
+            logger.info(
+                f"Pointing the {feature_type} view layer at {get_service_name(source_endpoint)}..."
+            )
+            attempted.append(feature_type)
+            with run_metrics.timed(f"{feature_type} view swap"):
+                point_view_at(feature_type, source_endpoint)
+    except Exception:
+        logger.error(
+            f"Pointing the view layers back at {get_service_name(previous_endpoint)}..."
+        )
+        for feature_type in attempted:
+            try:
+                point_view_at(feature_type, previous_endpoint)
+            except Exception as e:
+                logger.error(
+                    f"Failed to point the {feature_type} view layer back at {get_service_name(previous_endpoint)}: {e}"
+                )
+        raise
+
+
+def verify_feature_counts(all_features):
+    """Check that every layer holds exactly the features that were sent to it.
+
+    Args:
+        all_features (dict): lists of the Esri feature objects sent, keyed by feature type
+
+    Raises:
+        ValueError: if a layer's feature count does not match
+    """
+    for feature_type, features in all_features.items():
+        count = count_features(feature_type)
+        if count != len(features):
+            raise ValueError(
+                f"The {feature_type} layer has {count} features but {len(features)} were sent"
+            )
+        logger.info(f"The {feature_type} layer has all {count} features")
+
+
+def main(args):
+    # The token is only needed once the components are fetched and built
+    logger.info("Getting token in the background...")
+    token_ready = fetch_in_background(run_metrics.measured("token", get_token))
+
+    if args.stream:
+        stream_all_features(args, token_ready)
+        return
+
+    journal = None
+
+    if args.resume:
+        logger.info("Resuming the unfinished run from its journal...")
+        journal = RunJournal.load(JOURNAL_DIR)
+        args.full, args.date = journal.full, journal.date
+        all_features = journal.all_features
+        project_ids_for_delete = journal.project_ids
+        component_ids_for_delete = journal.component_ids
+    elif args.full or args.diff:
+        variables = get_query_variables(args)
+
+        logger.info(
+            f"Getting {'all' if args.full else 'recently updated'} component features from all projects..."
+        )
+        data = make_hasura_request(
+            query=COMPONENTS_QUERY_BY_LAST_UPDATE_DATE,
+            variables=variables,
+        )
+        components_data = data["component_arcgis_online_view"]
+        projects_data = data["moped_project"]
+
+        # Get project IDs that have been updated (including soft-deleted projects) for deletes
+        project_ids_for_delete = [project["project_id"] for project in projects_data]
+        component_ids_for_delete = []
+    else:
+        logger.info(f"Finding projects and components updated since {args.date}...")
+        changes = get_incremental_changes(args.date)
+        project_ids_for_delete = changes["project_ids"]
+        component_ids_for_delete = changes["component_ids"]
+
+        logger.info("Getting updated component features...")
+        components_data = make_hasura_request(
+            query=COMPONENTS_QUERY,
+            variables={"where": changes["component_where"]},
+        )["component_arcgis_online_view"]
+
+    if not args.resume:
+        all_features = build_all_features(components_data)
+
+        if args.simplify:
+            geometry_bytes = {}
+            shrink_features(all_features, geometry_bytes)
+            log_geometry_savings(geometry_bytes)
+
+        if not (args.diff or args.bulk or args.blue_green or args.dry_run):
+            journal = RunJournal.start(
+                JOURNAL_DIR,
+                full=args.full,
+                date=args.date,
+                all_features=all_features,
+                project_ids=project_ids_for_delete,
+                component_ids=component_ids_for_delete,
+                discard_unfinished=args.discard_journal,
+            )
+
+    token_ready.result()
+
+    if args.blue_green:
+        live_endpoint, standby_endpoint = get_standby_endpoint()
+        logger.info(
+            f"Rebuilding {get_service_name(standby_endpoint)} while the view reads {get_service_name(live_endpoint)}..."
+        )
+        set_components_endpoint(standby_endpoint)
+    else:
+        target_live_service()
+
+    layer_jobs = {}
+    chunkers = []
+    encoder = FeatureEncoder()
+
+    if args.diff:
+        # Edits of every layer for --service-edits, which are sent together
+        edits_by_layer = {}
+
+        # Compare against every feature in the layer, or only the features of updated projects
+        if args.full:
+            where = "1=1"
+        else:
+            project_ids = ", ".join(str(x) for x in project_ids_for_delete)
+            where = f"project_id IN ({project_ids})" if project_ids else None
+
+        if where is None:
+            logger.info("No updated projects to diff")
+            all_layer_components = {}
+        else:
+            all_layer_components = read_all_layer_components(where, args.workers)
+
+        for feature_type, layer_components in all_layer_components.items():
+            logger.info(f"Diffing {feature_type} features...")
+            edits = make_layer_edits(all_features[feature_type], layer_components)
+            log_edit_counts(feature_type, edits, args.dry_run)
+
+            if args.dry_run or not edits:
+                continue
+
+            if args.service_edits:
+                edits_by_layer[feature_type] = edits
+                continue
+
+            edit_chunker = make_edit_chunker(feature_type)
+            chunkers.append(edit_chunker)
+            layer_jobs[feature_type] = [
+                make_apply_edits_stage(feature_type, edits, edit_chunker)
+            ]
+
+        if edits_by_layer:
+            service_chunker = make_edit_chunker("service")
+            chunkers.append(service_chunker)
+            layer_jobs["service"] = [
+                make_service_edits_stage(edits_by_layer, service_chunker)
+            ]
+    elif args.bulk:
+        for feature_type in ["points", "lines", "combined", "exploded"]:
+            features = all_features[feature_type]
+            if args.dry_run:
+                logger.info(
+                    f"[DRY RUN] Would truncate {feature_type} layer and append {len(features)} features"
+                )
+                continue
+
+            layer_jobs[feature_type] = [
+                [
+                    (
+                        f"Truncating {feature_type} layer...",
+                        run_metrics.measured(
+                            f"{feature_type} delete",
+                            partial(
+                                truncate_layer,
+                                feature_type,
+                                BULK_JOB_POLL_SECONDS,
+                                BULK_JOB_TIMEOUT_SECONDS,
+                            ),
+                        ),
+                    )
+                ]
+            ]
+            if features:
+                layer_jobs[feature_type].append(
+                    make_bulk_load_stage(feature_type, features, encoder)
+                )
+    elif args.full:
         for feature_type in ["points", "lines", "combined", "exploded"]:
             logger.info(f"Processing {feature_type} features...")
             features = all_features[feature_type]
+            upload_chunker = make_upload_chunker(feature_type)
+            chunkers.append(upload_chunker)
 
             if args.dry_run:
                 logger.info(
                     f"[DRY RUN] Would delete all existing features from {feature_type} layer"
                 )
-            else:
-                logger.info("Deleting all existing features...")
-                delete_all_features(feature_type)
-
-            if args.dry_run:
+                upload_chunk_count = sum(
+                    1
+                    for _ in upload_chunker.chunks(
+                        map(encoder.encode_feature, features), get_encoded_size
+                    )
+                )
                 logger.info(
-                    f"[DRY RUN] Would upload {len(features)} features to {feature_type} layer in chunks of {UPLOAD_CHUNK_SIZE}"
+                    f"[DRY RUN] Would upload {len(features)} features to {feature_type} layer in {upload_chunk_count} chunks of about {upload_chunker.get_byte_budget()} bytes"
+                )
+                continue
+
+            layer_jobs[feature_type] = []
+            if not (journal and journal.is_cleared(feature_type)):
+                layer_jobs[feature_type].append(
+                    [
+                        (
+                            f"Deleting all existing features in {feature_type} layer...",
+                            run_metrics.measured(
+                            f"{feature_type} delete",
+                            partial(delete_all_features, feature_type),
+                        ),
+                        )
+                    ]
                 )
             else:
-                logger.info(
-                    f"Uploading {len(features)} features in chunks of {UPLOAD_CHUNK_SIZE}..."
+                layer_jobs[feature_type].append(
+                    make_unacknowledged_delete_stage(feature_type, features, journal)
+                )
+            layer_jobs[feature_type].append(
+                make_upload_stage(
+                    feature_type, features, upload_chunker, encoder, journal
                 )
-                for feature_chunk in chunks(features, UPLOAD_CHUNK_SIZE):
-                    logger.info("Uploading chunk....")
-                    add_features(feature_type, feature_chunk)
+            )
     else:
-        # Get project IDs that have been updated (including soft-deleted projects) for deletes
-        project_ids_for_delete = [project["project_id"] for project in projects_data]
-
         # Delete outdated feature from AGOL and add updated features
         for feature_type in ["points", "lines", "combined", "exploded"]:
             logger.info(f"Processing {feature_type} features...")
             features = all_features[feature_type]
+            delete_chunker = make_delete_chunker(feature_type)
+            upload_chunker = make_upload_chunker(feature_type)
+            chunkers.extend([delete_chunker, upload_chunker])
 
             if args.dry_run:
                 logger.info(
-                    f"[DRY RUN] Would delete features from {feature_type} layer for {len(project_ids_for_delete)} updated projects"
+                    f"[DRY RUN] Would delete features from {feature_type} layer for {len(project_ids_for_delete)} projects and {len(component_ids_for_delete)} components"
                 )
-                for delete_chunk in chunks(project_ids_for_delete, UPLOAD_CHUNK_SIZE):
+                for delete_chunk, _ in delete_chunker.chunks(
+                    project_ids_for_delete, get_id_size
+                ):
                     joined_project_ids = ", ".join(str(x) for x in delete_chunk)
                     logger.info(
                         f"[DRY RUN] Would delete features with project ids: {joined_project_ids}"
                     )
-            else:
-                logger.info(
-                    f"Deleting all existing features in {feature_type} layer for updated projects in chunks of {UPLOAD_CHUNK_SIZE}..."
-                )
-                for delete_chunk in chunks(project_ids_for_delete, UPLOAD_CHUNK_SIZE):
-                    joined_project_ids = ", ".join(str(x) for x in delete_chunk)
+                for delete_chunk, _ in delete_chunker.chunks(
+                    component_ids_for_delete, get_id_size
+                ):
+                    joined_component_ids = ", ".join(str(x) for x in delete_chunk)
                     logger.info(
-                        f"Deleting features with project ids {joined_project_ids}"
+                        f"[DRY RUN] Would delete features with project component ids: {joined_component_ids}"
                     )
-                    delete_features_by_project_ids(feature_type, joined_project_ids)
-
-            if args.dry_run:
+                upload_chunk_count = sum(
+                    1
+                    for _ in upload_chunker.chunks(
+                        map(encoder.encode_feature, features), get_encoded_size
+                    )
+                )
                 logger.info(
-                    f"[DRY RUN] Would upload {len(features)} features to {feature_type} layer in chunks of {UPLOAD_CHUNK_SIZE}"
+                    f"[DRY RUN] Would upload {len(features)} features to {feature_type} layer in {upload_chunk_count} chunks of about {upload_chunker.get_byte_budget()} bytes"
+                )
+                continue
+
+            layer_jobs[feature_type] = []
+            if not (journal and journal.is_cleared(feature_type)):
+                layer_jobs[feature_type].append(
+                    make_delete_stage(
+                        feature_type,
+                        project_ids_for_delete,
+                        component_ids_for_delete,
+                        delete_chunker,
+                    )
                 )
             else:
-                logger.info(
-                    f"Uploading {len(features)} features in chunks of {UPLOAD_CHUNK_SIZE}..."
+                layer_jobs[feature_type].append(
+                    make_unacknowledged_delete_stage(feature_type, features, journal)
                 )
-                for feature_chunk in chunks(features, UPLOAD_CHUNK_SIZE):
-                    logger.info("Uploading chunk....")
-                    add_features(feature_type, feature_chunk)
+            layer_jobs[feature_type].append(
+                make_upload_stage(
+                    feature_type, features, upload_chunker, encoder, journal
+                )
+            )
+
+    if layer_jobs:
+        logger.info(
+            f"Running AGOL requests with up to {args.workers} workers ({args.layer_workers} per layer)..."
+        )
+        try:
+            run_layer_jobs(
+                layer_jobs,
+                max_workers=args.workers,
+                # service edits are a single job, so the per-layer cap does not apply
+                max_workers_per_layer=(
+                    args.workers if args.service_edits else args.layer_workers
+                ),
+            )
+        except Exception:
+            log_chunk_sizes(chunkers)
+            if journal:
+                logger.error(
+                    "The run did not finish. Run again with --resume to continue from the last acknowledged chunk."
+                )
+            raise
+
+    if args.blue_green and not args.dry_run:
+        logger.info("Checking the feature counts of the rebuilt layers...")
+        with run_metrics.timed("verify counts"):
+            verify_feature_counts(all_features)
+        point_view_layers_at(standby_endpoint, live_endpoint)
+
+    if journal:
+        journal.finish()
+
+    log_chunk_sizes(chunkers)
+
+
+def report_metrics(args, succeeded):
+    """Log the run's stage metrics as a JSON summary and send it to the sinks the CLI names.
+
+    Args:
+        args (argparse.Namespace): the CLI namespace
+        succeeded (bool): whether the run finished without an error
+    """
+    summary = run_metrics.summary(
+        succeeded=succeeded,
+        options=vars(args),
+        agol_requests=get_request_stats(),
+    )
+    logger.info(f"Run metrics: {json.dumps(summary)}")
+    if args.metrics:
+        append_summary(args.metrics, summary)
+        logger.info(f"Appended the run metrics to {args.metrics}")
+    if args.statsd:
+        send_to_statsd(args.statsd, summary, METRICS_PREFIX)
+
+
+# Defined here rather than under __main__ so the ETL also logs when it is imported, as
+# reconcile.py and benchmark.py do
+logger = get_logger(name="components-to-agol", level=logging.INFO)
 
 
 if __name__ == "__main__":
     args = get_cli_args()
-    logger = get_logger(name="components-to-agol", level=logging.INFO)
 
-    if args.date and args.full:
+    if args.resume:
+        if (
+            args.date
+            or args.full
+            or args.diff
+            or args.stream
+            or args.bulk
+            or args.blue_green
+            or args.simplify
+            or args.dry_run
+            or args.discard_journal
+        ):
+            raise Exception(
+                "The --resume flag continues the unfinished run with its original options and cannot be combined with -d, -f, --diff, --stream, --bulk, --blue-green, --simplify, -n or --discard-journal."
+            )
+    elif args.date and args.full:
         raise Exception(
             "Please provide either the -d flag with ISO date string with TZ offset or the -f flag and not both."
         )
-
-    if not args.date and not args.full:
+    elif not args.date and not args.full:
         raise Exception(
             "Please provide either the -d flag with optional ISO date string with TZ offset or the -f flag."
         )
 
-    if args.full:
+    if args.resume:
+        logger.info("Starting sync. Resuming the unfinished run...")
+    elif args.full:
         logger.info(f"Starting sync. Replacing all projects' components data...")
     else:
         logger.info(
             f"Starting sync. Finding projects updated since {args.date} and replacing components data..."
         )
 
-    main(args)
+    if args.service_edits and not args.diff:
+        raise Exception(
+            "The --service-edits flag sends the edits found by --diff and must be used with it."
+        )
+
+    if args.bulk and (not args.full or args.diff or args.stream):
+        raise Exception(
+            "The --bulk flag replaces every feature of each layer and must be used with -f, without --diff or --stream."
+        )
+
+    if args.blue_green and (not args.full or args.diff or args.stream):
+        raise Exception(
+            "The --blue-green flag rebuilds every feature of the standby layers and must be used with -f, without --diff or --stream."
+        )
+
+    if args.stream and args.diff:
+        raise Exception(
+            "The --diff flag needs every component at once and cannot be combined with --stream."
+        )
+
+    if args.workers < 1 or args.layer_workers < 1:
+        raise Exception(
+            "Please provide at least one worker for the -w and --layer-workers flags."
+        )
+
+    if args.capture and args.replay:
+        raise Exception(
+            "Please provide either the --capture flag or the --replay flag and not both."
+        )
+
+    if args.capture:
+        start_hasura_capture()
+    elif args.replay:
+        logger.info(f"Replaying Hasura responses from {args.replay}...")
+        start_hasura_replay(args.replay)
+
+    started_at = time.monotonic()
+    succeeded = False
+    try:
+        main(args)
+        succeeded = True
+    finally:
+        log_request_stats()
+        logger.info(f"Sync took {time.monotonic() - started_at:.1f} seconds")
+        if args.capture:
+            save_hasura_capture(args.capture)
+            logger.info(f"Saved the Hasura responses to {args.capture}")
+        report_metrics(args, succeeded)
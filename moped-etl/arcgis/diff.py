@@ -0,0 +1,193 @@
+"""Finds the smallest set of AGOL edits that brings a layer in line with Moped"""
+import hashlib
+import json
+from collections import defaultdict
+
+from settings import CONTENT_HASH_FIELD, OBJECT_ID_FIELD
+from utils import query_features
+
+
+def get_content_hash(features):
+    """Hash the geometry and attributes of a component's features in one layer.
+
+    Args:
+        features (list): the Esri feature objects of a single component
+
+    Returns:
+        str: a hex digest that changes whenever any of the features change
+    """
+    serialized = json.dumps(features, sort_keys=True)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def group_features_by_component(features):
+    """Group Esri features by the component they were created from.
+
+    Args:
+        features (list): Esri feature objects for a single layer
+
+    Returns:
+        dict: lists of features keyed by project_component_id
+    """
+    features_by_component = defaultdict(list)
+    for feature in features:
+        features_by_component[feature["attributes"]["project_component_id"]].append(
+            feature
+        )
+    return features_by_component
+
+
+def get_layer_components(feature_type, where):
+    """Read the object ids and content hashes of the components already in a layer.
+
+    A component whose features do not all share one content hash, such as one uploaded
+    before diff mode existed, gets a hash of None so that it is always rewritten.
+
+    Args:
+        feature_type (str): the layer to read
+        where (str): the SQL where clause that selects the features to compare
+
+    Returns:
+        dict: `{"content_hash": str, "object_ids": list}` keyed by project_component_id
+    """
+    records = query_features(
+        feature_type,
+        where,
+        [OBJECT_ID_FIELD, "project_component_id", CONTENT_HASH_FIELD],
+    )
+    layer_components = {}
+    for record in records:
+        project_component_id = record.get("project_component_id")
+        content_hash = record.get(CONTENT_HASH_FIELD)
+        component = layer_components.setdefault(
+            project_component_id,
+            {"content_hash": content_hash, "object_ids": []},
+        )
+        if component["content_hash"] != content_hash:
+            component["content_hash"] = None
+        component["object_ids"].append(record[OBJECT_ID_FIELD])
+    return layer_components
+
+
+def with_attributes(feature, attributes):
+    """Copy an Esri feature with extra attributes.
+
+    Features share their attributes dict across layers, so they are never edited in place.
+    """
+    return {**feature, "attributes": {**feature["attributes"], **attributes}}
+
+
+def make_layer_edits(features, layer_components):
+    """Compare a layer's features with what is in AGOL and list the edits to apply.
+
+    Components with an unchanged content hash are left alone. A changed component reuses
+    its existing object ids for updates, then adds or deletes the features left over when
+    its feature count changed. Components in AGOL that are no longer in `features` are
+    deleted.
+
+    Args:
+        features (list): the Esri feature objects the layer should contain
+        layer_components (dict): the layer's current components from `get_layer_components`
+
+    Returns:
+        list: `(project_component_id, operation, payload)` tuples where operation is "adds",
+            "updates" or "deletes", and payload is a feature or, for deletes, an object id
+    """
+    edits = []
+    features_by_component = group_features_by_component(features)
+
+    for project_component_id, component_features in features_by_component.items():
+        content_hash = get_content_hash(component_features)
+        existing = layer_components.get(project_component_id)
+        if existing and existing["content_hash"] == content_hash:
+            continue
+
+        new_features = [
+            with_attributes(feature, {CONTENT_HASH_FIELD: content_hash})
+            for feature in component_features
+        ]
+        object_ids = existing["object_ids"] if existing else []
+
+        for object_id, feature in zip(object_ids, new_features):
+            edits.append(
+                (
+                    project_component_id,
+                    "updates",
+                    with_attributes(feature, {OBJECT_ID_FIELD: object_id}),
+                )
+            )
+        for feature in new_features[len(object_ids) :]:
+            edits.append((project_component_id, "adds", feature))
+        for object_id in object_ids[len(new_features) :]:
+            edits.append((project_component_id, "deletes", object_id))
+
+    for project_component_id, existing in layer_components.items():
+        if project_component_id not in features_by_component:
+            for object_id in existing["object_ids"]:
+                edits.append((project_component_id, "deletes", object_id))
+
+    return edits
+
+
+def get_edit_size(edit):
+    """Return the size in bytes an edit adds to an applyEdits payload"""
+    payload = edit[-1]
+    return len(json.dumps(payload)) + 1
+
+
+def split_edits(edits):
+    """Split a list of edits into the adds, updates, and deletes of an applyEdits request.
+
+    Args:
+        edits (list): `(project_component_id, operation, payload)` tuples from
+            `make_layer_edits`
+
+    Returns:
+        dict: lists of payloads keyed by "adds", "updates" and "deletes"
+    """
+    edits_by_operation = {"adds": [], "updates": [], "deletes": []}
+    for _, operation, payload in edits:
+        edits_by_operation[operation].append(payload)
+    return edits_by_operation
+
+
+def group_edits_by_component(edits_by_layer):
+    """Gather the edits of every layer that belong to the same component.
+
+    Args:
+        edits_by_layer (dict): lists of edits from `make_layer_edits` keyed by feature type
+
+    Returns:
+        list: one list per component of `(feature_type, operation, payload)` tuples
+    """
+    edits_by_component = defaultdict(list)
+    for feature_type, edits in edits_by_layer.items():
+        for project_component_id, operation, payload in edits:
+            edits_by_component[project_component_id].append(
+                (feature_type, operation, payload)
+            )
+    return list(edits_by_component.values())
+
+
+def get_component_edits_size(component_edits):
+    """Return the size in bytes a component's edits add to a service applyEdits payload"""
+    return sum(get_edit_size(edit) for edit in component_edits)
+
+
+def split_service_edits(components_edits):
+    """Split the edits of several components into the layer edits of a service applyEdits.
+
+    Args:
+        components_edits (list): lists of edits from `group_edits_by_component`
+
+    Returns:
+        dict: the "adds", "updates" and "deletes" lists of each layer keyed by feature type
+    """
+    edits_by_layer = {}
+    for component_edits in components_edits:
+        for feature_type, operation, payload in component_edits:
+            layer_edits = edits_by_layer.setdefault(
+                feature_type, {"adds": [], "updates": [], "deletes": []}
+            )
+            layer_edits[operation].append(payload)
+    return edits_by_layer
@@ -0,0 +1,124 @@
+"""Shrinks Esri feature geometries before they are uploaded to AGOL"""
+import json
+
+import numpy as np
+
+
+def simplify_path(path, tolerance):
+    """Simplify a path with the Douglas-Peucker algorithm.
+
+    The distance from every vertex of a span to the line between its ends is computed in
+    one array operation, and the span is split at the farthest vertex until no vertex is
+    farther than the tolerance.
+
+    Args:
+        path (np.ndarray): the path's vertices, one row per vertex
+        tolerance (float): the farthest a removed vertex may be from the simplified path,
+            in the units of the coordinates
+
+    Returns:
+        np.ndarray: the vertices that were kept
+    """
+    if len(path) < 3 or tolerance <= 0:
+        return path
+
+    keep = np.zeros(len(path), dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, len(path) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        segment = path[end, :2] - path[start, :2]
+        offsets = path[start + 1 : end, :2] - path[start, :2]
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = (
+                np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+            )
+        farthest = np.argmax(distances)
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.extend([(start, split), (split, end)])
+    return path[keep]
+
+
+def quantize_path(path, decimals):
+    """Round a path's coordinates and drop the vertices that rounding made repeat.
+
+    Args:
+        path (np.ndarray): the path's vertices, one row per vertex
+        decimals (int): the number of decimal places to keep
+
+    Returns:
+        np.ndarray: the rounded vertices
+    """
+    path = np.round(path, decimals)
+    if len(path) < 2:
+        return path
+    changed = np.any(path[1:] != path[:-1], axis=1)
+    if not changed.any():
+        # Keep both ends so that a very short line is still a valid path
+        return path[[0, -1]]
+    return path[np.concatenate(([True], changed))]
+
+
+def shrink_geometry(geometry, decimals, tolerance):
+    """Round and simplify an Esri geometry in place.
+
+    Args:
+        geometry (dict): an Esri geometry with `paths`, `points`, or `x` and `y`
+        decimals (int): the number of decimal places to keep
+        tolerance (float): the line simplification tolerance
+    """
+    if "paths" in geometry:
+        geometry["paths"] = [
+            quantize_path(
+                simplify_path(np.asarray(path, dtype=float), tolerance), decimals
+            ).tolist()
+            for path in geometry["paths"]
+        ]
+    elif "points" in geometry:
+        geometry["points"] = np.round(
+            np.asarray(geometry["points"], dtype=float), decimals
+        ).tolist()
+    else:
+        geometry["x"] = round(geometry["x"], decimals)
+        geometry["y"] = round(geometry["y"], decimals)
+
+
+def shrink_all_features(all_features, decimals, tolerance):
+    """Round and simplify the geometries of every layer's features.
+
+    Layers share some feature and geometry objects, so each geometry is only shrunk once.
+
+    Args:
+        all_features (dict): lists of Esri feature objects keyed by feature type
+        decimals (int): the number of decimal places to keep
+        tolerance (float): the line simplification tolerance
+
+    Returns:
+        dict: `(bytes before, bytes after)` of the geometries keyed by feature type
+    """
+    shrunk_geometries = {}
+    bytes_by_layer = {}
+    for feature_type, features in all_features.items():
+        bytes_before = 0
+        bytes_after = 0
+        for feature in features:
+            geometry = feature["geometry"]
+            if id(geometry) not in shrunk_geometries:
+                original_bytes = len(json.dumps(geometry))
+                shrink_geometry(geometry, decimals, tolerance)
+                shrunk_geometries[id(geometry)] = (
+                    original_bytes,
+                    len(json.dumps(geometry)),
+                )
+            original_bytes, shrunk_bytes = shrunk_geometries[id(geometry)]
+            bytes_before += original_bytes
+            bytes_after += shrunk_bytes
+        bytes_by_layer[feature_type] = (bytes_before, bytes_after)
+    return bytes_by_layer
@@ -0,0 +1,240 @@
+"""Records the progress of a components_to_agol run so that a failed run can be resumed"""
+import json
+import os
+import shutil
+import threading
+
+SNAPSHOT_FILENAME = "snapshot.json"
+EVENTS_FILENAME = "events.jsonl"
+
+
+class RunJournal:
+    """A local journal of the layers that were cleared and the feature ranges AGOL accepted.
+
+    Starting a run saves a snapshot of the features built from Hasura along with the run's
+    mode. Each event is appended to the journal and flushed to disk as soon as AGOL
+    acknowledges it, so a run that dies partway through can pick up where it left off
+    without downloading from Hasura or re-uploading acknowledged features.
+
+    Events are recorded by the upload workers.
+
+    Args:
+        directory (str): the directory holding the journal files
+        snapshot (dict): the run's mode, features, and the project and component ids whose
+            features are deleted
+        events (list): the events already recorded
+    """
+
+    def __init__(self, directory, snapshot, events):
+        self.directory = directory
+        self.full = snapshot["full"]
+        self.date = snapshot["date"]
+        self.all_features = snapshot["all_features"]
+        self.project_ids = snapshot["project_ids"]
+        self.component_ids = snapshot["component_ids"]
+        self.cleared = {
+            event["feature_type"] for event in events if event["event"] == "cleared"
+        }
+        # Acknowledged [start, end) feature ranges keyed by feature type
+        self.acknowledged = {}
+        for event in events:
+            if event["event"] == "chunk":
+                self.acknowledged.setdefault(event["feature_type"], []).append(
+                    (event["start"], event["end"])
+                )
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(
+        cls,
+        directory,
+        *,
+        full,
+        date,
+        all_features,
+        project_ids,
+        component_ids,
+        discard_unfinished=False,
+    ):
+        """Save the snapshot of a new run, refusing to replace the journal of an unfinished one.
+
+        Args:
+            directory (str): the directory to keep the journal files in
+            full (bool): if the run replaces all features
+            date (str): the updated_at date of an incremental run
+            all_features (dict): lists of Esri feature objects keyed by feature type
+            project_ids (list): the ids of the projects whose features are replaced
+            component_ids (list): the ids of the components whose features are replaced
+            discard_unfinished (bool, optional): replace the journal of a run that did not
+                finish. Defaults to False.
+
+        Raises:
+            ValueError: if the directory holds an unfinished run and it is not discarded
+
+        Returns:
+            RunJournal: the journal of the new run
+        """
+        # A finished run deletes its journal, so a snapshot means the last run did not finish
+        if not discard_unfinished and os.path.exists(
+            os.path.join(directory, SNAPSHOT_FILENAME)
+        ):
+            raise ValueError(
+                f"{directory} holds a run that did not finish. Continue it with --resume or start over with --discard-journal."
+            )
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        snapshot = {
+            "full": full,
+            "date": date,
+            "all_features": all_features,
+            "project_ids": project_ids,
+            "component_ids": component_ids,
+        }
+        with open(os.path.join(directory, SNAPSHOT_FILENAME), "w") as fout:
+            json.dump(snapshot, fout)
+        return cls(directory, snapshot, [])
+
+    @classmethod
+    def load(cls, directory):
+        """Load the journal of a run that did not finish.
+
+        Args:
+            directory (str): the directory holding the journal files
+
+        Raises:
+            ValueError: if there is no journal to resume
+
+        Returns:
+            RunJournal: the journal of the unfinished run
+        """
+        try:
+            with open(os.path.join(directory, SNAPSHOT_FILENAME)) as fin:
+                snapshot = json.load(fin)
+        except FileNotFoundError:
+            raise ValueError(f"No unfinished run to resume in {directory}")
+
+        events = []
+        events_path = os.path.join(directory, EVENTS_FILENAME)
+        if os.path.exists(events_path):
+            with open(events_path) as fin:
+                for line in fin:
+                    try:
+                        events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # The run died while writing its last event, which was never confirmed
+                        break
+        return cls(directory, snapshot, events)
+
+    def is_cleared(self, feature_type):
+        """Return True if the layer's outdated features were already deleted"""
+        with self._lock:
+            return feature_type in self.cleared
+
+    def record_cleared(self, feature_type):
+        """Record that all of the layer's outdated features were deleted"""
+        with self._lock:
+            if feature_type in self.cleared:
+                return
+            self.cleared.add(feature_type)
+            self._append({"event": "cleared", "feature_type": feature_type})
+
+    def record_chunk(self, feature_type, start, end):
+        """Record that AGOL accepted the layer's features from index start up to end"""
+        with self._lock:
+            self.acknowledged.setdefault(feature_type, []).append((start, end))
+            self._append(
+                {"event": "chunk", "feature_type": feature_type, "start": start, "end": end}
+            )
+
+    def recorded(self, feature_type, start, end, request):
+        """Wrap an upload request so that its feature range is recorded once it succeeds.
+
+        Args:
+            feature_type (str): the layer the features are uploaded to
+            start (int): the index of the first feature in the request
+            end (int): the index after the last feature in the request
+            request (function): the request to run, which takes no arguments
+
+        Returns:
+            function: runs the request and records its feature range
+        """
+
+        def run_recorded_request():
+            result = request()
+            self.record_chunk(feature_type, start, end)
+            return result
+
+        return run_recorded_request
+
+    def get_pending_ranges(self, feature_type, features):
+        """Return the [start, end) ranges of the layer's features that were not acknowledged.
+
+        A chunk AGOL committed without its response reaching us, or one that partly failed,
+        is not acknowledged even though some of its features are in the layer. The ranges
+        are widened to whole components, so that every feature of a component with pending
+        features can be deleted by `get_pending_component_ids` and sent again.
+
+        Args:
+            feature_type (str): the layer to check
+            features (list): the Esri feature objects in the layer's snapshot, where the
+                features of a component are next to each other
+
+        Returns:
+            list: `(start, end)` tuples in order
+        """
+        with self._lock:
+            acknowledged = sorted(self.acknowledged.get(feature_type, []))
+        pending = []
+        position = 0
+        for start, end in acknowledged:
+            if start > position:
+                pending.append((position, start))
+            position = max(position, end)
+        if position < len(features):
+            pending.append((position, len(features)))
+
+        def get_component_id(index):
+            return features[index]["attributes"]["project_component_id"]
+
+        widened = []
+        for start, end in pending:
+            while start > 0 and get_component_id(start - 1) == get_component_id(start):
+                start -= 1
+            while end < len(features) and get_component_id(end) == get_component_id(
+                end - 1
+            ):
+                end += 1
+            if widened and start <= widened[-1][1]:
+                widened[-1] = (widened[-1][0], max(widened[-1][1], end))
+            else:
+                widened.append((start, end))
+        return widened
+
+    def get_pending_component_ids(self, feature_type, features):
+        """Return the ids of the components with features in the layer's pending ranges.
+
+        Args:
+            feature_type (str): the layer to check
+            features (list): the Esri feature objects in the layer's snapshot
+
+        Returns:
+            list: project component ids in snapshot order
+        """
+        return list(
+            dict.fromkeys(
+                features[index]["attributes"]["project_component_id"]
+                for start, end in self.get_pending_ranges(feature_type, features)
+                for index in range(start, end)
+            )
+        )
+
+    def finish(self):
+        """Delete the journal once every request of the run has succeeded"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _append(self, event):
+        """Write an event and make sure it reaches the disk before moving on"""
+        with open(os.path.join(self.directory, EVENTS_FILENAME), "a") as fout:
+            fout.write(json.dumps(event) + "\n")
+            fout.flush()
+            os.fsync(fout.fileno())
@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+"""A local stand-in for the AGOL feature service so components_to_agol can run offline"""
+# docker compose run --service-ports local-agol --latency 0.5 --failure-rate 0.05;
+import argparse
+import email.parser
+import email.policy
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from process.logging import get_logger
+from settings import OBJECT_ID_FIELD
+
+TOKEN_PATH = re.compile(r"/sharing/rest/generateToken$")
+LAYER_PATH = re.compile(
+    r"/services/(?P<service>[^/]+)/FeatureServer/(?P<layer_id>\d+)/(?P<method>addFeatures|deleteFeatures|applyEdits|query|truncate|append|updateDefinition)$"
+)
+SERVICE_PATH = re.compile(
+    r"/services/(?P<service>[^/]+)/FeatureServer/(?P<method>applyEdits|sources)$"
+)
+UPLOAD_PATH = re.compile(r"/FeatureServer/uploads/upload$")
+UPLOAD_DELETE_PATH = re.compile(r"/FeatureServer/uploads/(?P<upload_id>\w+)/delete$")
+JOB_PATH = re.compile(r"/jobs/(?P<job_id>\w+)$")
+# The only where clauses components_to_agol sends besides 1=1
+IN_CLAUSE = re.compile(r"^(?P<field>\w+) IN \((?P<values>[^)]*)\)$")
+
+
+class FeatureStore:
+    """The features of every layer, kept in memory and keyed by object id
+
+    Layers are keyed by `(service name, layer id)` so that several feature services can be
+    served at once.
+    """
+
+    def __init__(self):
+        self.layers = {}
+        self.next_object_id = 1
+        self.lock = threading.Lock()
+
+    def add(self, layer_id, features):
+        """Store new features and return their addResults"""
+        results = []
+        with self.lock:
+            layer = self.layers.setdefault(layer_id, {})
+            for feature in features:
+                object_id = self.next_object_id
+                self.next_object_id += 1
+                layer[object_id] = {
+                    **feature,
+                    "attributes": {**feature["attributes"], OBJECT_ID_FIELD: object_id},
+                }
+                results.append({"objectId": object_id, "success": True})
+        return results
+
+    def update(self, layer_id, features):
+        """Replace stored features and return their updateResults"""
+        results = []
+        with self.lock:
+            layer = self.layers.setdefault(layer_id, {})
+            for feature in features:
+                object_id = feature["attributes"][OBJECT_ID_FIELD]
+                if object_id not in layer:
+                    results.append(
+                        {
+                            "objectId": object_id,
+                            "success": False,
+                            "error": {"code": 1019, "description": "Object is missing."},
+                        }
+                    )
+                    continue
+                layer[object_id] = feature
+                results.append({"objectId": object_id, "success": True})
+        return results
+
+    def delete(self, layer_id, object_ids):
+        """Remove stored features and return their deleteResults"""
+        results = []
+        with self.lock:
+            layer = self.layers.setdefault(layer_id, {})
+            for object_id in object_ids:
+                success = layer.pop(object_id, None) is not None
+                results.append({"objectId": object_id, "success": success})
+        return results
+
+    def select(self, layer_id, where):
+        """Return the object ids of a layer's features that match a where clause
+
+        Raises:
+            ValueError: if the where clause is not one the stand-in understands
+        """
+        with self.lock:
+            layer = dict(self.layers.get(layer_id, {}))
+        if where.strip() == "1=1":
+            return sorted(layer)
+        match = IN_CLAUSE.match(where.strip())
+        if not match:
+            raise ValueError(f"Unsupported where clause: {where}")
+        values = {value.strip() for value in match["values"].split(",")}
+        return sorted(
+            object_id
+            for object_id, feature in layer.items()
+            if str(feature["attributes"].get(match["field"])) in values
+        )
+
+    def get_attributes(self, layer_id, object_ids, out_fields):
+        """Return the requested attributes of stored features"""
+        with self.lock:
+            layer = self.layers.get(layer_id, {})
+            return [
+                {
+                    field: layer[object_id]["attributes"].get(field)
+                    for field in out_fields
+                }
+                for object_id in object_ids
+                if object_id in layer
+            ]
+
+    def count(self):
+        """Return the number of stored features in each layer"""
+        with self.lock:
+            return {layer_id: len(layer) for layer_id, layer in self.layers.items()}
+
+
+def parse_multipart(content_type, body):
+    """Read the fields and files of a multipart form upload
+
+    Returns:
+        dict: field values as text and file contents as bytes, keyed by field name
+    """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+    )
+    data = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True)
+        data[name] = payload if part.get_filename() else payload.decode("utf-8")
+    return data
+
+
+def get_esri_feature(geojson_feature):
+    """Convert a GeoJSON feature to the Esri feature the stand-in stores"""
+    geometry = geojson_feature["geometry"]
+    if geometry["type"] == "MultiLineString":
+        esri_geometry = {"paths": geometry["coordinates"]}
+    elif geometry["type"] == "MultiPoint":
+        esri_geometry = {"points": geometry["coordinates"]}
+    else:
+        x, y = geometry["coordinates"]
+        esri_geometry = {"x": x, "y": y}
+    return {"attributes": geojson_feature["properties"], "geometry": esri_geometry}
+
+
+def parse_object_ids(object_ids):
+    """Read the object ids of a delete, which may be a JSON list or a comma-separated string"""
+    if isinstance(object_ids, str):
+        return [int(object_id) for object_id in object_ids.split(",") if object_id]
+    return [int(object_id) for object_id in object_ids]
+
+
+class LocalAgolHandler(BaseHTTPRequestHandler):
+    """Answers the AGOL REST requests components_to_agol makes"""
+
+    # Set by `make_server`
+    options = None
+    store = None
+    tokens = None
+    uploads = None
+    # The source service name of each view service that was pointed at one
+    view_sources = None
+    stats = None
+    stats_lock = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            data = parse_multipart(content_type, body)
+        else:
+            data = {
+                key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()
+            }
+        self.count("requests")
+
+        if TOKEN_PATH.search(self.path):
+            return self.send_json(self.generate_token())
+
+        layer_match = LAYER_PATH.search(self.path)
+        service_match = SERVICE_PATH.search(self.path)
+        upload_match = UPLOAD_PATH.search(self.path)
+        upload_delete_match = UPLOAD_DELETE_PATH.search(self.path)
+        job_match = JOB_PATH.search(self.path)
+        if not any(
+            [layer_match, service_match, upload_match, upload_delete_match, job_match]
+        ):
+            return self.send_json({"error": {"code": 404, "message": "Not found"}}, 404)
+
+        self.simulate_latency(len(body))
+
+        failure = self.pick_failure(data)
+        if failure:
+            self.count(failure[0])
+            return self.send_json(*failure[1:])
+
+        if job_match:
+            # Jobs run synchronously in the stand-in, so they are done by the first check
+            return self.send_json({"status": "Completed"})
+        if upload_match:
+            self.count("upload")
+            return self.send_json(self.upload(data))
+        if upload_delete_match:
+            self.count("upload_delete")
+            with self.stats_lock:
+                self.uploads.pop(upload_delete_match["upload_id"], None)
+            return self.send_json({"success": True})
+
+        try:
+            if service_match and service_match["method"] == "sources":
+                response_data = self.sources(service_match["service"])
+            elif service_match:
+                response_data = self.apply_service_edits(
+                    self.get_source(service_match["service"]), data
+                )
+            elif layer_match["method"] == "updateDefinition":
+                response_data = self.update_definition(layer_match["service"], data)
+            else:
+                response_data = getattr(self, layer_match["method"].lower())(
+                    (
+                        self.get_source(layer_match["service"]),
+                        int(layer_match["layer_id"]),
+                    ),
+                    data,
+                )
+        except (ValueError, KeyError) as e:
+            return self.send_json({"error": {"code": 400, "message": str(e)}}, 400)
+        self.count(service_match["method"] if service_match else layer_match["method"])
+        return self.send_json(response_data)
+
+    def generate_token(self):
+        token = uuid.uuid4().hex
+        with self.stats_lock:
+            self.tokens[token] = time.monotonic() + self.options.token_lifetime
+        self.count("tokens")
+        return {"token": token, "expires": int(time.time() + self.options.token_lifetime) * 1000}
+
+    def simulate_latency(self, payload_bytes):
+        seconds = self.options.latency + self.options.latency_per_mb * payload_bytes / 1e6
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def pick_failure(self, data):
+        """Decide if a request fails, returning its stat name, response body, and status"""
+        token = data.get("token")
+        with self.stats_lock:
+            expires_at = self.tokens.get(token)
+        if not token:
+            return ("token_required", {"error": {"code": 499, "message": "Token Required"}}, 200)
+        if expires_at is None or expires_at < time.monotonic():
+            return ("invalid_token", {"error": {"code": 498, "message": "Invalid Token"}}, 200)
+        if random.random() < self.options.token_error_rate:
+            return ("token_required", {"error": {"code": 499, "message": "Token Required"}}, 200)
+        if random.random() < self.options.throttle_rate:
+            return (
+                "throttled",
+                {"error": {"code": 429, "message": "Too Many Requests"}},
+                429,
+                {"Retry-After": str(self.options.retry_after)},
+            )
+        if random.random() < self.options.failure_rate:
+            return ("failed", {"error": {"code": 503, "message": "Service Unavailable"}}, 503)
+        if random.random() < self.options.error_body_rate:
+            return (
+                "error_body",
+                {"error": {"code": 500, "message": "Unable to complete operation."}},
+                200,
+            )
+        return None
+
+    def addfeatures(self, layer_id, data):
+        return {"addResults": self.store.add(layer_id, json.loads(data["features"]))}
+
+    def deletefeatures(self, layer_id, data):
+        object_ids = self.store.select(layer_id, data["where"])
+        results = self.store.delete(layer_id, object_ids)
+        if data.get("returnDeleteResults", "true").lower() == "false":
+            return {"success": True}
+        return {"deleteResults": results}
+
+    def applyedits(self, layer_id, data):
+        return self.apply_layer_edits(
+            layer_id,
+            json.loads(data.get("adds", "[]")),
+            json.loads(data.get("updates", "[]")),
+            parse_object_ids(json.loads(data.get("deletes", "[]"))),
+        )
+
+    def apply_layer_edits(self, layer_id, adds, updates, deletes):
+        return {
+            "addResults": self.store.add(layer_id, adds),
+            "updateResults": self.store.update(layer_id, updates),
+            "deleteResults": self.store.delete(layer_id, deletes),
+        }
+
+    def apply_service_edits(self, service, data):
+        return [
+            {
+                "id": layer_edits["id"],
+                **self.apply_layer_edits(
+                    (service, layer_edits["id"]),
+                    layer_edits.get("adds", []),
+                    layer_edits.get("updates", []),
+                    parse_object_ids(layer_edits.get("deletes", [])),
+                ),
+            }
+            for layer_edits in json.loads(data["edits"])
+        ]
+
+    def upload(self, data):
+        upload_id = uuid.uuid4().hex
+        with self.stats_lock:
+            self.uploads[upload_id] = data["file"]
+        return {"success": True, "item": {"itemID": upload_id}}
+
+    def truncate(self, layer_id, data):
+        self.store.delete(layer_id, self.store.select(layer_id, "1=1"))
+        return self.get_job_response("statusURL")
+
+    def append(self, layer_id, data):
+        if data.get("appendUploadFormat") != "geojson":
+            raise ValueError("The stand-in only appends GeoJSON uploads")
+        with self.stats_lock:
+            upload = self.uploads[data["appendUploadId"]]
+        features = json.loads(upload)["features"]
+        self.store.add(layer_id, [get_esri_feature(feature) for feature in features])
+        return self.get_job_response("statusUrl")
+
+    def get_job_response(self, status_url_key):
+        """Answer a finished asynchronous job, under the status URL key AGOL uses for it"""
+        job_id = uuid.uuid4().hex
+        return {status_url_key: f"http://{self.headers['Host']}/jobs/{job_id}"}
+
+    def get_source(self, service):
+        """Return the service whose features a service reads, which differs for views"""
+        with self.stats_lock:
+            return self.view_sources.get(service, service)
+
+    def sources(self, service):
+        source = self.get_source(service)
+        return {
+            "services": [
+                {
+                    "name": source,
+                    "url": f"http://{self.headers['Host']}/arcgis/rest/services/{source}/FeatureServer",
+                }
+            ]
+        }
+
+    def update_definition(self, service, data):
+        definition = json.loads(data["updateDefinition"])
+        view_definition = definition["adminLayerInfo"]["viewLayerDefinition"]
+        with self.stats_lock:
+            self.view_sources[service] = view_definition["sourceServiceName"]
+        return {"success": True}
+
+    def query(self, layer_id, data):
+        object_ids = self.store.select(layer_id, data["where"])
+        if data.get("returnCountOnly", "false").lower() == "true":
+            return {"count": len(object_ids)}
+        if data.get("outStatistics"):
+            return self.query_statistics(layer_id, object_ids, data)
+        offset = int(data.get("resultOffset", 0))
+        count = int(data.get("resultRecordCount", len(object_ids)))
+        page = object_ids[offset : offset + count]
+        out_fields = data.get("outFields", OBJECT_ID_FIELD).split(",")
+        return {
+            "objectIdFieldName": OBJECT_ID_FIELD,
+            "features": [
+                {"attributes": attributes}
+                for attributes in self.store.get_attributes(layer_id, page, out_fields)
+            ],
+            "exceededTransferLimit": offset + count < len(object_ids),
+        }
+
+    def query_statistics(self, layer_id, object_ids, data):
+        """Answer a statistics query, supporting the count and max statistics"""
+        group_by_field = data["groupByFieldsForStatistics"]
+        out_statistics = json.loads(data["outStatistics"])
+        fields = [group_by_field] + [
+            statistic["onStatisticField"] for statistic in out_statistics
+        ]
+        groups = {}
+        for attributes in self.store.get_attributes(layer_id, object_ids, fields):
+            groups.setdefault(attributes[group_by_field], []).append(attributes)
+        records = []
+        for group_value in sorted(groups):
+            record = {group_by_field: group_value}
+            for statistic in out_statistics:
+                values = [
+                    attributes[statistic["onStatisticField"]]
+                    for attributes in groups[group_value]
+                    if attributes[statistic["onStatisticField"]] is not None
+                ]
+                if statistic["statisticType"] == "count":
+                    value = len(values)
+                elif statistic["statisticType"] == "max":
+                    value = max(values, default=None)
+                else:
+                    raise ValueError(
+                        f"Unsupported statistic type: {statistic['statisticType']}"
+                    )
+                record[statistic["outStatisticFieldName"]] = value
+            records.append(record)
+        offset = int(data.get("resultOffset", 0))
+        count = int(data.get("resultRecordCount", len(records)))
+        return {
+            "features": [
+                {"attributes": record} for record in records[offset : offset + count]
+            ],
+            "exceededTransferLimit": offset + count < len(records),
+        }
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def send_json(self, response_data, status=200, headers=None):
+        body = json.dumps(response_data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(options):
+    """Create the stand-in server with an empty feature store
+
+    Args:
+        options (argparse.Namespace): the latency and failure options from `get_cli_args`
+
+    Returns:
+        ThreadingHTTPServer: the server, which answers each request on its own thread
+    """
+    handler = type(
+        "ConfiguredLocalAgolHandler",
+        (LocalAgolHandler,),
+        {
+            "options": options,
+            "store": FeatureStore(),
+            "tokens": {},
+            "uploads": {},
+            "view_sources": dict(view.split("=", 1) for view in options.view),
+            "stats": Counter(),
+            "stats_lock": threading.Lock(),
+        },
+    )
+    return ThreadingHTTPServer((options.host, options.port), handler)
+
+
+def get_cli_args():
+    """Create the CLI and parse args
+
+    Returns:
+        argparse.Namespace: The CLI namespace
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        help="Seconds added to every feature service response. Defaults to 0.2.",
+    )
+    parser.add_argument(
+        "--latency-per-mb",
+        type=float,
+        default=1.0,
+        help="Seconds added to a response for each megabyte of request payload. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests answered with HTTP 503.",
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests answered with HTTP 429 and a Retry-After header.",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=1,
+        help="Seconds sent in the Retry-After header of throttled responses. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--token-error-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests answered with a 499 Token Required error in a 200 response.",
+    )
+    parser.add_argument(
+        "--error-body-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests answered with an error in a 200 response.",
+    )
+    parser.add_argument(
+        "--token-lifetime",
+        type=float,
+        default=3600,
+        help="Seconds before a token expires and requests get a 498 Invalid Token error. Defaults to 3600.",
+    )
+    parser.add_argument(
+        "--view",
+        action="append",
+        default=[],
+        metavar="VIEW=SOURCE",
+        help="Serve a view service that reads from a source service until its layers are pointed elsewhere with updateDefinition. Can be repeated.",
+    )
+    return parser.parse_args()
+
+
+# Defined here rather than under __main__ so the handlers also log when the stand-in is
+# imported, as benchmark.py does
+logger = get_logger(name="local-agol", level=logging.INFO)
+
+
+if __name__ == "__main__":
+    args = get_cli_args()
+    server = make_server(args)
+    logger.info(f"Serving a local AGOL stand-in on http://{args.host}:{args.port}...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Request counts: {dict(server.RequestHandlerClass.stats)}")
+        logger.info(f"Features per layer: {server.RequestHandlerClass.store.count()}")
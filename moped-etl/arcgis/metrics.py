@@ -0,0 +1,145 @@
+"""Measures the time, bytes and features of each stage of a run and reports them"""
+import json
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class RunMetrics:
+    """Totals the time, payload bytes and features of each stage of a run.
+
+    A stage is named after what it does, such as "token", "fetch GetProjectsComponents",
+    "build" or "points upload". Every call recorded under a stage adds to its totals, so
+    a layer's upload stage adds up all of its chunk requests. Calls are recorded from the
+    upload workers, so a stage's seconds can add up to more than the run's wall time.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.monotonic()
+        # {"calls": int, "seconds": float, "bytes": int, "features": int} keyed by stage
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, byte_count=0, feature_count=0):
+        """Record one call of a stage.
+
+        Args:
+            stage (str): the name of the stage
+            seconds (float): how long the call took
+            byte_count (int, optional): the bytes the call sent or received. Defaults to 0.
+            feature_count (int, optional): the features, or Hasura records, the call
+                handled. Defaults to 0.
+        """
+        with self._lock:
+            totals = self.stages.setdefault(
+                stage, {"calls": 0, "seconds": 0.0, "bytes": 0, "features": 0}
+            )
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["bytes"] += byte_count
+            totals["features"] += feature_count
+
+    @contextmanager
+    def timed(self, stage):
+        """Time a block of code as one call of a stage, even if it raises.
+
+        Args:
+            stage (str): the name of the stage
+
+        Yields:
+            dict: the `byte_count` and `feature_count` of the call, which the block can set
+        """
+        counts = {"byte_count": 0, "feature_count": 0}
+        start = time.monotonic()
+        try:
+            yield counts
+        finally:
+            self.add(stage, time.monotonic() - start, **counts)
+
+    def measured(self, stage, request, byte_count=0, feature_count=0):
+        """Wrap a request so that each time it runs it is recorded as one call of a stage.
+
+        Args:
+            stage (str): the name of the stage
+            request (function): the request to run, which takes no arguments
+            byte_count (int, optional): the payload size of the request. Defaults to 0.
+            feature_count (int, optional): the features in the request. Defaults to 0.
+
+        Returns:
+            function: runs the request and records it
+        """
+
+        def run_measured_request():
+            with self.timed(stage) as counts:
+                counts.update(byte_count=byte_count, feature_count=feature_count)
+                return request()
+
+        return run_measured_request
+
+    def summary(self, **fields):
+        """Build the JSON-serializable summary of the run so far.
+
+        Args:
+            **fields: extra top-level fields, such as the run's options
+
+        Returns:
+            dict: the start time, total seconds, extra fields and the totals of each stage
+        """
+        with self._lock:
+            stages = {
+                stage: {**totals, "seconds": round(totals["seconds"], 3)}
+                for stage, totals in self.stages.items()
+            }
+        return {
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(time.monotonic() - self._started, 3),
+            **fields,
+            "stages": stages,
+        }
+
+
+def append_summary(path, summary):
+    """Append a run summary to a JSON Lines file, one line per run, so runs can be compared"""
+    with open(path, "a") as fout:
+        fout.write(json.dumps(summary) + "\n")
+
+
+def get_metric_name(prefix, stage):
+    """Turn a stage name into a dotted StatsD metric name, like `moped_agol.points_upload`"""
+    return f"{prefix}.{re.sub(r'[^A-Za-z0-9_]+', '_', stage).strip('_')}"
+
+
+def send_to_statsd(address, summary, prefix):
+    """Send a run summary to a StatsD agent, such as a local Telegraf or statsd_exporter.
+
+    Each stage is sent as a timer of its seconds and gauges of its bytes and features, and
+    the run as a timer of its total seconds. StatsD is UDP, so sending never slows or fails
+    the run when nothing is listening.
+
+    Args:
+        address (str): the `host:port` of the StatsD agent
+        summary (dict): a summary from `RunMetrics.summary`
+        prefix (str): the namespace of the metric names
+    """
+    host, port = address.rsplit(":", 1)
+    lines = [f"{prefix}.run.seconds:{summary['seconds'] * 1000:.0f}|ms"]
+    for stage, totals in summary["stages"].items():
+        name = get_metric_name(prefix, stage)
+        lines.extend(
+            [
+                f"{name}.seconds:{totals['seconds'] * 1000:.0f}|ms",
+                f"{name}.bytes:{totals['bytes']}|g",
+                f"{name}.features:{totals['features']}|g",
+            ]
+        )
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for line in lines:
+            sock.sendto(line.encode("utf-8"), (host, int(port)))
+
+
+# The metrics of the running script, shared by the modules that take part in a run
+run_metrics = RunMetrics()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""Finds the projects whose AGOL features have drifted from Moped and optionally repairs them"""
+# docker compose run --entrypoint "python /app/reconcile.py" arcgis;
+import argparse
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from components_to_agol import (
+    make_all_features,
+    make_delete_chunker,
+    make_delete_stage,
+    make_upload_chunker,
+    make_upload_stage,
+    target_live_service,
+)
+from encoding import FeatureEncoder
+from process.logging import get_logger
+from settings import (
+    COMPONENTS_QUERY,
+    LAYER_IDS,
+    RECONCILE_COMPONENTS_QUERY,
+    RECONCILE_DATE_TOLERANCE_SECONDS,
+)
+from upload import run_layer_jobs
+from utils import (
+    get_token,
+    log_request_stats,
+    make_hasura_request,
+    query_statistics,
+)
+
+# The AGOL statistics requested for each project
+PROJECT_STATISTICS = [
+    {
+        "statisticType": "count",
+        "onStatisticField": "project_component_id",
+        "outStatisticFieldName": "feature_count",
+    },
+    {
+        "statisticType": "max",
+        "onStatisticField": "project_updated_at",
+        "outStatisticFieldName": "max_project_updated_at",
+    },
+]
+
+
+def to_epoch_seconds(value):
+    """Read a date from AGOL (epoch milliseconds or text) or Hasura (ISO text) as epoch seconds"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value / 1000
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def get_agol_aggregates():
+    """Read the feature count and latest project_updated_at of each project in every layer
+
+    Returns:
+        dict: `{project_id: (feature count, max updated_at in epoch seconds)}` keyed by
+            feature type
+    """
+    aggregates = {}
+    for feature_type in LAYER_IDS:
+        logger.info(f"Reading {feature_type} project statistics from AGOL...")
+        aggregates[feature_type] = {
+            record["project_id"]: (
+                record["feature_count"],
+                to_epoch_seconds(record["max_project_updated_at"]),
+            )
+            for record in query_statistics(feature_type, "project_id", PROJECT_STATISTICS)
+        }
+    return aggregates
+
+
+def get_moped_aggregates():
+    """Work out the same aggregates from Moped by building the features each layer should hold
+
+    Only the ids, project_updated_at and geometries are fetched, and features are built with
+    the same rules as an upload, so the counts match what components_to_agol would send.
+
+    Returns:
+        dict: `{project_id: (feature count, max updated_at in epoch seconds)}` keyed by
+            feature type
+    """
+    logger.info("Reading components from Hasura...")
+    components = make_hasura_request(query=RECONCILE_COMPONENTS_QUERY)[
+        "component_arcgis_online_view"
+    ]
+    all_features = make_all_features(
+        components,
+        layer_fields={feature_type: ["project_updated_at"] for feature_type in LAYER_IDS},
+    )
+    aggregates = {}
+    for feature_type, features in all_features.items():
+        counts = defaultdict(int)
+        updated_at = {}
+        for feature in features:
+            project_id = feature["attributes"]["project_id"]
+            counts[project_id] += 1
+            feature_updated_at = to_epoch_seconds(
+                feature["attributes"]["project_updated_at"]
+            )
+            if feature_updated_at is not None:
+                updated_at[project_id] = max(
+                    updated_at.get(project_id, feature_updated_at), feature_updated_at
+                )
+        aggregates[feature_type] = {
+            project_id: (count, updated_at.get(project_id))
+            for project_id, count in counts.items()
+        }
+    return aggregates
+
+
+def get_latest_updated_at(aggregates, project_id):
+    """Return a project's latest project_updated_at across every layer, or None"""
+    dates = [
+        layer[project_id][1]
+        for layer in aggregates.values()
+        if project_id in layer and layer[project_id][1] is not None
+    ]
+    return max(dates, default=None)
+
+
+def is_count_drifted(agol_aggregate, moped_aggregate):
+    """Return True if a project's feature counts in one layer disagree"""
+    if agol_aggregate is None or moped_aggregate is None:
+        return True
+    return agol_aggregate[0] != moped_aggregate[0]
+
+
+def is_date_drifted(agol_updated_at, moped_updated_at):
+    """Return True if a project's latest project_updated_at across all layers disagrees
+
+    Incremental runs that replace single components only write the new project_updated_at
+    to the replaced components' features, so a layer without any of them keeps the older
+    value. The date is therefore compared once per project rather than per layer.
+    """
+    if agol_updated_at is None or moped_updated_at is None:
+        return agol_updated_at != moped_updated_at
+    return abs(agol_updated_at - moped_updated_at) > RECONCILE_DATE_TOLERANCE_SECONDS
+
+
+def format_updated_at(updated_at):
+    """Describe a project_updated_at for the drift report"""
+    if updated_at is None:
+        return "never"
+    return datetime.fromtimestamp(updated_at).astimezone().isoformat()
+
+
+def format_aggregate(aggregate):
+    """Describe a project's aggregates in one layer for the drift report"""
+    if aggregate is None:
+        return "no features"
+    count, updated_at = aggregate
+    return f"{count} features updated {format_updated_at(updated_at)}"
+
+
+def find_drifted_projects(agol_aggregates, moped_aggregates):
+    """Compare every project's feature counts in every layer and its latest
+    project_updated_at, and log the ones that disagree
+
+    Returns:
+        list: the sorted ids of the drifted projects
+    """
+    drifted_project_ids = set()
+    for feature_type in LAYER_IDS:
+        agol_layer = agol_aggregates[feature_type]
+        moped_layer = moped_aggregates[feature_type]
+        for project_id in sorted(set(agol_layer) | set(moped_layer)):
+            agol_aggregate = agol_layer.get(project_id)
+            moped_aggregate = moped_layer.get(project_id)
+            if is_count_drifted(agol_aggregate, moped_aggregate):
+                drifted_project_ids.add(project_id)
+                logger.info(
+                    f"Project {project_id} {feature_type}: AGOL has {format_aggregate(agol_aggregate)}, Moped has {format_aggregate(moped_aggregate)}"
+                )
+
+    project_ids = set().union(
+        *(layer.keys() for layer in agol_aggregates.values()),
+        *(layer.keys() for layer in moped_aggregates.values()),
+    )
+    for project_id in sorted(project_ids):
+        agol_updated_at = get_latest_updated_at(agol_aggregates, project_id)
+        moped_updated_at = get_latest_updated_at(moped_aggregates, project_id)
+        if is_date_drifted(agol_updated_at, moped_updated_at):
+            drifted_project_ids.add(project_id)
+            logger.info(
+                f"Project {project_id}: AGOL was last updated {format_updated_at(agol_updated_at)}, Moped {format_updated_at(moped_updated_at)}"
+            )
+    return sorted(drifted_project_ids)
+
+
+def repair_projects(project_ids, args):
+    """Replace the features of the drifted projects in every layer
+
+    Args:
+        project_ids (list): the ids of the projects to replace
+        args (argparse.Namespace): the CLI namespace
+    """
+    logger.info(f"Getting the component features of {len(project_ids)} projects...")
+    components = make_hasura_request(
+        query=COMPONENTS_QUERY,
+        variables={"where": {"project_id": {"_in": project_ids}}},
+    )["component_arcgis_online_view"]
+    all_features = make_all_features(components)
+    encoder = FeatureEncoder()
+    run_layer_jobs(
+        {
+            feature_type: [
+                make_delete_stage(
+                    feature_type, project_ids, [], make_delete_chunker(feature_type)
+                ),
+                make_upload_stage(
+                    feature_type, features, make_upload_chunker(feature_type), encoder
+                ),
+            ]
+            for feature_type, features in all_features.items()
+        },
+        max_workers=args.workers,
+        max_workers_per_layer=args.layer_workers,
+    )
+
+
+def main(args):
+    logger.info("Getting token...")
+    get_token()
+    target_live_service()
+
+    agol_aggregates = get_agol_aggregates()
+    moped_aggregates = get_moped_aggregates()
+    project_ids = find_drifted_projects(agol_aggregates, moped_aggregates)
+
+    project_count = len(
+        set().union(
+            *(layer.keys() for layer in agol_aggregates.values()),
+            *(layer.keys() for layer in moped_aggregates.values()),
+        )
+    )
+    if not project_ids:
+        logger.info(f"All {project_count} projects match")
+        return
+
+    logger.info(
+        f"{len(project_ids)} of {project_count} projects drifted: {', '.join(str(project_id) for project_id in project_ids)}"
+    )
+    if args.repair:
+        repair_projects(project_ids, args)
+        logger.info(f"Repaired {len(project_ids)} projects")
+
+
+def get_cli_args():
+    """Create the CLI and parse args
+
+    Returns:
+        argparse.Namespace: The CLI namespace
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="Replace the features of the drifted projects in every layer.",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--layer-workers", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_cli_args()
+    logger = get_logger(name="reconcile", level=logging.INFO)
+
+    try:
+        main(args)
+    finally:
+        log_request_stats()
@@ -1,101 +1,252 @@
-UPLOAD_CHUNK_SIZE = 100
+import os
+
+# Chunks are sized by serialized payload bytes and adapt to AGOL's response times.
+# Each budget starts at its target and is kept between its min and max.
+UPLOAD_CHUNK_TARGET_BYTES = 1_000_000
+UPLOAD_CHUNK_MIN_BYTES = 50_000
+UPLOAD_CHUNK_MAX_BYTES = 8_000_000
+# Deletes are sized by the project ids in their `where` clause
+DELETE_CHUNK_TARGET_BYTES = 800
+DELETE_CHUNK_MIN_BYTES = 80
+DELETE_CHUNK_MAX_BYTES = 8_000
+# The response time each chunked request should aim for
+CHUNK_TARGET_SECONDS = 10
+
+# Upload concurrency: requests in flight across all layers and within a single layer
+UPLOAD_MAX_WORKERS = 1
+UPLOAD_MAX_WORKERS_PER_LAYER = 1
+
+# Connections kept alive per host by the AGOL session all workers share. Keep it at least
+# as large as -w, or the connections of the extra workers are closed after each request.
+HTTP_POOL_SIZE = 16
+# Seconds to wait for a connection and then for each read of a response before retrying,
+# so that a hung connection cannot block its worker forever
+HTTP_TIMEOUT_SECONDS = (10, 300)
+
+# Geometry shrinking with --simplify: decimal places kept (6 is about 10 cm) and the farthest
+# a removed line vertex may be from the simplified line, in degrees (0.00001 is about 1 m)
+COORDINATE_DECIMALS = 6
+SIMPLIFY_TOLERANCE = 0.00001
+
+# Where the journal of an unfinished run is kept so that it can be resumed with --resume
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal")
+
+# Diff mode stores a hash of each component's features in this hidden layer field
+CONTENT_HASH_FIELD = "moped_content_hash"
+OBJECT_ID_FIELD = "OBJECTID"
+# The number of features requested per page when reading a layer back from AGOL
+QUERY_PAGE_SIZE = 2000
+
+# Bulk mode (--bulk) waits this long between checks of a truncate or append job, and gives
+# up on a job that has not finished after the timeout
+BULK_JOB_POLL_SECONDS = 5
+BULK_JOB_TIMEOUT_SECONDS = 3600
+
+# The namespace of the run metrics sent to a StatsD agent with --statsd
+METRICS_PREFIX = "moped_agol"
 
 LAYER_IDS = {"points": 0, "lines": 1, "combined": 2, "exploded": 3}
 
-COMPONENTS_QUERY_BY_LAST_UPDATE_DATE = """
+# The number of components fetched per page when streaming from Hasura
+COMPONENTS_PAGE_SIZE = 500
+
+# The component_arcgis_online_view columns that can be uploaded as feature attributes
+COMPONENT_FIELDS = [
+    "component_description",
+    "component_id",
+    "component_location_description",
+    "component_name",
+    "component_name_full",
+    "component_phase_id",
+    "component_phase_name",
+    "component_phase_name_simple",
+    "component_subcomponents",
+    "component_subtype",
+    "component_tags",
+    "component_url",
+    "component_work_types",
+    "construction_start_date",
+    "contract_numbers",
+    "council_districts",
+    "council_districts_searchable",
+    "current_phase_name",
+    "current_phase_name_simple",
+    "ecapris_subproject_id",
+    "feature_ids",
+    "funding_sources",
+    "project_funding_total",
+    "geometry_type",
+    "interim_project_component_id",
+    "interim_project_id",
+    "is_within_city_limits",
+    "knack_data_tracker_project_record_id",
+    "length_feet_total",
+    "length_miles_total",
+    "feature_count",
+    "parent_project_id",
+    "parent_project_name",
+    "parent_project_name_full",
+    "parent_project_url",
+    "project_added_by",
+    "project_component_id",
+    "project_description",
+    "project_designer",
+    "project_development_status",
+    "project_development_status_date",
+    "project_development_status_date_calendar_year",
+    "project_development_status_date_calendar_year_month",
+    "project_development_status_date_calendar_year_month_numeric",
+    "project_development_status_date_calendar_year_quarter",
+    "project_development_status_date_fiscal_year",
+    "project_development_status_date_fiscal_year_quarter",
+    "project_id",
+    "project_inspector",
+    "project_lead",
+    "project_name",
+    "project_name_secondary",
+    "project_name_full",
+    "project_partners",
+    "project_phase_id",
+    "project_phase_name",
+    "project_phase_name_simple",
+    "project_sponsor",
+    "project_status_update",
+    "project_status_update_date_created",
+    "project_tags",
+    "project_team_members",
+    "project_updated_at",
+    "project_created_at",
+    "project_url",
+    "project_website",
+    "public_process_status",
+    "related_project_ids",
+    "related_project_ids_searchable",
+    "signal_ids",
+    "srts_id",
+    "substantial_completion_date",
+    "substantial_completion_date_estimated",
+    "task_order_names",
+    "workgroup_contractors",
+    "is_mapped",
+]
+
+# The attributes uploaded to each layer. Removing a column from a layer stops it from being
+# uploaded there, and a column no layer uses is no longer fetched from Hasura. Layers with
+# the same list share their attributes, so they are only built and encoded once.
+LAYER_FIELDS = {
+    "points": COMPONENT_FIELDS,
+    "lines": COMPONENT_FIELDS,
+    "combined": COMPONENT_FIELDS,
+    "exploded": COMPONENT_FIELDS,
+}
+
+# Columns every layer gets because the ETL finds and replaces features by them
+REQUIRED_FIELDS = ["project_component_id", "project_id"]
+
+# Every column used by some layer, in view order, plus the geometries the features are built from
+FETCHED_FIELDS = [
+    field
+    for field in COMPONENT_FIELDS
+    if field in REQUIRED_FIELDS
+    or any(field in fields for fields in LAYER_FIELDS.values())
+] + ["geometry", "line_geometry"]
+
+COMPONENT_FIELDS_FRAGMENT = (
+    """
+fragment ComponentFields on component_arcgis_online_view {
+"""
+    + "".join(f"    {field}\n" for field in FETCHED_FIELDS)
+    + "}\n"
+)
+
+COMPONENTS_QUERY_BY_LAST_UPDATE_DATE = (
+    """
 query GetProjectsComponents($project_where: moped_project_bool_exp!, $component_where: component_arcgis_online_view_bool_exp!) {
   moped_project(where: $project_where) {
     project_id
   }
   component_arcgis_online_view(where: $component_where) {
-    component_description
-    component_id
-    component_location_description
-    component_name
-    component_name_full
-    component_phase_id
-    component_phase_name
-    component_phase_name_simple
-    component_subcomponents
-    component_subtype
-    component_tags
-    component_url
-    component_work_types
-    construction_start_date
-    contract_numbers
-    council_districts
-    council_districts_searchable
-    current_phase_name
-    current_phase_name_simple
-    ecapris_subproject_id
-    feature_ids
-    funding_sources
-    project_funding_total
-    geometry
-    geometry_type
-    interim_project_component_id
-    interim_project_id
-    is_within_city_limits
-    knack_data_tracker_project_record_id
-    length_feet_total
-    length_miles_total
-    feature_count
-    line_geometry
-    parent_project_id
-    parent_project_name
-    parent_project_name_full
-    parent_project_url
-    project_added_by
-    project_component_id
-    project_description
-    project_designer
-    project_development_status
-    project_development_status_date
-    project_development_status_date_calendar_year
-    project_development_status_date_calendar_year_month
-    project_development_status_date_calendar_year_month_numeric
-    project_development_status_date_calendar_year_quarter
-    project_development_status_date_fiscal_year
-    project_development_status_date_fiscal_year_quarter
+    ...ComponentFields
+  }
+}
+"""
+    + COMPONENT_FIELDS_FRAGMENT
+)
+
+# Pages through the components by project_component_id so that each page starts after the
+# last id of the previous one, rather than at an offset
+COMPONENTS_PAGE_QUERY = (
+    """
+query GetProjectsComponentsPage($where: component_arcgis_online_view_bool_exp!, $limit: Int!) {
+  component_arcgis_online_view(where: $where, order_by: {project_component_id: asc}, limit: $limit) {
+    ...ComponentFields
+  }
+}
+"""
+    + COMPONENT_FIELDS_FRAGMENT
+)
+
+COMPONENTS_QUERY = (
+    """
+query GetComponents($where: component_arcgis_online_view_bool_exp!) {
+  component_arcgis_online_view(where: $where) {
+    ...ComponentFields
+  }
+}
+"""
+    + COMPONENT_FIELDS_FRAGMENT
+)
+
+# Only the columns reconcile.py needs to count each project's features in every layer
+RECONCILE_COMPONENTS_QUERY = """
+query GetComponentsToReconcile {
+  component_arcgis_online_view {
     project_id
-    project_inspector
-    project_lead
-    project_name
-    project_name_secondary
-    project_name_full
-    project_partners
-    project_phase_id
-    project_phase_name
-    project_phase_name_simple
-    project_sponsor
-    project_status_update
-    project_status_update_date_created
-    project_tags
-    project_team_members
+    project_component_id
     project_updated_at
-    project_created_at
-    project_url
-    project_website
-    public_process_status
-    related_project_ids
-    related_project_ids_searchable
-    signal_ids
-    srts_id
-    substantial_completion_date
-    substantial_completion_date_estimated
-    task_order_names
-    workgroup_contractors
-    is_mapped
+    geometry
+    line_geometry
   }
 }
 """
 
-# line_geometry
-EXPLODED_COMPONENTS_QUERY_BY_LAST_UPDATE_DATE = """
-query GetExplodedProjectsComponents($where: exploded_component_arcgis_online_view_bool_exp!) {
-  exploded_component_arcgis_online_view(where: $where) {
-    geometry: exploded_geometry
+# Seconds two project_updated_at values may differ by before a project counts as drifted,
+# since AGOL date fields keep milliseconds and Moped keeps microseconds
+RECONCILE_DATE_TOLERANCE_SECONDS = 1
+
+# Activity on these tables only changes a project's components, whose updated_at is bumped
+# by triggers. Activity on any other table can change attributes shared by every component.
+COMPONENT_RECORD_TYPES = [
+    "moped_proj_components",
+    "moped_proj_component_tags",
+    "moped_proj_component_work_types",
+    "moped_proj_components_subcomponents",
+    "feature_drawn_lines",
+    "feature_drawn_points",
+    "feature_intersections",
+    "feature_school_beacons",
+    "feature_signals",
+    "feature_street_segments",
+]
+
+# Finds what changed since a date so that incremental runs can replace single components.
+# The activity log's created_at is a timestamp without time zone that holds UTC, so it gets
+# its own variable with the date converted to UTC and its offset dropped.
+INCREMENTAL_CHANGES_QUERY = """
+query GetIncrementalChanges($date: timestamptz!, $activity_date: timestamp!, $component_record_types: [String!]!) {
+  moped_project(where: {updated_at: {_gt: $date}}) {
+    project_id
+    is_deleted
+  }
+  moped_activity_log(where: {created_at: {_gt: $activity_date}, record_type: {_nin: $component_record_types}}, distinct_on: record_project_id) {
+    record_project_id
+  }
+  moped_proj_components(where: {updated_at: {_gt: $date}}) {
     project_component_id
+    project_id
+    is_deleted
   }
 }
 """
+
+# line_geometry
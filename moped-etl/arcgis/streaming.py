@@ -0,0 +1,84 @@
+"""Streams component records from Hasura a page at a time"""
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import COMPONENTS_PAGE_QUERY
+from utils import make_hasura_request
+
+
+def iter_component_pages(component_where, page_size):
+    """Yield the components matching a filter, a page at a time.
+
+    Pages are keyed on project_component_id: each page asks for the components after the
+    last id of the previous page, so a page costs the same no matter how deep into the view
+    it is.
+
+    Args:
+        component_where (dict): the component_arcgis_online_view filter
+        page_size (int): the number of components to fetch per page
+
+    Yields:
+        list: a page of component records
+    """
+    last_project_component_id = None
+    while True:
+        where = component_where
+        if last_project_component_id is not None:
+            where = {
+                "_and": [
+                    component_where,
+                    {"project_component_id": {"_gt": last_project_component_id}},
+                ]
+            }
+        components = make_hasura_request(
+            query=COMPONENTS_PAGE_QUERY,
+            variables={"where": where, "limit": page_size},
+        )["component_arcgis_online_view"]
+
+        if not components:
+            return
+
+        yield components
+
+        if len(components) < page_size:
+            return
+        last_project_component_id = components[-1]["project_component_id"]
+
+
+def prefetch(iterable):
+    """Yield the items of an iterable while the next item is fetched in the background.
+
+    At most one item is held ahead of the consumer, so memory stays bounded to two items.
+
+    Args:
+        iterable (iterable): the items to fetch, such as pages from `iter_component_pages`
+
+    Yields:
+        the items of the iterable, in order
+    """
+    iterator = iter(iterable)
+    # A unique value returned by `next` once the iterator is exhausted
+    done = object()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        upcoming = executor.submit(next, iterator, done)
+        while True:
+            item = upcoming.result()
+            if item is done:
+                return
+            upcoming = executor.submit(next, iterator, done)
+            yield item
+
+
+def fetch_in_background(fetch):
+    """Start a fetch on a background thread so that other fetches can run meanwhile.
+
+    Args:
+        fetch (function): the fetch to run, which takes no arguments
+
+    Returns:
+        concurrent.futures.Future: resolves to the result of the fetch, or raises its error
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(fetch)
+    # The thread still runs the fetch, and exits once it is done
+    executor.shutdown(wait=False)
+    return future
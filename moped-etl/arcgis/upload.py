@@ -0,0 +1,87 @@
+"""Runs AGOL layer requests on a bounded pool of worker threads"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import get_logger
+
+
+def run_layer_jobs(layer_jobs, max_workers=1, max_workers_per_layer=1):
+    """Run the requests for each AGOL layer with bounded parallelism.
+
+    Each layer job is a list of stages, and each stage is an iterable of
+    `(description, request)` tuples where `request` is a callable that takes no arguments.
+    The requests of a stage run concurrently, but a layer only moves on to its next stage
+    once every request in the current stage has succeeded. This lets us delete a layer's
+    existing features before any new features are uploaded to it while other layers keep
+    working. Stages are consumed lazily, so a generator can size its next request from the
+    ones that already finished.
+
+    Errors are fail-fast: the first request that raises stops any queued requests from
+    starting and the exception is re-raised once the requests already in flight return.
+
+    Args:
+        layer_jobs (dict): lists of request stages keyed by feature type ("points", "lines", etc.)
+        max_workers (int, optional): the maximum number of requests in flight across all
+            layers. Defaults to 1.
+        max_workers_per_layer (int, optional): the maximum number of requests in flight for a
+            single layer. Defaults to 1.
+
+    Raises:
+        Exception: the first exception raised by any request
+    """
+    remaining_stages = {
+        feature_type: iter(stages) for feature_type, stages in layer_jobs.items()
+    }
+    # The requests of the stage each layer is currently working through
+    current_stage = {feature_type: None for feature_type in layer_jobs}
+    in_flight = {feature_type: 0 for feature_type in layer_jobs}
+    futures = {}
+
+    def next_request(feature_type):
+        """Pull the next request for a layer, or None if it has to wait or is done"""
+        while True:
+            if current_stage[feature_type] is not None:
+                request = next(current_stage[feature_type], None)
+                if request is not None:
+                    return request
+                if in_flight[feature_type]:
+                    # Wait for the rest of this stage to finish before starting the next
+                    return None
+            stage = next(remaining_stages[feature_type], None)
+            if stage is None:
+                return None
+            current_stage[feature_type] = iter(stage)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Fill free worker slots, visiting layers in order so a single worker
+            # processes the layers one after another
+            for feature_type in layer_jobs:
+                while (
+                    len(futures) < max_workers
+                    and in_flight[feature_type] < max_workers_per_layer
+                ):
+                    request = next_request(feature_type)
+                    if request is None:
+                        break
+                    description, run_request = request
+                    logger.info(description)
+                    futures[executor.submit(run_request)] = feature_type
+                    in_flight[feature_type] += 1
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                feature_type = futures.pop(future)
+                in_flight[feature_type] -= 1
+                error = future.exception()
+
+                if error:
+                    # Queued requests are never started; let the in-flight ones finish
+                    wait(futures)
+                    raise error
+
+
+logger = get_logger(__file__)
@@ -1,42 +1,156 @@
 import json
 import logging
 import os
+import random
+import re
 import sys
+import threading
 import time
+from collections import defaultdict
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from settings import LAYER_IDS
+from metrics import run_metrics
+from settings import LAYER_IDS, QUERY_PAGE_SIZE, HTTP_POOL_SIZE, HTTP_TIMEOUT_SECONDS
 
 AGOL_USERNAME = os.getenv("AGOL_USERNAME")
 AGOL_PASSWORD = os.getenv("AGOL_PASSWORD")
 AGOL_COMPONENTS_ENDPOINT=os.getenv("AGOL_COMPONENTS_ENDPOINT")
+# Blue/green rebuilds load whichever of two identical feature services the view layers
+# consumers read is not pointing at, then point the view at it
+AGOL_VIEW_ENDPOINT = os.getenv("AGOL_VIEW_ENDPOINT")
+AGOL_BLUE_ENDPOINT = os.getenv("AGOL_BLUE_ENDPOINT")
+AGOL_GREEN_ENDPOINT = os.getenv("AGOL_GREEN_ENDPOINT")
 HASURA_ENDPOINT = os.getenv("HASURA_ENDPOINT")
 HASURA_ADMIN_SECRET = os.getenv("HASURA_ADMIN_SECRET")
-AGOL_ORG_BASE_URL = "https://austin.maps.arcgis.com"
+# Point this and AGOL_COMPONENTS_ENDPOINT at local_agol.py to run without AGOL
+AGOL_ORG_BASE_URL = os.getenv("AGOL_ORG_BASE_URL", "https://austin.maps.arcgis.com")
 
+# Shared by all upload workers so that a throttled response pauses every worker
+throttle_lock = threading.Lock()
+throttled_until = 0
 
-def get_endpoint(method, feature_type):
+# One keep-alive session shared by every worker, so its pooled connections outlive the
+# worker pools of each run_layer_jobs call
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+# The response time of each thread's last successful AGOL request, without its failed
+# attempts and backoff, so that a throttled request does not shrink the chunk sizes
+last_attempt = threading.local()
+
+# Held while a worker fetches a new token so that the others wait for it
+token_lock = threading.Lock()
+
+# AGOL error codes for an expired or invalid token (498) and a missing token (499)
+TOKEN_ERROR_CODES = (498, 499)
+
+# Request counts and time spent backing off, keyed by feature type
+stats_lock = threading.Lock()
+request_stats = defaultdict(
+    lambda: {"requests": 0, "retries": 0, "backoff_seconds": 0, "token_refreshes": 0}
+)
+
+# Hasura responses keyed by request, saved by --capture and served by --replay
+hasura_lock = threading.Lock()
+hasura_responses = {}
+hasura_mode = None
+
+
+def get_endpoint(method, feature_type=None):
     """Get the AGOL REST API endpoint.
 
-    The docs are bad—but we only care about `addFeatures` or `deleteFeatures`.
+    The docs are bad—but we only care about `addFeatures`, `deleteFeatures`, `applyEdits`,
+    `query` and `append`.
     https://developers.arcgis.com/rest/services-reference/enterprise/
 
     Args:
-        method (Str): the REST API operation: addFeatures or deleteFeatures
-        feature_type (Str): the feature type we're adding: "points" or "lines"
+        method (Str): the REST API operation: addFeatures, deleteFeatures, applyEdits, query
+            or append
+        feature_type (Str, optional): the feature type we're adding: "points" or "lines".
+            Defaults to None, which targets the whole feature service.
 
     Returns:
         Str: an endpoint URL
     """
+    if feature_type is None:
+        return f"{AGOL_COMPONENTS_ENDPOINT}/{method}"
     layer_id = LAYER_IDS[feature_type]
     return f"{AGOL_COMPONENTS_ENDPOINT}/{layer_id}/{method}"
 
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst"""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+def get_hasura_request_key(query, variables):
+    """Identify a Hasura request in a capture file"""
+    return json.dumps({"query": query, "variables": variables}, sort_keys=True)
+
+
+def start_hasura_capture():
+    """Keep every Hasura response so that `save_hasura_capture` can write them to a file"""
+    global hasura_mode
+    with hasura_lock:
+        hasura_mode = "capture"
+        hasura_responses.clear()
+
+
+def save_hasura_capture(path):
+    """Write the Hasura responses kept since `start_hasura_capture` to a JSON file"""
+    with hasura_lock:
+        with open(path, "w") as fout:
+            json.dump(hasura_responses, fout)
+
+
+def start_hasura_replay(path):
+    """Answer Hasura requests from a file written by `save_hasura_capture`
+
+    Args:
+        path (str): the capture file
+    """
+    global hasura_mode
+    with open(path) as fin:
+        responses = json.load(fin)
+    with hasura_lock:
+        hasura_mode = "replay"
+        hasura_responses.clear()
+        hasura_responses.update(responses)
+
+
+def set_components_endpoint(endpoint):
+    """Point every following feature service request at another feature service"""
+    global AGOL_COMPONENTS_ENDPOINT
+    AGOL_COMPONENTS_ENDPOINT = endpoint
+
+
+def get_service_name(endpoint):
+    """Read the service name from a feature service URL, such as Moped_Project_Components"""
+    return endpoint.rstrip("/").split("/rest/services/")[-1].split("/")[0]
+
+
+def get_admin_endpoint(method, feature_type, service_endpoint=None):
+    """Get the AGOL REST API admin endpoint of a layer, which hosts `truncate` and
+    `updateDefinition`.
+
+    Args:
+        method (Str): the admin operation, such as truncate
+        feature_type (Str): the feature type of the layer
+        service_endpoint (Str, optional): the feature service URL. Defaults to None, which
+            uses AGOL_COMPONENTS_ENDPOINT.
+
+    Returns:
+        Str: an endpoint URL
+    """
+    admin_endpoint = (service_endpoint or AGOL_COMPONENTS_ENDPOINT).replace(
+        "/rest/services/", "/rest/admin/services/"
+    )
+    return f"{admin_endpoint}/{LAYER_IDS[feature_type]}/{method}"
+
+
+def get_operation_name(query):
+    """Return the name of a GraphQL query, such as `GetComponents`, to label its metrics"""
+    match = re.search(r"query\s+(\w+)", query)
+    return match.group(1) if match else "query"
 
 
 def make_hasura_request(*, query, variables=None):
@@ -46,23 +160,45 @@ def make_hasura_request(*, query, variables=None):
         query (str): the hasura query
 
     Raises:
-        ValueError: If no data is returned
+        ValueError: If no data is returned, or a replayed request was not captured
 
     Returns:
         dict: Hasura JSON response data
     """
+    key = get_hasura_request_key(query, variables)
+    if hasura_mode == "replay":
+        with hasura_lock:
+            if key not in hasura_responses:
+                raise ValueError(
+                    "The Hasura capture has no response for this request. Replay with the same options and -d date used for the capture."
+                )
+            return hasura_responses[key]
+
     headers = {
         "X-Hasura-Admin-Secret": HASURA_ADMIN_SECRET,
         "content-type": "application/json",
     }
     payload = {"query": query, "variables": variables}
-    res = requests.post(HASURA_ENDPOINT, json=payload, headers=headers)
-    res.raise_for_status()
-    data = res.json()
+    with run_metrics.timed(f"fetch {get_operation_name(query)}") as counts:
+        res = requests.post(
+            HASURA_ENDPOINT, json=payload, headers=headers, timeout=HTTP_TIMEOUT_SECONDS
+        )
+        res.raise_for_status()
+        counts["byte_count"] = len(res.content)
+        data = res.json()
+        counts["feature_count"] = sum(
+            len(records)
+            for records in (data.get("data") or {}).values()
+            if isinstance(records, list)
+        )
     try:
-        return data["data"]
+        response_data = data["data"]
     except KeyError:
         raise ValueError(data)
+    if hasura_mode == "capture":
+        with hasura_lock:
+            hasura_responses[key] = response_data
+    return response_data
 
 
 def handle_arcgis_response(response_data):
@@ -109,7 +245,7 @@ def delete_all_features(feature_type):
         "where": "1=1",
         "returnDeleteResults": False,
     }
-    res = resilient_layer_request(endpoint, data=data)
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
     response_data = res.json()
 
     if not response_data.get("success"):
@@ -133,14 +269,38 @@ def delete_features_by_project_ids(feature_type, project_ids):
         "where": f"project_id IN ({project_ids})",
         "returnDeleteResults": False,
     }
-    res = resilient_layer_request(endpoint, data=data)
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+    response_data = res.json()
+
+    if not response_data.get("success"):
+        raise Exception(f"Delete features failed: {response_data}")
+
+
+def delete_features_by_component_ids(feature_type, project_component_ids):
+    """Deletes features from an arcgis online feature service associated with components in a list of ids.
+
+    Args:
+        feature_type (Str): the feature type we're adding: "points" or "lines"
+        project_component_ids (Str): the comma-separated project component ids to delete
+
+    Raises:
+        Exception: if the deletion fails
+    """
+    endpoint = get_endpoint("deleteFeatures", feature_type)
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "f": "json",
+        "where": f"project_component_id IN ({project_component_ids})",
+        "returnDeleteResults": False,
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
     response_data = res.json()
 
     if not response_data.get("success"):
         raise Exception(f"Delete features failed: {response_data}")
 
 
-def add_features(feature_type, features):
+def add_features(feature_type, features_json):
     """Inserts feature objects into AGOL feature service
 
     Read more about the feature json spec here:
@@ -148,58 +308,559 @@ def add_features(feature_type, features):
 
     Args:
         feature_type (Str): the feature type we're adding: "points" or "lines"
-        features (List): Esri feature objects to upload
+        features_json (Bytes): a JSON array of Esri feature objects to upload, such as
+            one joined by `encoding.join_features`
     """
     token = os.getenv("AGOL_TOKEN")
     endpoint = get_endpoint("addFeatures", feature_type)
     data = {
         "token": token,
-        "features": json.dumps(features),
+        "features": features_json,
+        "rollbackOnFailure": False,
+        "f": "json",
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+
+
+def truncate_layer(feature_type, poll_seconds, timeout_seconds):
+    """Delete every feature of an AGOL layer with the asynchronous truncate operation
+
+    Truncating skips the per-feature work of deleteFeatures, which makes it far faster at
+    emptying a large layer.
+    https://developers.arcgis.com/rest/services-reference/online/truncate-feature-layer/
+
+    Args:
+        feature_type (Str): the feature type of the layer to empty
+        poll_seconds (Int): the seconds between checks of the truncate job
+        timeout_seconds (Int): the seconds to wait for the truncate job to finish
+
+    Raises:
+        Exception: if the truncate job fails
+    """
+    endpoint = get_admin_endpoint("truncate", feature_type)
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "async": True,
+        "attachmentOnly": False,
+        "f": "json",
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+    if response_data.get("statusURL"):
+        wait_for_job(
+            response_data["statusURL"], feature_type, poll_seconds, timeout_seconds
+        )
+    elif not response_data.get("success"):
+        raise Exception(f"Truncate failed: {response_data}")
+
+
+def upload_file(feature_type, path):
+    """Upload a file to the feature service so an append job can load it
+
+    Args:
+        feature_type (Str): the feature type the file is for, used to group the request stats
+        path (Str): the file to upload
+
+    Raises:
+        Exception: if the upload fails
+
+    Returns:
+        Str: the id of the uploaded item
+    """
+    endpoint = f"{AGOL_COMPONENTS_ENDPOINT}/uploads/upload"
+    data = {"token": os.getenv("AGOL_TOKEN"), "f": "json"}
+    with open(path, "rb") as fin:
+        res = resilient_layer_request(
+            endpoint, data=data, feature_type=feature_type, files={"file": fin}
+        )
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+    try:
+        return response_data["item"]["itemID"]
+    except KeyError:
+        raise Exception(f"Upload failed: {response_data}")
+
+
+def delete_upload(feature_type, upload_id):
+    """Delete a file uploaded to the feature service once it has been appended"""
+    endpoint = f"{AGOL_COMPONENTS_ENDPOINT}/uploads/{upload_id}/delete"
+    data = {"token": os.getenv("AGOL_TOKEN"), "f": "json"}
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+    handle_arcgis_response(res.json())
+
+
+def append_geojson(feature_type, upload_id, poll_seconds, timeout_seconds):
+    """Load an uploaded GeoJSON file into an AGOL layer with one asynchronous append job
+
+    https://developers.arcgis.com/rest/services-reference/online/append-feature-service-layer/
+
+    Args:
+        feature_type (Str): the feature type of the layer to load
+        upload_id (Str): the id of the GeoJSON file from `upload_file`
+        poll_seconds (Int): the seconds between checks of the append job
+        timeout_seconds (Int): the seconds to wait for the append job to finish
+
+    Raises:
+        Exception: if the append job fails
+    """
+    endpoint = get_endpoint("append", feature_type)
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "appendUploadId": upload_id,
+        "appendUploadFormat": "geojson",
+        "upsert": False,
+        "rollbackOnFailure": True,
+        "async": True,
+        "f": "json",
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+    if not response_data.get("statusUrl"):
+        raise Exception(f"Append failed: {response_data}")
+    wait_for_job(response_data["statusUrl"], feature_type, poll_seconds, timeout_seconds)
+
+
+def wait_for_job(status_url, feature_type, poll_seconds, timeout_seconds):
+    """Poll an asynchronous AGOL job until it is done
+
+    Args:
+        status_url (Str): the job status URL returned when the job was started
+        feature_type (Str): the feature type of the job's layer, used to group the request stats
+        poll_seconds (Int): the seconds between checks
+        timeout_seconds (Int): the seconds to wait before giving up
+
+    Raises:
+        Exception: if the job fails or does not finish in time
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        data = {"token": os.getenv("AGOL_TOKEN"), "f": "json"}
+        res = resilient_layer_request(status_url, data=data, feature_type=feature_type)
+        response_data = res.json()
+        handle_arcgis_response(response_data)
+        status = response_data.get("status")
+        if status == "Completed":
+            return
+        if status not in ("Pending", "InProgress", "Executing", "Submitted"):
+            raise Exception(f"{feature_type} job failed: {response_data}")
+        if time.monotonic() > deadline:
+            raise Exception(
+                f"{feature_type} job did not finish within {timeout_seconds} seconds: {status_url}"
+            )
+        time.sleep(poll_seconds)
+
+
+def apply_edits(feature_type, adds, updates, deletes):
+    """Adds, updates, and deletes features of an AGOL layer in a single request
+
+    Read more about applyEdits here:
+    https://developers.arcgis.com/rest/services-reference/enterprise/apply-edits-feature-service-layer/
+
+    Args:
+        feature_type (Str): the feature type we're editing: "points" or "lines"
+        adds (List): Esri feature objects to add
+        updates (List): Esri feature objects to update, with their object id in the attributes
+        deletes (List): the object ids of the features to delete
+    """
+    endpoint = get_endpoint("applyEdits", feature_type)
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "adds": json.dumps(adds),
+        "updates": json.dumps(updates),
+        "deletes": json.dumps(deletes),
         "rollbackOnFailure": False,
         "f": "json",
     }
-    res = resilient_layer_request(endpoint, data=data)
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
     response_data = res.json()
     handle_arcgis_response(response_data)
 
 
-def resilient_layer_request(endpoint, data, max_retries=10, sleep_seconds=2):
+def apply_service_edits(edits_by_layer):
+    """Adds, updates, and deletes features of several AGOL layers in a single request
+
+    Read more about the feature service applyEdits here:
+    https://developers.arcgis.com/rest/services-reference/enterprise/apply-edits-feature-service/
+
+    Args:
+        edits_by_layer (Dict): the `adds`, `updates`, and `deletes` lists of each layer,
+            keyed by feature type. See `apply_edits` for what the lists hold.
+    """
+    endpoint = get_endpoint("applyEdits")
+    edits = [
+        {"id": LAYER_IDS[feature_type], **layer_edits}
+        for feature_type, layer_edits in edits_by_layer.items()
+    ]
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "edits": json.dumps(edits),
+        "rollbackOnFailure": False,
+        "f": "json",
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type="service")
+    response_data = res.json()
+    if isinstance(response_data, dict):
+        # errors about the whole request come back as an object instead of a list
+        handle_arcgis_response(response_data)
+        return
+    for layer_response_data in response_data:
+        handle_arcgis_response(layer_response_data)
+
+
+def query_features(feature_type, where, out_fields):
+    """Reads the attributes of every feature in an AGOL layer that matches a where clause
+
+    Features are requested a page at a time until AGOL reports there are no more.
+
+    Args:
+        feature_type (Str): the feature type we're reading: "points" or "lines"
+        where (Str): the SQL where clause that selects the features
+        out_fields (List): the names of the attributes to return
+
+    Raises:
+        ValueError: if AGOL returns an error
+
+    Returns:
+        List: the attributes dict of each matching feature
+    """
+    endpoint = get_endpoint("query", feature_type)
+    records = []
+    while True:
+        data = {
+            "token": os.getenv("AGOL_TOKEN"),
+            "where": where,
+            "outFields": ",".join(out_fields),
+            "returnGeometry": False,
+            "orderByFields": out_fields[0],
+            "resultOffset": len(records),
+            "resultRecordCount": QUERY_PAGE_SIZE,
+            "f": "json",
+        }
+        res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+        response_data = res.json()
+        handle_arcgis_response(response_data)
+        features = response_data.get("features", [])
+        records.extend(feature["attributes"] for feature in features)
+        if not features or not response_data.get("exceededTransferLimit"):
+            return records
+
+
+def query_statistics(feature_type, group_by_field, out_statistics):
+    """Reads grouped statistics of the features in an AGOL layer
+
+    Groups are requested a page at a time until AGOL reports there are no more.
+    https://developers.arcgis.com/rest/services-reference/enterprise/query-feature-service-layer/
+
+    Args:
+        feature_type (Str): the feature type we're reading: "points" or "lines"
+        group_by_field (Str): the field to group the features by
+        out_statistics (List): statistic definitions with `statisticType`,
+            `onStatisticField` and `outStatisticFieldName`
+
+    Raises:
+        ValueError: if AGOL returns an error
+
+    Returns:
+        List: the attributes dict of each group, with the group field and each statistic
+    """
+    endpoint = get_endpoint("query", feature_type)
+    records = []
+    while True:
+        data = {
+            "token": os.getenv("AGOL_TOKEN"),
+            "where": "1=1",
+            "groupByFieldsForStatistics": group_by_field,
+            "outStatistics": json.dumps(out_statistics),
+            "orderByFields": group_by_field,
+            "resultOffset": len(records),
+            "resultRecordCount": QUERY_PAGE_SIZE,
+            "f": "json",
+        }
+        res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+        response_data = res.json()
+        handle_arcgis_response(response_data)
+        features = response_data.get("features", [])
+        records.extend(feature["attributes"] for feature in features)
+        if not features or not response_data.get("exceededTransferLimit"):
+            return records
+
+
+def count_features(feature_type):
+    """Count the features in an AGOL layer
+
+    Args:
+        feature_type (Str): the feature type of the layer to count
+
+    Raises:
+        ValueError: if AGOL returns an error
+
+    Returns:
+        Int: the number of features in the layer
+    """
+    endpoint = get_endpoint("query", feature_type)
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "where": "1=1",
+        "returnCountOnly": True,
+        "f": "json",
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type=feature_type)
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+    return response_data["count"]
+
+
+def get_view_source_endpoint():
+    """Find the feature service the view layers read from
+
+    Raises:
+        ValueError: if AGOL returns an error
+
+    Returns:
+        Str: the URL of the view's source feature service
+    """
+    endpoint = f"{AGOL_VIEW_ENDPOINT}/sources"
+    data = {"token": os.getenv("AGOL_TOKEN"), "f": "json"}
+    res = resilient_layer_request(endpoint, data=data, feature_type="view")
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+    return response_data["services"][0]["url"]
+
+
+def point_view_at(feature_type, source_endpoint):
+    """Switch a view layer to read the same layer of another feature service
+
+    Args:
+        feature_type (Str): the feature type of the view layer
+        source_endpoint (Str): the URL of the feature service the view should read
+
+    Raises:
+        ValueError: if AGOL returns an error
+    """
+    endpoint = get_admin_endpoint("updateDefinition", feature_type, AGOL_VIEW_ENDPOINT)
+    definition = {
+        "adminLayerInfo": {
+            "viewLayerDefinition": {
+                "sourceServiceName": get_service_name(source_endpoint),
+                "sourceLayerId": LAYER_IDS[feature_type],
+                "sourceLayerFields": "*",
+            }
+        }
+    }
+    data = {
+        "token": os.getenv("AGOL_TOKEN"),
+        "updateDefinition": json.dumps(definition),
+        "async": False,
+        "f": "json",
+    }
+    res = resilient_layer_request(endpoint, data=data, feature_type="view")
+    response_data = res.json()
+    handle_arcgis_response(response_data)
+    if not response_data.get("success"):
+        raise ValueError(f"Update definition failed: {response_data}")
+
+
+def get_retry_after_seconds(res, default_seconds):
+    """Read the number of seconds AGOL asked us to wait from a throttled response.
+
+    Args:
+        res (requests.Response): the throttled response
+        default_seconds (int): the wait to use if no `Retry-After` header was sent
+
+    Returns:
+        float: seconds to wait before the next request
+    """
+    try:
+        return float(res.headers.get("Retry-After", default_seconds))
+    except ValueError:
+        return default_seconds
+
+
+def wait_for_throttle(feature_type=None):
+    """Block until any throttle window reported by AGOL to another worker has passed
+
+    Args:
+        feature_type (str, optional): the layer of the waiting request, whose backoff
+            stats the wait is added to. Defaults to None.
+    """
+    with throttle_lock:
+        wait_seconds = throttled_until - time.monotonic()
+    if wait_seconds > 0:
+        count_request(feature_type, backoff_seconds=wait_seconds)
+        time.sleep(wait_seconds)
+
+
+def set_throttle(wait_seconds):
+    """Pause all workers making AGOL requests for the given number of seconds"""
+    global throttled_until
+    with throttle_lock:
+        throttled_until = max(throttled_until, time.monotonic() + wait_seconds)
+
+
+def get_last_attempt_seconds():
+    """Return how long this thread's last successful AGOL request took to answer, or None"""
+    return getattr(last_attempt, "seconds", None)
+
+
+def get_backoff_seconds(attempts, base_seconds, max_seconds):
+    """Exponential backoff with full jitter so that workers do not retry in lockstep.
+
+    Args:
+        attempts (int): the number of attempts made so far
+        base_seconds (float): the backoff ceiling after the first attempt
+        max_seconds (float): the largest backoff ceiling
+
+    Returns:
+        float: seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(max_seconds, base_seconds * 2 ** (attempts - 1)))
+
+
+def refresh_token(expired_token):
+    """Get a new token unless another worker already replaced the expired one.
+
+    Args:
+        expired_token (str): the token that AGOL rejected
+    """
+    with token_lock:
+        if os.getenv("AGOL_TOKEN") == expired_token:
+            logger.info("Refreshing expired AGOL token...")
+            get_token()
+
+
+def count_request(feature_type, **counts):
+    """Add to the request stats of a layer"""
+    with stats_lock:
+        for key, value in counts.items():
+            request_stats[feature_type][key] += value
+
+
+def get_request_stats():
+    """Return a copy of the request stats of each layer, for the run metrics"""
+    with stats_lock:
+        return {
+            feature_type or "other": dict(stats)
+            for feature_type, stats in request_stats.items()
+        }
+
+
+def log_request_stats():
+    """Log the retries and time spent backing off for each layer"""
+    with stats_lock:
+        for feature_type, stats in request_stats.items():
+            logger.info(
+                f"{feature_type or 'other'} AGOL requests: {stats['requests']} requests, "
+                f"{stats['retries']} retries, {stats['backoff_seconds']:.1f}s backing off, "
+                f"{stats['token_refreshes']} token refreshes"
+            )
+
+
+def resilient_layer_request(
+    endpoint,
+    data,
+    feature_type=None,
+    files=None,
+    max_retries=10,
+    sleep_seconds=2,
+    max_sleep_seconds=60,
+):
     """An ArcGIS request wrapper to enable re-trying. Will try on any HTTP error
     except status code 400. Bear in mind that AGOL returns 200 for most invalid
     request errors, so those will be handled separately.
 
+    Requests reuse a pooled keep-alive session and retries back off exponentially with
+    jitter. A request that cannot connect or stops receiving within `HTTP_TIMEOUT_SECONDS`
+    is retried. When AGOL throttles us (status code 429), every worker sharing this module
+    waits out the `Retry-After` window before sending its next request, and the wait is
+    counted as backoff. When AGOL rejects the token (code 498 or 499), a new token is
+    fetched before retrying.
+
     Args:
         endpoint (str): The AGOL HTTP endpooint
         data (dict): The request payload
-        max_retries (int, optional): The number of times to retry. Defaults to 3.
-        sleep_seconds (int, optional): The amount of time to sleep between retries.
+        feature_type (str, optional): the layer the request is for, used to group the
+            request stats. Defaults to None.
+        files (dict, optional): open files to upload as multipart form data, which are
+            rewound before every attempt. Defaults to None.
+        max_retries (int, optional): The number of times to retry. Defaults to 10.
+        sleep_seconds (int, optional): The backoff ceiling after the first attempt.
             Defaults to 2. This tends to help mitigate strange errors like random
             404 errors.
+        max_sleep_seconds (int, optional): The largest backoff ceiling. Defaults to 60.
 
     Returns:
         requests.Response: the request response if successful
     """
     attempts = 0
+    last_attempt.seconds = None
     while True:
         attempts += 1
-        res = requests.post(endpoint, data=data)
+        wait_for_throttle(feature_type)
+        count_request(feature_type, requests=1)
+        for file in (files or {}).values():
+            file.seek(0)
+        attempt_started = time.monotonic()
+        try:
+            res = session.post(
+                endpoint, data=data, files=files, timeout=HTTP_TIMEOUT_SECONDS
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # A pooled connection that AGOL already closed fails without a response
+            if attempts >= max_retries:
+                raise e
+            logger.warn(
+                f"Retrying after {type(e).__name__} on attempt #{attempts} of {max_retries}"
+            )
+            backoff_seconds = get_backoff_seconds(
+                attempts, sleep_seconds, max_sleep_seconds
+            )
+            count_request(feature_type, retries=1, backoff_seconds=backoff_seconds)
+            time.sleep(backoff_seconds)
+            continue
         try:
+            if res.status_code == 429:
+                set_throttle(get_retry_after_seconds(res, sleep_seconds))
             res.raise_for_status()
             response_data = res.json()
-            if response_data.get("error"):
-                if response_data.get("error").get("code") == 499:
-                    # this is an inexplicable "token required" error
-                    # which will have a status_code of 200 👍
-                    res.status_code = 499
-                    raise Exception("Token Required")
+            # the feature service applyEdits answers with a list of layer results
+            error = (
+                response_data.get("error") if isinstance(response_data, dict) else None
+            )
+            error_code = (error or {}).get("code")
+            if error_code in TOKEN_ERROR_CODES:
+                # token errors like "Token Required" have a status_code of 200 👍
+                res.status_code = error_code
+                raise Exception(error.get("message", "Invalid Token"))
+            if error_code == 429:
+                # throttling errors can also arrive with a status_code of 200
+                res.status_code = 429
+                set_throttle(get_retry_after_seconds(res, sleep_seconds))
+                raise Exception("Too Many Requests")
         except Exception as e:
             if attempts >= max_retries or res.status_code == 400:
                 raise e
             logger.warn(
                 f"Retrying after status {res.status_code} on attempt #{attempts} of {max_retries}"
             )
-            time.sleep(sleep_seconds)
+            count_request(feature_type, retries=1)
+            if res.status_code in TOKEN_ERROR_CODES and "token" in data:
+                # Retrying with the same token can never succeed
+                refresh_token(data["token"])
+                data["token"] = os.getenv("AGOL_TOKEN")
+                count_request(feature_type, token_refreshes=1)
+            elif res.status_code != 429:
+                backoff_seconds = get_retry_after_seconds(
+                    res,
+                    get_backoff_seconds(attempts, sleep_seconds, max_sleep_seconds),
+                )
+                count_request(feature_type, backoff_seconds=backoff_seconds)
+                time.sleep(backoff_seconds)
             continue
+        last_attempt.seconds = time.monotonic() - attempt_started
         return res
 
 
@@ -216,7 +877,7 @@ def get_token():
         "referer": "http://www.arcgis.com",
         "f": "pjson",
     }
-    res = requests.post(url, data=data)
+    res = session.post(url, data=data, timeout=HTTP_TIMEOUT_SECONDS)
     res.raise_for_status()
     # like all the Esri REST endpoints this endpoint returns 200 where you would expect
     # 4xx - so we need to catch errors 👍👍👍👍👍
@@ -3,19 +3,32 @@
 import os
 import argparse
 import logging
+import time
 from datetime import datetime, timezone
+from functools import partial
 
 import knackpy
 
 from process.request import make_hasura_request
 from process.logging import get_logger
-from process.knack_data import build_knack_project_from_moped_project
+from process.knack_data import (
+    build_knack_project_from_moped_project,
+    is_knack_project_unchanged,
+)
+from process.knack_mirror import KnackMirror, KNACK_MIRROR_PATH
+from process.knack_writer import (
+    RateLimiter,
+    write_knack_record,
+    run_in_pool,
+    KNACK_REQUESTS_PER_SECOND,
+)
 from process.queries import (
     GET_SYNCED_PROJECTS,
     GET_TEST_SYNCED_PROJECTS,
     GET_UNSYNCED_PROJECTS,
     GET_TEST_UNSYNCED_PROJECTS,
     UPDATE_MOPED_PROJECT_KNACK_ID,
+    UPDATE_MOPED_PROJECTS_KNACK_IDS,
 )
 
 KNACK_DATA_TRACKER_APP_ID = os.getenv("KNACK_DATA_TRACKER_APP_ID")
@@ -23,6 +36,16 @@ KNACK_DATA_TRACKER_API_KEY = os.getenv("KNACK_DATA_TRACKER_API_KEY")
 TEST_MOPED_PROJECT_ID = os.getenv("TEST_MOPED_PROJECT_ID")
 
 KNACK_DATA_TRACKER_PROJECT_OBJECT = "object_201"
+KNACK_DATA_TRACKER_MOPED_PROJECT_ID_FIELD = "field_4133"
+
+# Moped projects whose Data Tracker records are read per request when checking for changes
+KNACK_READ_CHUNK_SIZE = 50
+
+# Knack record IDs written back to Moped projects per mutation
+MOPED_KNACK_ID_BATCH_SIZE = 100
+
+# Knack records written at once. Knack's rate limit is shared by all of them.
+KNACK_MAX_WORKERS = 4
 
 
 def find_unsynced_moped_projects(is_test=False):
@@ -57,18 +80,19 @@ def find_unsynced_moped_projects(is_test=False):
 
 
 def create_knack_project_from_moped_project(
-    moped_project_record, is_test=False, dry_run=True
+    moped_project_record, rate_limiter, is_test=False, dry_run=True
 ):
     """
     Create a Knack project record to sync a Moped project to Data Tracker
 
     Parameters:
         moped_project_record (dict): A Moped project record
+        rate_limiter (RateLimiter): keeps the requests of all workers within Knack's rate limit
         is_test (boolean): test flag added to add a compatible Knack signal record id to payload
         dry_run (boolean): if true, do not create record but print what would be created
 
     Returns:
-        String: Knack record ID of created record or None if running in DRY RUN mode
+        Dictionary: The created Knack record or None if running in DRY RUN mode
     """
     knack_project_record = build_knack_project_from_moped_project(
         moped_project_record=moped_project_record, is_test=is_test
@@ -78,7 +102,8 @@ def create_knack_project_from_moped_project(
         logger.info(f"[DRY RUN] Would create Knack record: {knack_project_record}")
         return None
     else:
-        created = knackpy.api.record(
+        created = write_knack_record(
+            rate_limiter=rate_limiter,
             app_id=KNACK_DATA_TRACKER_APP_ID,
             api_key=KNACK_DATA_TRACKER_API_KEY,
             method="create",
@@ -87,8 +112,7 @@ def create_knack_project_from_moped_project(
         )
 
         logger.debug(f"Created Knack record: {created}")
-        knack_record_id = created["id"]
-        return knack_record_id
+        return created
 
 
 def update_moped_project_knack_id(moped_project_id, knack_project_id):
@@ -116,6 +140,70 @@ def update_moped_project_knack_id(moped_project_id, knack_project_id):
     return update
 
 
+def update_moped_projects_knack_ids(created_knack_records):
+    """
+    Update Moped project records with the Knack record IDs of their synced records in one mutation
+
+    If the mutation fails, each project is updated on its own so that the failures are
+    reported per project.
+
+    Parameters:
+        created_knack_records (list): dicts of the `moped_project_id` and `knack_record_id`
+            of each created Knack record
+
+    Returns:
+        List: the created records whose Knack record ID could not be saved in Moped
+    """
+    try:
+        data = make_hasura_request(
+            query=UPDATE_MOPED_PROJECTS_KNACK_IDS,
+            variables={
+                "updates": [
+                    {
+                        "where": {"project_id": {"_eq": record["moped_project_id"]}},
+                        "_set": {"knack_project_id": record["knack_record_id"]},
+                    }
+                    for record in created_knack_records
+                ]
+            },
+        )
+    except Exception as e:
+        logger.error(
+            f"Failed to update {len(created_knack_records)} Moped projects with their Knack IDs at once, updating them one at a time: {e}"
+        )
+        failed_records = []
+        for record in created_knack_records:
+            try:
+                update = update_moped_project_knack_id(
+                    record["moped_project_id"], record["knack_record_id"]
+                )
+                if not update["update_moped_project_by_pk"]:
+                    raise ValueError("Moped project not found")
+            except Exception as e:
+                logger.error(
+                    f"Failed to update Moped project {record['moped_project_id']} with Knack ID {record['knack_record_id']}: {e}"
+                )
+                failed_records.append(record)
+        return failed_records
+
+    updated_project_ids = {
+        project["project_id"]
+        for result in data["update_moped_project_many"]
+        for project in result["returning"]
+    }
+    failed_records = []
+    for record in created_knack_records:
+        if record["moped_project_id"] not in updated_project_ids:
+            logger.error(
+                f"Failed to update Moped project {record['moped_project_id']} with Knack ID {record['knack_record_id']}: Moped project not found"
+            )
+            failed_records.append(record)
+    logger.debug(
+        f"Updated Moped projects {sorted(updated_project_ids)} with their Knack IDs"
+    )
+    return failed_records
+
+
 def find_synced_moped_projects(last_run_date, is_test=False):
     """
     Find a list of Moped projects that are already synced to Data Tracker
@@ -156,18 +244,19 @@ def find_synced_moped_projects(last_run_date, is_test=False):
 
 
 def update_knack_project_from_moped_project(
-    moped_project_record, is_test=False, dry_run=True
+    moped_project_record, rate_limiter, is_test=False, dry_run=True
 ):
     """
     Update a Knack project record already synced to Data Tracker from a Moped project record
 
     Parameters:
         moped_project_record (dict): A Moped project record
+        rate_limiter (RateLimiter): keeps the requests of all workers within Knack's rate limit
         is_test (boolean): test flag added to add a compatible Knack signal record id to payload
         dry_run (boolean): if true, if true, do not update record but print what would be updated
 
     Returns:
-        String: Knack record ID of updated record
+        Dictionary: The updated Knack record or None if running in DRY RUN mode
     """
     logger.debug(f"Updating Knack record for {moped_project_record}")
 
@@ -178,7 +267,8 @@ def update_knack_project_from_moped_project(
     knack_project_record["id"] = moped_project_record["knack_project_id"]
 
     if not dry_run:
-        updated = knackpy.api.record(
+        updated = write_knack_record(
+            rate_limiter=rate_limiter,
             app_id=KNACK_DATA_TRACKER_APP_ID,
             api_key=KNACK_DATA_TRACKER_API_KEY,
             method="update",
@@ -186,38 +276,186 @@ def update_knack_project_from_moped_project(
             obj=KNACK_DATA_TRACKER_PROJECT_OBJECT,
         )
 
-        knack_record_id = updated["id"]
-        return knack_record_id
+        return updated
 
     logger.info(f"[DRY RUN] would update project {knack_project_record}")
-    return moped_project_record["knack_project_id"]
+    return None
+
 
+def get_current_knack_projects(moped_project_ids, rate_limiter):
+    """
+    Read the Data Tracker records of Moped projects, a chunk of projects per request
+
+    Parameters:
+        moped_project_ids (list): Moped project IDs whose Knack records to read
+        rate_limiter (RateLimiter): keeps the requests within Knack's rate limit
+
+    Returns:
+        Dictionary: Knack project records keyed by Knack record ID
+    """
+    current_knack_projects = {}
+    for start in range(0, len(moped_project_ids), KNACK_READ_CHUNK_SIZE):
+        chunk = moped_project_ids[start : start + KNACK_READ_CHUNK_SIZE]
+        rate_limiter.acquire()
+        records = knackpy.api.get(
+            app_id=KNACK_DATA_TRACKER_APP_ID,
+            api_key=KNACK_DATA_TRACKER_API_KEY,
+            obj=KNACK_DATA_TRACKER_PROJECT_OBJECT,
+            filters={
+                "match": "or",
+                "rules": [
+                    {
+                        "field": KNACK_DATA_TRACKER_MOPED_PROJECT_ID_FIELD,
+                        "operator": "is",
+                        "value": moped_project_id,
+                    }
+                    for moped_project_id in chunk
+                ],
+            },
+        )
+        for record in records:
+            current_knack_projects[record["id"]] = record
+    return current_knack_projects
+
+
+def find_changed_moped_projects(
+    synced_moped_projects, rate_limiter, is_test=False, mirror=None
+):
+    """
+    Drop the synced Moped projects whose Data Tracker record already has the values we would send
+
+    A project's updated_at changes with edits to fields Data Tracker does not have, so most
+    of the projects found by date would be written with the same values they already have.
+
+    Parameters:
+        synced_moped_projects (list): Moped project records to be updated in Data Tracker
+        rate_limiter (RateLimiter): keeps the requests within Knack's rate limit
+        is_test (boolean): test flag added to add a compatible Knack signal record id to payload
+        mirror (KnackMirror): a local copy of the Data Tracker records to compare against
+            instead of reading them from Knack. Defaults to None.
+
+    Returns:
+        List: the Moped project records whose Knack record needs to be updated
+    """
+    if not synced_moped_projects:
+        return []
+
+    if mirror:
+        current_knack_projects = mirror.get_projects(
+            [project["knack_project_id"] for project in synced_moped_projects]
+        )
+    else:
+        logger.info(
+            f"Reading {len(synced_moped_projects)} Data Tracker records to find the ones that changed..."
+        )
+        current_knack_projects = get_current_knack_projects(
+            [project["project_id"] for project in synced_moped_projects], rate_limiter
+        )
+    changed_projects = []
+    for project in synced_moped_projects:
+        current_knack_project = current_knack_projects.get(project["knack_project_id"])
+        if not current_knack_project:
+            logger.warning(
+                f"Knack record {project['knack_project_id']} of Moped project {project['project_id']} was not found in Data Tracker"
+            )
+        knack_project_record = build_knack_project_from_moped_project(
+            moped_project_record=project, is_test=is_test
+        )
+        if current_knack_project and is_knack_project_unchanged(
+            knack_project_record, current_knack_project
+        ):
+            logger.debug(
+                f"Skipping unchanged Knack record {project['knack_project_id']} for Moped project {project['project_id']}"
+            )
+            continue
+        changed_projects.append(project)
+
+    logger.info(
+        f"Skipping {len(synced_moped_projects) - len(changed_projects)} Data Tracker records that are already up to date"
+    )
+    return changed_projects
+
+
+def log_throughput(action, count, started_at):
+    """
+    Log how many Knack records were written and how fast
+
+    Parameters:
+        action (string): what was done to the records, like "Created"
+        count (int): the number of records written
+        started_at (float): the `time.monotonic()` value when the writes started
+    """
+    seconds = time.monotonic() - started_at
+    rate = count / seconds if seconds else 0
+    logger.info(
+        f"{action} {count} Knack records in {seconds:.1f} seconds ({rate:.1f} per second)"
+    )
+
+
+def main(args, mirror=None):
+    # Every worker shares one rate limiter since Knack limits requests per app
+    rate_limiter = RateLimiter(KNACK_REQUESTS_PER_SECOND)
+    failed_project_ids = []
 
-def main(args):
     # Find all projects that are not synced to Data Tracker
     unsynced_moped_projects = find_unsynced_moped_projects(is_test=args.test)
 
     # Create a Knack project for each unsynced Moped project
-    logger.info(f"Creating Knack records...")
+    logger.info(f"Creating Knack records with up to {args.workers} workers...")
     created_knack_records = []
-    for project in unsynced_moped_projects:
-        moped_project_id = project["project_id"]
-        knack_record_id = create_knack_project_from_moped_project(
-            moped_project_record=project, is_test=args.test, dry_run=args.dry_run
-        )
-        created_knack_records.append(
-            {
-                "moped_project_id": moped_project_id,
-                "knack_record_id": knack_record_id,
-            }
-        )
+    # Created records whose Knack ID is not saved in Moped yet, and those that failed to save
+    unsaved_knack_records = []
+    failed_knack_id_records = []
 
-        if not args.dry_run:
-            # Update Moped project with Knack record ID of created record
+    def save_knack_ids():
+        if unsaved_knack_records:
             logger.info(
-                f"Updating Moped project {moped_project_id} with Knack ID {knack_record_id}"
+                f"Updating {len(unsaved_knack_records)} Moped projects with their Knack IDs..."
+            )
+            failed_knack_id_records.extend(
+                update_moped_projects_knack_ids(unsaved_knack_records)
             )
-            update_moped_project_knack_id(moped_project_id, knack_record_id)
+            unsaved_knack_records.clear()
+
+    started_at = time.monotonic()
+    try:
+        for project, knack_record, error in run_in_pool(
+            partial(
+                create_knack_project_from_moped_project,
+                rate_limiter=rate_limiter,
+                is_test=args.test,
+                dry_run=args.dry_run,
+            ),
+            unsynced_moped_projects,
+            args.workers,
+        ):
+            moped_project_id = project["project_id"]
+            if error:
+                logger.error(
+                    f"Failed to create Knack record for Moped project {moped_project_id}: {error}"
+                )
+                failed_project_ids.append(moped_project_id)
+                continue
+
+            created_knack_record = {
+                "moped_project_id": moped_project_id,
+                "knack_record_id": knack_record["id"] if knack_record else None,
+            }
+            created_knack_records.append(created_knack_record)
+
+            if not args.dry_run:
+                # Save Knack IDs in batches as records are created, so that a failed run
+                # does not create many records again
+                unsaved_knack_records.append(created_knack_record)
+                if len(unsaved_knack_records) >= MOPED_KNACK_ID_BATCH_SIZE:
+                    save_knack_ids()
+
+            if mirror and knack_record:
+                mirror.save_project(knack_record)
+    finally:
+        save_knack_ids()
+    if not args.dry_run:
+        log_throughput("Created", len(created_knack_records), started_at)
 
     # Find all projects that have been last updated since provided timestamp
     synced_moped_projects = find_synced_moped_projects(
@@ -225,23 +463,52 @@ def main(args):
     )
 
     # Update synced Moped projects in Data Tracker and skip those just created
-    logger.info(f"Updating...")
-    updated_knack_records = []
-    updates_to_skip = [record["moped_project_id"] for record in created_knack_records]
+    updates_to_skip = {record["moped_project_id"] for record in created_knack_records}
+    projects_to_update = [
+        project
+        for project in synced_moped_projects
+        if project["project_id"] not in updates_to_skip
+    ]
+    # and those whose Data Tracker record would not change
+    if not args.force:
+        projects_to_update = find_changed_moped_projects(
+            projects_to_update, rate_limiter, is_test=args.test, mirror=mirror
+        )
 
-    for project in synced_moped_projects:
-        if project["project_id"] in updates_to_skip:
+    logger.info(f"Updating with up to {args.workers} workers...")
+    updated_knack_records = []
+    started_at = time.monotonic()
+    for project, knack_record, error in run_in_pool(
+        partial(
+            update_knack_project_from_moped_project,
+            rate_limiter=rate_limiter,
+            is_test=args.test,
+            dry_run=args.dry_run,
+        ),
+        projects_to_update,
+        args.workers,
+    ):
+        moped_project_id = project["project_id"]
+        if error:
+            logger.error(
+                f"Failed to update Knack record {project['knack_project_id']} for Moped project {moped_project_id}: {error}"
+            )
+            failed_project_ids.append(moped_project_id)
             continue
 
-        moped_project_id = project["project_id"]
-        knack_record_id = update_knack_project_from_moped_project(
-            moped_project_record=project, is_test=args.test, dry_run=args.dry_run
-        )
+        if mirror and knack_record:
+            mirror.save_project(knack_record)
+
         updated_knack_records.append(
-            {"moped_project_id": moped_project_id, "knack_record_id": knack_record_id}
+            {
+                "moped_project_id": moped_project_id,
+                "knack_record_id": project["knack_project_id"],
+            }
         )
+    if not args.dry_run:
+        log_throughput("Updated", len(updated_knack_records), started_at)
 
-        logger.info(f"Done syncing.")
+    logger.info(f"Done syncing.")
     if not args.dry_run:
         logger.info(f"Created {len(created_knack_records)} new Knack records")
         logger.debug(f"Records created: {created_knack_records}")
@@ -257,6 +524,18 @@ def main(args):
         )
         logger.debug(f"[DRY RUN] Knack records to update: {updated_knack_records}")
 
+    if failed_knack_id_records:
+        # These Knack records exist but would be created again on the next run
+        raise Exception(
+            f"Created Knack records but failed to save their Knack IDs in {len(failed_knack_id_records)} Moped projects. "
+            f"Set knack_project_id on these projects before the next run: {failed_knack_id_records}"
+        )
+
+    if failed_project_ids:
+        raise Exception(
+            f"Failed to sync {len(failed_project_ids)} Moped projects: {sorted(failed_project_ids)}"
+        )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -278,6 +557,31 @@ if __name__ == "__main__":
         help="Log what changes would be made without executing them",
     )
 
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Update every synced project updated since the date, even if its Data Tracker record already has the same values.",
+    )
+
+    parser.add_argument(
+        "--mirror",
+        type=str,
+        nargs="?",
+        const=KNACK_MIRROR_PATH,
+        default=None,
+        metavar="FILE",
+        help=f"Refresh a local SQLite mirror of the Data Tracker projects and compare against it instead of reading the records to update from Knack. Defaults to {KNACK_MIRROR_PATH} if --mirror is used without a value.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=KNACK_MAX_WORKERS,
+        help=f"Maximum number of Knack records written at once. Defaults to {KNACK_MAX_WORKERS}.",
+    )
+
     args = parser.parse_args()
 
     log_level = logging.DEBUG if args.test else logging.INFO
@@ -291,4 +595,16 @@ if __name__ == "__main__":
             f"Starting sync. Creating Knack records for Moped projects not synced and updating synced Knack records with latest project data from Moped since {args.date}."
         )
 
-    main(args)
+    if args.workers < 1:
+        raise Exception("Please provide at least one worker for the -w flag.")
+
+    mirror = None
+    if args.mirror:
+        mirror = KnackMirror(args.mirror)
+        mirror.refresh(logger)
+
+    try:
+        main(args, mirror)
+    finally:
+        if mirror:
+            mirror.close()
@@ -0,0 +1,154 @@
+#
+# Delete Journal Helper - Records the deletes of a cleanup so that a failed cleanup can be resumed
+#
+import json
+import os
+from datetime import datetime, timezone
+
+
+class DeleteJournal:
+    """
+    An append-only JSON Lines journal of the Knack records a cleanup plans to delete and
+    the deletes Knack acknowledged
+
+    Starting a cleanup writes a "planned" event for every record to delete. Each delete
+    appends a "deleted" or "failed" event as soon as Knack answers, flushed to disk before
+    moving on, so a cleanup that dies partway through can pick up where it left off. A
+    planned delete that no longer qualifies when the cleanup resumes gets a "skipped" event
+    instead. A cleanup that finishes appends a "finished" event and the journal is kept as a log of
+    what was deleted.
+
+    Parameters:
+        path (string): the journal file
+        events (list): the events already recorded
+    """
+
+    def __init__(self, path, events):
+        self.path = path
+        self.planned = [
+            event["knack_id"] for event in events if event["event"] == "planned"
+        ]
+        self.deleted = {
+            event["knack_id"] for event in events if event["event"] == "deleted"
+        }
+        self.skipped = {
+            event["knack_id"] for event in events if event["event"] == "skipped"
+        }
+        self.finished = any(event["event"] == "finished" for event in events)
+
+    @classmethod
+    def start(cls, path, knack_ids, discard_unfinished=False):
+        """
+        Replace the journal of a finished cleanup and record the deletes a new cleanup plans to make
+
+        Parameters:
+            path (string): the journal file
+            knack_ids (list): the Knack record IDs to delete
+            discard_unfinished (bool): replace the journal even if its cleanup did not
+                finish. Defaults to False.
+
+        Raises:
+            ValueError: if the journal holds a cleanup that did not finish
+
+        Returns:
+            DeleteJournal: the journal of the new cleanup
+        """
+        if not discard_unfinished:
+            try:
+                unfinished = cls.load(path)
+            except ValueError:
+                unfinished = None
+            if unfinished:
+                raise ValueError(
+                    f"The cleanup in {path} did not finish and has {len(unfinished.get_pending())} deletes left. "
+                    "Run with --resume to finish it or --discard-journal to replace it."
+                )
+
+        events = [{"event": "planned", "knack_id": knack_id} for knack_id in knack_ids]
+        # Empty the journal of the previous cleanup
+        open(path, "w").close()
+        journal = cls(path, events)
+        journal._append(events)
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the journal of a cleanup that did not finish
+
+        Parameters:
+            path (string): the journal file
+
+        Raises:
+            ValueError: if there is no unfinished cleanup to resume
+
+        Returns:
+            DeleteJournal: the journal of the unfinished cleanup
+        """
+        events = []
+        try:
+            with open(path) as fin:
+                for line in fin:
+                    try:
+                        events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # The cleanup died while writing its last event
+                        break
+        except FileNotFoundError:
+            raise ValueError(f"No unfinished cleanup to resume in {path}")
+
+        journal = cls(path, events)
+        if journal.finished:
+            raise ValueError(f"The cleanup in {path} already finished")
+        return journal
+
+    def get_pending(self):
+        """
+        Return the planned deletes that were neither acknowledged by Knack nor skipped, in the order they were planned
+
+        Returns:
+            List: Knack record IDs
+        """
+        return [
+            knack_id
+            for knack_id in self.planned
+            if knack_id not in self.deleted and knack_id not in self.skipped
+        ]
+
+    def record_deleted(self, knack_id):
+        """
+        Record that Knack deleted a record
+        """
+        self.deleted.add(knack_id)
+        self._append([{"event": "deleted", "knack_id": knack_id}])
+
+    def record_skipped(self, knack_id, reason):
+        """
+        Record that a planned delete no longer qualifies and will not be made
+        """
+        self.skipped.add(knack_id)
+        self._append([{"event": "skipped", "knack_id": knack_id, "reason": reason}])
+
+    def record_failed(self, knack_id, error):
+        """
+        Record that a delete failed, so it is retried with --resume
+        """
+        self._append([{"event": "failed", "knack_id": knack_id, "error": str(error)}])
+
+    def finish(self):
+        """
+        Record that every planned delete was made
+        """
+        self.finished = True
+        self._append([{"event": "finished"}])
+
+    def _append(self, events):
+        """
+        Write events and make sure they reach the disk before moving on
+        """
+        recorded_at = datetime.now(timezone.utc).isoformat()
+        with open(self.path, "a") as fout:
+            for event in events:
+                fout.write(json.dumps({**event, "recorded_at": recorded_at}) + "\n")
+            fout.flush()
+            os.fsync(fout.fileno())
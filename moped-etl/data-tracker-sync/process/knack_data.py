@@ -68,3 +68,53 @@ def build_knack_project_from_moped_project(moped_project_record, is_test=False):
         "field_3861": signals,
         "field_4162": make_moped_project_url(moped_project_record["project_id"]),
     }
+
+
+def normalize_knack_value(value):
+    """
+    Reduce a Knack field value to a form that can be compared with the values we send
+
+    Parameters:
+        value: a value from a Knack record payload or a raw (`field_xxxx_raw`) Knack value
+
+    Returns:
+        A comparable value: None for empty values, sorted record IDs for connections, the
+        URL of a link, and integers for whole numbers
+    """
+    if value is None or value == "" or value == []:
+        return None
+    if isinstance(value, list):
+        return sorted(
+            item["id"] if isinstance(item, dict) else item for item in value
+        )
+    if isinstance(value, dict):
+        return value.get("url")
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def is_knack_project_unchanged(knack_project_record, current_knack_record):
+    """
+    Check if sending a Knack project record would leave the record in Knack as it is
+
+    A field missing from the current record counts as a change, so that it is written.
+
+    Parameters:
+        knack_project_record (dict): A Knack project record built from a Moped project
+        current_knack_record (dict): The record as read from the Knack API
+
+    Returns:
+        Boolean: True if every field we send already has the same value in Knack
+    """
+    for field, value in knack_project_record.items():
+        if field == "id":
+            continue
+        raw_field = f"{field}_raw"
+        if raw_field not in current_knack_record:
+            return False
+        if normalize_knack_value(value) != normalize_knack_value(
+            current_knack_record[raw_field]
+        ):
+            return False
+    return True
@@ -0,0 +1,266 @@
+#
+# Knack Mirror Helper - Keeps a local SQLite copy of the Data Tracker project records
+#
+import json
+import os
+import sqlite3
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import knackpy
+
+KNACK_DATA_TRACKER_APP_ID = os.getenv("KNACK_DATA_TRACKER_APP_ID")
+KNACK_DATA_TRACKER_API_KEY = os.getenv("KNACK_DATA_TRACKER_API_KEY")
+# The "date modified" fields of the mirrored objects. Without one, that object is downloaded
+# in full on every refresh.
+KNACK_DATA_TRACKER_PROJECT_MODIFIED_FIELD = os.getenv(
+    "KNACK_DATA_TRACKER_PROJECT_MODIFIED_FIELD"
+)
+KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_MODIFIED_FIELD = os.getenv(
+    "KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_MODIFIED_FIELD"
+)
+
+KNACK_DATA_TRACKER_PROJECT_OBJECT = "object_201"
+KNACK_DATA_TRACKER_MOPED_PROJECT_ID_FIELD = "field_4133"
+KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_OBJECT = "object_31"
+WORK_ORDER_SIGNALS_PROJECT_FIELD = "field_3965"
+
+KNACK_MIRROR_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "knack_mirror.sqlite"
+)
+# Records deleted in Knack are only dropped from the mirror by a full refresh, so a mirror
+# is downloaded in full again once its last full refresh is this old
+KNACK_MIRROR_FULL_REFRESH_DAYS = 7
+# Knack compares date filters by day in the app's time zone, so an incremental refresh asks
+# for the records modified after the day this many days before its last refresh there
+KNACK_APP_TIMEZONE = ZoneInfo("America/Chicago")
+KNACK_MIRROR_OVERLAP_DAYS = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS knack_projects (
+    id TEXT PRIMARY KEY,
+    moped_project_id INTEGER,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS work_order_signal_links (
+    work_order_signal_id TEXT NOT NULL,
+    knack_project_id TEXT NOT NULL,
+    PRIMARY KEY (work_order_signal_id, knack_project_id)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    object TEXT PRIMARY KEY,
+    refreshed_at TEXT NOT NULL,
+    full_refreshed_at TEXT NOT NULL
+);
+"""
+
+
+class KnackMirror:
+    """
+    A local SQLite copy of the Data Tracker project records and the work order signals
+    connected to them
+
+    `refresh` downloads the records modified since the last refresh by each object's date
+    modified field, so a run reads a few records from Knack instead of whole objects. The
+    sync scripts also write their own creates, updates and deletes to the mirror. Records
+    deleted in Knack by anything else stay in the mirror until its next full refresh.
+
+    Parameters:
+        path (string): the SQLite database file, which is created if it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def refresh(self, logger, full_objects=()):
+        """
+        Bring the mirror up to date with Knack
+
+        Parameters:
+            logger (logging.Logger): the logger of the running script
+            full_objects (list): the Knack object keys to download in full even if an
+                incremental refresh is due. Defaults to none.
+        """
+        self._refresh_object(
+            KNACK_DATA_TRACKER_PROJECT_OBJECT,
+            KNACK_DATA_TRACKER_PROJECT_MODIFIED_FIELD,
+            [],
+            self._replace_projects,
+            logger,
+            KNACK_DATA_TRACKER_PROJECT_OBJECT in full_objects,
+        )
+        self._refresh_object(
+            KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_OBJECT,
+            KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_MODIFIED_FIELD,
+            # A full refresh only needs the records connected to a project
+            [{"field": WORK_ORDER_SIGNALS_PROJECT_FIELD, "operator": "is not blank"}],
+            self._replace_work_order_signal_links,
+            logger,
+            KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_OBJECT in full_objects,
+        )
+
+    def get_project_ids(self):
+        """
+        Return the Knack record IDs of every mirrored project record
+
+        Returns:
+            List: Knack record IDs
+        """
+        return [row[0] for row in self.connection.execute("SELECT id FROM knack_projects")]
+
+    def get_projects(self, knack_ids):
+        """
+        Return the mirrored project records with the given Knack record IDs
+
+        Parameters:
+            knack_ids (list): Knack record IDs
+
+        Returns:
+            Dictionary: Knack project records keyed by Knack record ID, without the IDs that
+            are not in the mirror
+        """
+        projects = {}
+        for knack_id in knack_ids:
+            row = self.connection.execute(
+                "SELECT record FROM knack_projects WHERE id = ?", (knack_id,)
+            ).fetchone()
+            if row:
+                projects[knack_id] = json.loads(row[0])
+        return projects
+
+    def get_work_order_signals_project_counts(self):
+        """
+        Count the work order signals records connected to each project
+
+        Returns:
+            Counter: the number of work order signals records keyed by Knack project ID
+        """
+        return Counter(
+            dict(
+                self.connection.execute(
+                    "SELECT knack_project_id, COUNT(*) FROM work_order_signal_links GROUP BY knack_project_id"
+                )
+            )
+        )
+
+    def save_project(self, record):
+        """
+        Add or replace a project record, such as one the sync just created or updated
+        """
+        with self.connection:
+            self._upsert_projects([record])
+
+    def delete_project(self, knack_id):
+        """
+        Remove a project record that was deleted from Knack
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM knack_projects WHERE id = ?", (knack_id,))
+
+    def close(self):
+        self.connection.close()
+
+    def _refresh_object(
+        self, obj, modified_field, full_filters, replace, logger, force_full=False
+    ):
+        """
+        Download the records of an object that changed since its last refresh and store them
+
+        Parameters:
+            obj (string): the Knack object key
+            modified_field (string): the object's date modified field, or None
+            full_filters (list): the Knack filters of a full refresh
+            replace (function): stores records, given the records and whether the refresh
+                is full
+            logger (logging.Logger): the logger of the running script
+            force_full (boolean): download every record even if an incremental refresh is due
+        """
+        started_at = datetime.now(timezone.utc)
+        row = self.connection.execute(
+            "SELECT refreshed_at, full_refreshed_at FROM refreshes WHERE object = ?",
+            (obj,),
+        ).fetchone()
+        is_full = (
+            force_full
+            or not row
+            or not modified_field
+            or started_at - datetime.fromisoformat(row[1])
+            > timedelta(days=KNACK_MIRROR_FULL_REFRESH_DAYS)
+        )
+
+        if is_full:
+            logger.info(f"Downloading every {obj} record to the Knack mirror...")
+            filters = full_filters
+        else:
+            # The filter value is a day in the app's time zone, not a UTC timestamp
+            since = datetime.fromisoformat(row[0]).astimezone(
+                KNACK_APP_TIMEZONE
+            ) - timedelta(days=KNACK_MIRROR_OVERLAP_DAYS)
+            logger.info(
+                f"Downloading {obj} records modified since {since.date()} to the Knack mirror..."
+            )
+            filters = [
+                {
+                    "field": modified_field,
+                    "operator": "is after",
+                    "value": since.strftime("%m/%d/%Y"),
+                }
+            ]
+
+        records = knackpy.api.get(
+            app_id=KNACK_DATA_TRACKER_APP_ID,
+            api_key=KNACK_DATA_TRACKER_API_KEY,
+            obj=obj,
+            filters=filters or None,
+        )
+
+        with self.connection:
+            replace(records, is_full)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO refreshes (object, refreshed_at, full_refreshed_at) VALUES (?, ?, ?)",
+                (
+                    obj,
+                    started_at.isoformat(),
+                    started_at.isoformat() if is_full else row[1],
+                ),
+            )
+        logger.info(f"Stored {len(records)} {obj} records in the Knack mirror")
+
+    def _replace_projects(self, records, is_full):
+        if is_full:
+            self.connection.execute("DELETE FROM knack_projects")
+        self._upsert_projects(records)
+
+    def _upsert_projects(self, records):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO knack_projects (id, moped_project_id, record) VALUES (?, ?, ?)",
+            [
+                (
+                    record["id"],
+                    record.get(f"{KNACK_DATA_TRACKER_MOPED_PROJECT_ID_FIELD}_raw"),
+                    json.dumps(record),
+                )
+                for record in records
+            ],
+        )
+
+    def _replace_work_order_signal_links(self, records, is_full):
+        if is_full:
+            self.connection.execute("DELETE FROM work_order_signal_links")
+        else:
+            # A modified record may have been disconnected from its projects
+            self.connection.executemany(
+                "DELETE FROM work_order_signal_links WHERE work_order_signal_id = ?",
+                [(record["id"],) for record in records],
+            )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO work_order_signal_links (work_order_signal_id, knack_project_id) VALUES (?, ?)",
+            [
+                (record["id"], project["id"])
+                for record in records
+                for project in record.get(f"{WORK_ORDER_SIGNALS_PROJECT_FIELD}_raw") or []
+            ],
+        )
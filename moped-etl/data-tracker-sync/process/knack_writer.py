@@ -0,0 +1,175 @@
+#
+# Knack Writer Helper - Writes Knack records from a pool of workers within Knack's rate limit
+#
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import knackpy
+import requests
+
+# Knack allows an app 10 API requests per second
+KNACK_REQUESTS_PER_SECOND = 10
+# Attempts made for a record write before giving up
+KNACK_MAX_ATTEMPTS = 5
+# Backoff ceilings for failed writes, in seconds
+KNACK_BACKOFF_SECONDS = 1
+KNACK_MAX_BACKOFF_SECONDS = 30
+
+
+class RateLimiter:
+    """
+    A token bucket shared by every worker that writes to the same Knack app
+
+    Tokens refill at a steady rate up to `burst` tokens. Each request takes a token,
+    waiting for one if the bucket is empty. When Knack answers with a 429, `hold` empties
+    the bucket and stops every worker until the `Retry-After` window has passed.
+
+    Parameters:
+        rate (float): requests allowed per second
+        burst (int): requests that may be sent back to back after a pause. Defaults to 1,
+            which spaces every request evenly so no one-second window goes over the rate.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.held_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for a token to send one request
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.held_until:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated_at) * self.rate
+                    )
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_seconds = (1 - self.tokens) / self.rate
+                else:
+                    wait_seconds = self.held_until - now
+            time.sleep(wait_seconds)
+
+    def hold(self, seconds):
+        """
+        Stop every worker from sending requests for a while
+
+        Parameters:
+            seconds (float): how long to wait before the next request
+        """
+        with self._lock:
+            self.held_until = max(self.held_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated_at = self.held_until
+
+
+def get_retry_after_seconds(response, default_seconds):
+    """
+    Read how long Knack asked us to wait from a response's Retry-After header
+
+    Parameters:
+        response (requests.Response): a throttled response
+        default_seconds (float): the wait to use when the header is missing or not a number
+
+    Returns:
+        Float: seconds to wait
+    """
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return default_seconds
+
+
+def write_knack_record(
+    *, rate_limiter, app_id, api_key, obj, method, data, max_attempts=KNACK_MAX_ATTEMPTS
+):
+    """
+    Create, update, or delete a Knack record within the rate limit, retrying failed requests
+
+    Throttled (429) requests wait out Knack's Retry-After window. Server errors, timeouts and
+    dropped connections are retried with exponential backoff and jitter. Any other error is
+    raised right away.
+
+    Parameters:
+        rate_limiter (RateLimiter): the rate limiter of the Knack app
+        app_id (string): the Knack app ID
+        api_key (string): the Knack API key
+        obj (string): the Knack object key of the record
+        method (string): "create", "update", or "delete"
+        data (dict): the Knack record payload, with an "id" for updates and deletes
+        max_attempts (int): the number of attempts to make before raising the error
+
+    Returns:
+        Dictionary: The created or updated Knack record, or `{"delete": true}`
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        rate_limiter.acquire()
+        try:
+            # Retries are handled here so that they respect the rate limit
+            return knackpy.api.record(
+                app_id=app_id,
+                api_key=api_key,
+                obj=obj,
+                method=method,
+                data=data,
+                max_attempts=1,
+            )
+        except requests.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code == 429:
+                if attempts >= max_attempts:
+                    raise e
+                rate_limiter.hold(
+                    get_retry_after_seconds(e.response, KNACK_BACKOFF_SECONDS)
+                )
+                continue
+            if status_code is not None and status_code < 500:
+                raise e
+            if attempts >= max_attempts:
+                raise e
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if attempts >= max_attempts:
+                raise e
+        backoff_ceiling = min(
+            KNACK_BACKOFF_SECONDS * 2 ** (attempts - 1), KNACK_MAX_BACKOFF_SECONDS
+        )
+        time.sleep(random.uniform(0, backoff_ceiling))
+
+
+def run_in_pool(function, items, max_workers):
+    """
+    Call a function on each item from a bounded pool of workers
+
+    A failed call does not stop the others, so every item gets a result. If the caller
+    stops early, for example because its loop raised or was interrupted, the calls that
+    have not started are cancelled and only the ones in flight are waited for.
+
+    Parameters:
+        function (function): called with one item at a time
+        items (list): the items to process
+        max_workers (int): the maximum number of calls in flight
+
+    Yields:
+        Tuple: `(item, result, error)` for each item as its call finishes, where either
+        the result or the error is None
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -86,3 +86,13 @@ mutation UpdateMopedProjectKnackId($moped_project_id: Int!, $knack_project_id: S
   }
 }
 """
+
+UPDATE_MOPED_PROJECTS_KNACK_IDS = """
+mutation UpdateMopedProjectsKnackIds($updates: [moped_project_updates!]!) {
+  update_moped_project_many(updates: $updates) {
+    returning {
+      project_id
+    }
+  }
+}
+"""
@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 
 import os
+import argparse
 import logging
+import time
+from collections import Counter
+from functools import partial
 
 import knackpy
+import requests
 
 from process.request import make_hasura_request
 from process.logging import get_logger
+from process.delete_journal import DeleteJournal
+from process.knack_mirror import KnackMirror, KNACK_MIRROR_PATH
+from process.knack_writer import (
+    RateLimiter,
+    write_knack_record,
+    run_in_pool,
+    KNACK_REQUESTS_PER_SECOND,
+)
 
 KNACK_DATA_TRACKER_APP_ID = os.getenv("KNACK_DATA_TRACKER_APP_ID")
 KNACK_DATA_TRACKER_API_KEY = os.getenv("KNACK_DATA_TRACKER_API_KEY")
@@ -16,6 +29,13 @@ KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_OBJECT = "object_31"
 
 WORK_ORDER_SIGNALS_PROJECT_FIELD = "field_3965"
 
+# Knack records deleted at once. Knack's rate limit is shared by all of them.
+KNACK_MAX_WORKERS = 4
+# Where the planned and completed deletes of the last cleanup are journaled for --resume
+DELETE_JOURNAL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "delete_journal.jsonl"
+)
+
 GET_MOPED_PROJECTS = """
 query GetMopedProjects {
   moped_project(where: { knack_project_id: { _is_null: false }}) {
@@ -67,22 +87,118 @@ def check_for_work_order_signals_connection(knack_id):
     return work_order_signals
 
 
-def delete_knack_project_record(knack_id):
-    logger.info(f"Deleting Knack project record with ID: {knack_id}")
-    knackpy.api.record(
+def get_work_order_signals_project_counts():
+    """
+    Download every work order signals record connected to a project in one paginated read
+
+    Returns:
+        Counter: the number of work order signals records connected to each Knack project ID
+    """
+    work_order_signals = knackpy.api.get(
         app_id=KNACK_DATA_TRACKER_APP_ID,
         api_key=KNACK_DATA_TRACKER_API_KEY,
-        obj=KNACK_DATA_TRACKER_PROJECT_OBJECT,
-        method="delete",
-        data={"id": knack_id},
+        obj=KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_OBJECT,
+        filters=[
+            {
+                "field": WORK_ORDER_SIGNALS_PROJECT_FIELD,
+                "operator": "is not blank",
+            }
+        ],
     )
 
+    project_counts = Counter()
+    for work_order_signal in work_order_signals:
+        for project in work_order_signal.get(f"{WORK_ORDER_SIGNALS_PROJECT_FIELD}_raw") or []:
+            project_counts[project["id"]] += 1
+
+    logger.info(
+        f"Found {len(work_order_signals)} work order signals records connected to {len(project_counts)} Knack projects"
+    )
+    return project_counts
+
+
+def delete_knack_project_record(knack_id, rate_limiter):
+    logger.info(f"Deleting Knack project record with ID: {knack_id}")
+    try:
+        write_knack_record(
+            rate_limiter=rate_limiter,
+            app_id=KNACK_DATA_TRACKER_APP_ID,
+            api_key=KNACK_DATA_TRACKER_API_KEY,
+            obj=KNACK_DATA_TRACKER_PROJECT_OBJECT,
+            method="delete",
+            data={"id": knack_id},
+        )
+    except requests.HTTPError as e:
+        # A resumed cleanup can retry a delete that Knack made before the run died
+        if e.response is None or e.response.status_code != 404:
+            raise e
+        logger.info(f"Knack project record {knack_id} was already deleted")
+
 
-def main():
+def delete_knack_project_records(knack_ids, journal, max_workers, mirror=None):
+    """
+    Delete Knack project records from a pool of workers and journal each delete
+
+    Parameters:
+        knack_ids (list): the Knack record IDs to delete
+        journal (DeleteJournal): the journal of the cleanup
+        max_workers (int): the maximum number of deletes in flight
+        mirror (KnackMirror): a local copy of the Data Tracker records to remove the
+            deleted records from. Defaults to None.
+    """
+    rate_limiter = RateLimiter(KNACK_REQUESTS_PER_SECOND)
+    failed_ids = []
+    started_at = time.monotonic()
+    for knack_id, _, error in run_in_pool(
+        partial(delete_knack_project_record, rate_limiter=rate_limiter),
+        knack_ids,
+        max_workers,
+    ):
+        if error:
+            logger.error(f"Failed to delete Knack project record {knack_id}: {error}")
+            journal.record_failed(knack_id, error)
+            failed_ids.append(knack_id)
+            continue
+        journal.record_deleted(knack_id)
+        if mirror:
+            mirror.delete_project(knack_id)
+
+    seconds = time.monotonic() - started_at
+    deleted_count = len(knack_ids) - len(failed_ids)
+    rate = deleted_count / seconds if seconds else 0
+    logger.info(
+        f"Deleted {deleted_count} Knack project records in {seconds:.1f} seconds ({rate:.1f} per second)"
+    )
+
+    if failed_ids:
+        raise Exception(
+            f"Failed to delete {len(failed_ids)} Knack project records. Run again with --resume to retry them: {failed_ids}"
+        )
+    journal.finish()
+
+
+def find_knack_project_records_to_delete(args, mirror=None):
+    """
+    Find the Knack project records that are not synced to a Moped project and have no work
+    order signals connected
+
+    Parameters:
+        args (argparse.Namespace): the CLI namespace
+        mirror (KnackMirror): a local copy of the Data Tracker records to read instead of
+            Knack. Defaults to None.
+
+    Returns:
+        List: the Knack record IDs to delete
+    """
     logger.info(f"Getting all Knack project IDs from Moped projects...")
     knack_project_ids_in_moped = get_synced_moped_project_knack_ids()
-    logger.info(f"Getting all Knack project IDs from Knack...")
-    knack_project_ids_in_knack = get_knack_project_record_ids()
+    if mirror:
+        logger.info(f"Getting all Knack project IDs from the Knack mirror...")
+        knack_project_ids_in_knack = mirror.get_project_ids()
+        logger.info(f"Found {len(knack_project_ids_in_knack)} Knack projects")
+    else:
+        logger.info(f"Getting all Knack project IDs from Knack...")
+        knack_project_ids_in_knack = get_knack_project_record_ids()
 
     logger.info(f"Finding overlap and differences in those lists...")
     ids_in_both_tables = list(
@@ -101,32 +217,217 @@ def main():
     )
 
     logger.info(f"Checking Knack project records for work order signals connections...")
+    if mirror:
+        work_order_signals_project_counts = mirror.get_work_order_signals_project_counts()
+    elif args.bulk_signals_check:
+        # Decide for every record locally instead of asking Knack about each one
+        work_order_signals_project_counts = get_work_order_signals_project_counts()
+
     deletes_to_skip = []
+    knack_ids_to_delete = []
     count = 1
     for id in ids_not_in_both_tables:
         logger.info(f"{count}/{len(ids_not_in_both_tables)}: Knack ID {id}")
-
-        work_order_signals = check_for_work_order_signals_connection(id)
         count += 1
 
-        if len(work_order_signals) > 0:
-            logger.info(
-                f"Found work order signals connected to project ID {id}: {work_order_signals}"
-            )
-            deletes_to_skip.append(id)
+        if mirror or args.bulk_signals_check:
+            work_order_signals_count = work_order_signals_project_counts[id]
+            if work_order_signals_count > 0:
+                logger.info(
+                    f"Found {work_order_signals_count} work order signals connected to project ID {id}"
+                )
+                deletes_to_skip.append(id)
+                continue
         else:
-            logger.info(f"No work order signals connection found deleting...")
-            delete_knack_project_record(id)
+            work_order_signals = check_for_work_order_signals_connection(id)
+            if len(work_order_signals) > 0:
+                logger.info(
+                    f"Found work order signals connected to project ID {id}: {work_order_signals}"
+                )
+                deletes_to_skip.append(id)
+                continue
+
+        logger.info(f"No work order signals connection found, marking for deletion...")
+        knack_ids_to_delete.append(id)
 
     logger.info(
         f"Record IDs of {len(deletes_to_skip)} deletes skipped: {deletes_to_skip}"
     )
+    return knack_ids_to_delete
+
+
+def check_pending_knack_project_records(knack_ids, mirror=None):
+    """
+    Check the deletes left in an unfinished cleanup again, since projects can be linked
+    to Moped or connected to work order signals after the cleanup was planned
+
+    Parameters:
+        knack_ids (list): the Knack record IDs the cleanup has left to delete
+        mirror (KnackMirror): a local copy of the Data Tracker records to read instead of
+            Knack. Defaults to None.
+
+    Returns:
+        Tuple: the Knack record IDs to delete and a dict of the reason each other record
+            no longer qualifies, keyed by Knack record ID
+    """
+    logger.info(f"Checking the deletes left against Moped projects...")
+    knack_project_ids_in_moped = set(get_synced_moped_project_knack_ids())
+
+    logger.info(f"Checking the deletes left for work order signals connections...")
+    if mirror:
+        work_order_signals_project_counts = mirror.get_work_order_signals_project_counts()
+    else:
+        work_order_signals_project_counts = get_work_order_signals_project_counts()
+
+    knack_ids_to_delete = []
+    deletes_to_skip = {}
+    for id in knack_ids:
+        if id in knack_project_ids_in_moped:
+            deletes_to_skip[id] = "Synced to a Moped project"
+        elif work_order_signals_project_counts[id] > 0:
+            deletes_to_skip[id] = (
+                f"Connected to {work_order_signals_project_counts[id]} work order signals"
+            )
+        else:
+            knack_ids_to_delete.append(id)
+
+    for id, reason in deletes_to_skip.items():
+        logger.info(f"Knack ID {id} no longer qualifies for deletion: {reason}")
+    logger.info(
+        f"{len(knack_ids_to_delete)} of {len(knack_ids)} deletes left still qualify"
+    )
+    return knack_ids_to_delete, deletes_to_skip
+
+
+def main(args, mirror=None):
+    if args.resume:
+        journal = DeleteJournal.load(args.journal)
+        knack_ids_to_delete, deletes_to_skip = check_pending_knack_project_records(
+            journal.get_pending(), mirror
+        )
+        if not args.dry_run:
+            for knack_id, reason in deletes_to_skip.items():
+                journal.record_skipped(knack_id, reason)
+        logger.info(
+            f"Resuming the cleanup in {args.journal} with {len(knack_ids_to_delete)} of {len(journal.planned)} deletes left..."
+        )
+    else:
+        knack_ids_to_delete = find_knack_project_records_to_delete(args, mirror)
+
+    if args.dry_run:
+        for knack_id in knack_ids_to_delete:
+            logger.info(f"[DRY RUN] Would delete Knack project record with ID: {knack_id}")
+        logger.info(
+            f"[DRY RUN] {len(knack_ids_to_delete)} Knack project records to delete"
+        )
+        return
+
+    if not args.resume:
+        journal = DeleteJournal.start(
+            args.journal, knack_ids_to_delete, args.discard_journal
+        )
+        logger.info(
+            f"Journaling {len(knack_ids_to_delete)} planned deletes in {args.journal}"
+        )
+
+    logger.info(
+        f"Deleting {len(knack_ids_to_delete)} Knack project records with up to {args.workers} workers..."
+    )
+    delete_knack_project_records(knack_ids_to_delete, journal, args.workers, mirror)
     logger.info(f"Done.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--bulk-signals-check",
+        action="store_true",
+        help="Download every work order signals record connected to a project at once and check the records to delete against it, instead of asking Knack about each record.",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Log the Knack project records that would be deleted without deleting them",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the cleanup journaled by a run that did not finish. The deletes left are checked against Moped and the work order signals again instead of evaluating every record.",
+    )
+
+    parser.add_argument(
+        "--discard-journal",
+        action="store_true",
+        help="Start a new cleanup even if the journal holds a cleanup that did not finish.",
+    )
+
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=DELETE_JOURNAL_PATH,
+        help=f"The file that journals the planned and completed deletes. Defaults to {DELETE_JOURNAL_PATH}.",
+    )
+
+    parser.add_argument(
+        "--mirror",
+        type=str,
+        nargs="?",
+        const=KNACK_MIRROR_PATH,
+        default=None,
+        metavar="FILE",
+        help=f"Refresh a local SQLite mirror of the Data Tracker projects and work order signals and check the records to delete against it instead of reading them from Knack. Defaults to {KNACK_MIRROR_PATH} if --mirror is used without a value.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=KNACK_MAX_WORKERS,
+        help=f"Maximum number of Knack records deleted at once. Defaults to {KNACK_MAX_WORKERS}.",
+    )
+
+    args = parser.parse_args()
+
+    if args.resume and args.bulk_signals_check:
+        raise Exception(
+            "The --resume flag already checks the deletes left against every work order signal at once and cannot be combined with --bulk-signals-check."
+        )
+
+    if args.resume and args.discard_journal:
+        raise Exception(
+            "The --resume flag continues the unfinished cleanup in the journal and cannot be combined with --discard-journal."
+        )
+
+    if args.mirror and args.bulk_signals_check:
+        raise Exception(
+            "The --mirror flag already checks every record against the mirrored work order signals and cannot be combined with --bulk-signals-check."
+        )
+
+    if args.workers < 1:
+        raise Exception("Please provide at least one worker for the -w flag.")
+
     log_level = logging.INFO
     logger = get_logger(name="sync_evaluation", level=log_level)
     logger.info(f"Starting.")
 
-    main()
+    mirror = None
+    if args.mirror:
+        mirror = KnackMirror(args.mirror)
+        # A link to a work order signal that the mirror missed would let a project
+        # be deleted, so the links are downloaded in full before deleting anything
+        mirror.refresh(
+            logger,
+            full_objects=(
+                [] if args.dry_run else [KNACK_DATA_TRACKER_WORK_ORDER_SIGNALS_OBJECT]
+            ),
+        )
+
+    try:
+        main(args, mirror)
+    finally:
+        if mirror:
+            mirror.close()